@@ -0,0 +1,317 @@
+'''
+Benchmarks for the tiling and rendering hot paths
+
+Synthetic slides are generated offline (nothing is downloaded and no real model is needed) and every benchmark's
+throughput is written to a json file. Pass a previous run's json with --compare to see how a change affected each
+benchmark
+
+    python benchmarks/run_benchmarks.py --out results.json
+    python benchmarks/run_benchmarks.py --out new.json --compare results.json
+'''
+
+import os
+import sys
+import json
+import time
+import logging
+import platform
+import argparse
+import tempfile
+import numpy as np
+import cv2
+from PIL import Image
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from brain_utils.general_utility.slide import Slide
+from brain_utils.general_utility.image_creator import ImageCreator
+from brain_utils.general_utility.tile_image_utils import TileUtils
+from brain_utils.general_utility.tiff_writer import write_tiled_tiff
+from brain_utils.general_utility.ai.tileextractor import TileExtractor
+
+# the library's own progress logging is left at warning level so that only the results get logged
+logger = logging.getLogger('benchmarks')
+
+# mpp of the synthetic slides. tiles are extracted at this mpp times each of the mpp ratios
+SLIDE_MPP = 0.2520
+
+
+class StubModel:
+    '''
+    Stands in for a keras model. Preds are a softmax over per-channel means of the tiles so they depend on the tiles
+    but cost next to nothing
+    '''
+
+    def __init__(self, num_classes=9):
+        self.num_classes = num_classes
+
+    def predict_on_batch(self, imgs):
+        means = imgs.reshape(len(imgs), -1, imgs.shape[-1]).mean(axis=1)
+        logits = np.resize(means, (len(imgs), self.num_classes)) * 10
+        e = np.exp(logits - logits.max(axis=1, keepdims=True))
+        return e / e.sum(axis=1, keepdims=True)
+
+
+def make_synthetic_slide(width, height, tissue_fraction, seed=0):
+    '''
+    Makes a slide-like RGB image: off-white background with noisy pink/purple blobs of tissue covering roughly the
+    given fraction of the image
+
+    :param width:
+    :param height:
+    :param tissue_fraction: between 0 and 1
+    :param seed:
+    :return: RGB uint8 array
+    '''
+
+    rng = np.random.default_rng(seed)
+
+    # tissue mask made at a low resolution and scaled up so blobs are smooth
+    small = cv2.GaussianBlur(rng.random((max(1, height // 64), max(1, width // 64))).astype(np.float32), (0, 0), 2)
+    threshold = np.quantile(small, 1 - tissue_fraction) if tissue_fraction > 0 else np.inf
+    mask = cv2.resize((small >= threshold).astype(np.uint8), (width, height), interpolation=cv2.INTER_NEAREST)
+
+    img = np.empty((height, width, 3), dtype=np.uint8)
+    img[:] = (242, 240, 244)
+
+    tissue = np.nonzero(mask)
+    noise = rng.integers(-30, 30, (len(tissue[0]), 1))
+    img[tissue] = np.clip(np.array([200, 120, 170]) + noise + rng.integers(-10, 10, (len(tissue[0]), 3)), 0, 255)
+    return img
+
+
+def write_synthetic_slides(directory, width, height, tissue_fraction):
+    '''
+    Writes the synthetic slide as a jpeg compressed pyramidal tiff and as a jpeg
+
+    :return: dict of format -> path
+    '''
+
+    img = make_synthetic_slide(width, height, tissue_fraction)
+
+    levels = []
+    level = img
+    while True:
+        levels.append((level.shape[1], level.shape[0], lambda y1, y2, level=level: level[y1:y2]))
+        if max(level.shape[:2]) <= 2048:
+            break
+        level = cv2.resize(level, (-(-level.shape[1] // 2), -(-level.shape[0] // 2)), interpolation=cv2.INTER_AREA)
+
+    paths = {'tiff': os.path.join(directory, 'synthetic.tif'), 'jpeg': os.path.join(directory, 'synthetic.jpg')}
+    write_tiled_tiff(paths['tiff'], levels, tile_size=256, compression='jpeg')
+    Image.fromarray(img).save(paths['jpeg'], quality=90)
+    return paths
+
+
+def timed(fn, repeat):
+    '''
+    Runs fn `repeat` times
+
+    :return: (best time in seconds, what the last run returned)
+    '''
+
+    best, res = np.inf, None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        res = fn()
+        best = min(best, time.perf_counter() - start)
+    return best, res
+
+
+class Benchmarks:
+
+    def __init__(self, slide_paths, tile_size, repeat):
+        self.slide_paths = slide_paths
+        self.tile_size = tile_size
+        self.repeat = repeat
+        self.results = []
+
+    def record(self, name, params, seconds, items, unit):
+        '''
+        Stores (and logs) the throughput of a benchmark
+        '''
+
+        result = {
+            'name': name,
+            'params': params,
+            'seconds': seconds,
+            'items': items,
+            'unit': unit,
+            'per_sec': items / seconds if seconds > 0 else None,
+        }
+        self.results.append(result)
+        logger.info('{:<32} {:<60} {:>12.1f} {}/s'.format(name, json.dumps(params), result['per_sec'] or 0, unit))
+
+    def _tile_extractor(self, fmt, mpp_ratio):
+        slide = Slide(self.slide_paths[fmt])
+        slide.mpp = SLIDE_MPP
+        return TileExtractor(slide, tile_size=self.tile_size, desired_tile_mpp=SLIDE_MPP * mpp_ratio)
+
+    def iterate_tiles(self, batch_sizes, mpp_ratios, num_workers=(0,)):
+        for fmt in self.slide_paths:
+            for mpp_ratio in mpp_ratios:
+                for batch_size in batch_sizes:
+                    for workers in num_workers:
+                        def run():
+                            te = self._tile_extractor(fmt, mpp_ratio)
+                            return sum(len(res['tiles']) for res in te.iterate_tiles(
+                                min_non_blank_amt=0.1, batch_size=batch_size, print_time=False, num_workers=workers))
+
+                        seconds, n = timed(run, self.repeat)
+                        self.record('iterate_tiles', {'format': fmt, 'mpp_ratio': mpp_ratio, 'batch_size': batch_size,
+                                                      'num_workers': workers}, seconds, n, 'tiles')
+
+    def iterate_tiles_with_lesion_conf(self, batch_sizes, mpp_ratios, queue_depths=(0, 1)):
+        model = StubModel()
+        for mpp_ratio in mpp_ratios:
+            for batch_size in batch_sizes:
+                for queue_depth in queue_depths:
+                    def run():
+                        te = self._tile_extractor('tiff', mpp_ratio)
+                        return sum(len(res['tiles']) for res in te.iterate_tiles_with_lesion_conf(
+                            model, [0, 1, 2], min_non_blank_amt=0.1, batch_size=batch_size, print_time=False,
+                            queue_depth=queue_depth))
+
+                    seconds, n = timed(run, self.repeat)
+                    self.record('iterate_tiles_with_lesion_conf', {'format': 'tiff', 'mpp_ratio': mpp_ratio,
+                                                                   'batch_size': batch_size,
+                                                                   'queue_depth': queue_depth}, seconds, n, 'tiles')
+
+    def amount_blank(self, num_tiles):
+        tiles = self._sample_tiles(num_tiles)
+
+        seconds, _ = timed(lambda: [TileExtractor.amount_blank(t) for t in tiles], self.repeat)
+        self.record('amount_blank', {'tile_size': self.tile_size}, seconds, len(tiles), 'tiles')
+
+        seconds, _ = timed(lambda: [TileExtractor.amount_blank_fast(t) for t in tiles], self.repeat)
+        self.record('amount_blank_fast', {'tile_size': self.tile_size}, seconds, len(tiles), 'tiles')
+
+        seconds, _ = timed(lambda: TileExtractor.amount_blank_fast(tiles), self.repeat)
+        self.record('amount_blank_fast_batch', {'tile_size': self.tile_size}, seconds, len(tiles), 'tiles')
+
+    def add_border(self, num_tiles):
+        tiles = self._sample_tiles(num_tiles)
+
+        def run():
+            for t in tiles:
+                TileUtils.add_border(t, thickness=0.05, color=(0, 255, 0))
+
+        seconds, _ = timed(run, self.repeat)
+        self.record('add_border', {'tile_size': self.tile_size}, seconds, len(tiles), 'tiles')
+
+    def make_image_vector_using_tiles(self, num_tiles):
+        tiles = self._sample_tiles(num_tiles)
+
+        seconds, _ = timed(lambda: TileUtils.make_image_vector_using_tiles(tiles, tiles_per_row=3), self.repeat)
+        self.record('make_image_vector_using_tiles', {'tile_size': self.tile_size}, seconds, len(tiles), 'tiles')
+
+    def image_creator(self, scale_factors):
+        te = self._tile_extractor('tiff', 1)
+        batches = [(res['tiles'].copy(), res['coordinates'].copy())
+                   for res in te.iterate_tiles(batch_size=16, print_time=False)]
+        n = sum(len(tiles) for tiles, _ in batches)
+
+        for scale_factor in scale_factors:
+            def add_tile():
+                ic = ImageCreator(te.trimmed_height, te.trimmed_width, scale_factor=scale_factor)
+                for tiles, coordinates in batches:
+                    for tile, coordinate in zip(tiles, coordinates):
+                        ic.add_tile(tile, coordinate)
+                ic.add_borders([c for _, coordinates in batches for c in coordinates[:1]])
+
+            def add_tiles():
+                ic = ImageCreator(te.trimmed_height, te.trimmed_width, scale_factor=scale_factor)
+                for tiles, coordinates in batches:
+                    ic.add_tiles(tiles, coordinates)
+                ic.add_borders([c for _, coordinates in batches for c in coordinates[:1]])
+
+            seconds, _ = timed(add_tile, self.repeat)
+            self.record('image_creator_add_tile', {'scale_factor': scale_factor}, seconds, n, 'tiles')
+
+            seconds, _ = timed(add_tiles, self.repeat)
+            self.record('image_creator_add_tiles', {'scale_factor': scale_factor}, seconds, n, 'tiles')
+
+    def _sample_tiles(self, num_tiles):
+        # real looking tiles, a mix of tissue and background
+        reader = Slide(self.slide_paths['tiff']).reader
+        rng = np.random.default_rng(0)
+        xs = rng.integers(0, reader.width - self.tile_size, num_tiles)
+        ys = rng.integers(0, reader.height - self.tile_size, num_tiles)
+        tiles = np.stack([reader.read_region((x, y, x + self.tile_size, y + self.tile_size))[:, :, ::-1]
+                          for x, y in zip(xs, ys)])
+        reader.close()
+        return tiles
+
+
+def compare(results, baseline_path):
+    '''
+    Logs the speedup of every benchmark over the same benchmark in a previous run
+    '''
+
+    with open(baseline_path) as f:
+        baseline = {(r['name'], json.dumps(r['params'], sort_keys=True)): r for r in json.load(f)['results']}
+
+    for r in results:
+        old = baseline.get((r['name'], json.dumps(r['params'], sort_keys=True)))
+        if old is None or not old['per_sec'] or not r['per_sec']:
+            continue
+        logger.info('{:<32} {:<60} {:>6.2f}x'.format(r['name'], json.dumps(r['params']), r['per_sec'] / old['per_sec']))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--out', default='benchmark_results.json', help='json file to write the results to')
+    parser.add_argument('--compare', help='json file of a previous run to compare against')
+    parser.add_argument('--width', type=int, default=12288, help='synthetic slide width')
+    parser.add_argument('--height', type=int, default=8192, help='synthetic slide height')
+    parser.add_argument('--tissue-fraction', type=float, default=0.4, help='fraction of the slide covered by tissue')
+    parser.add_argument('--tile-size', type=int, default=1024)
+    parser.add_argument('--batch-sizes', type=int, nargs='+', default=[1, 4, 16])
+    parser.add_argument('--mpp-ratios', type=float, nargs='+', default=[1, 2],
+                        help='desired tile mpp as a multiple of the slide mpp')
+    parser.add_argument('--num-tiles', type=int, default=64, help='tiles used by the per-tile benchmarks')
+    parser.add_argument('--repeat', type=int, default=3, help='best of this many runs is reported')
+    parser.add_argument('--workdir', help='where the synthetic slides are written. a temporary directory by default')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING, format='%(message)s')
+    logger.setLevel(logging.INFO)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        workdir = args.workdir or tmp
+        os.makedirs(workdir, exist_ok=True)
+
+        logger.info('Writing {}x{} synthetic slides to {}'.format(args.width, args.height, workdir))
+        slide_paths = write_synthetic_slides(workdir, args.width, args.height, args.tissue_fraction)
+
+        b = Benchmarks(slide_paths, args.tile_size, args.repeat)
+        b.iterate_tiles(args.batch_sizes, args.mpp_ratios)
+        b.iterate_tiles(args.batch_sizes[-1:], args.mpp_ratios[:1], num_workers=(4,))
+        b.iterate_tiles_with_lesion_conf(args.batch_sizes, args.mpp_ratios)
+        b.amount_blank(args.num_tiles)
+        b.add_border(args.num_tiles)
+        b.make_image_vector_using_tiles(args.num_tiles)
+        b.image_creator([1, 4, 16])
+
+    output = {
+        'meta': {
+            'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'opencv': cv2.__version__,
+            'platform': platform.platform(),
+            'cpu_count': os.cpu_count(),
+            'args': vars(args),
+        },
+        'results': b.results,
+    }
+    with open(args.out, 'w') as f:
+        json.dump(output, f, indent=2)
+    logger.info('Results written to {}'.format(args.out))
+
+    if args.compare:
+        compare(b.results, args.compare)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,10 +1,40 @@
 import numpy as np
-import tensorflow.keras.backend as K
 from fuzzywuzzy import process, fuzz
 import logging
+import functools
+import collections
+import weakref
+
+# compiled layer output functions. (id(model), layer names) -> (weakref to model, function), least recently used first
+_layer_functions = collections.OrderedDict()
+
+
+@functools.lru_cache(maxsize=256)
+def _get_kept_class_indices(classes, remove):
+    '''
+    Finds the classes that remain after removing each of `remove` in turn, matching each one to the most similar
+    remaining class name
+
+    :param classes: tuple of class names
+    :param remove: tuple of (approximate) class names to remove
+    :return: tuple of indices of the remaining classes
+    '''
+
+    remaining = list(range(len(classes)))
+    for r in remove:
+        # find the exact name of 'remove' within the remaining classes
+        name, confidence = process.extractOne(r, [classes[i] for i in remaining], scorer=fuzz.partial_ratio)
+        if confidence < 85:
+            logging.warning("Failed to remove {}. Seems to not be present in given class list".format(r))
+            # we will return the arguments with nothing removed
+        else:
+            remaining.pop([classes[i] for i in remaining].index(name))
+
+    return tuple(remaining)
 
 
 class ModelUtils:
+    LAYER_FUNCTION_CACHE_SIZE = 16
 
 
     @staticmethod
@@ -25,70 +55,155 @@ class ModelUtils:
         :return:
         '''
 
-        pred, classes = np.array(pred), list(classes)
-
-        for r in remove:
-            # find the exact name of 'remove' within classes list
-            name, confidence = process.extractOne(r, classes, scorer=fuzz.partial_ratio)
-            if confidence < 85:
-                logging.warning("Failed to remove {}. Seems to not be present in given class list".format(r))
-                # we will return the arguments with nothing removed
-            else:
-                # delete
-                idx = classes.index(name)
-                classes.pop(idx)
-                pred = np.delete(pred, idx)
-                # delete element at index in all kwargs values. on the copy
-                for k, v in kwargs.items():
-                    v = v.copy()
-                    v.pop(idx)
-                    kwargs[k] = v
-
-                if redist_conf:
-                    # redistribute
-                    ### METHOD 1: uniformly distribute
-                    # redistribute_amnt = (1 - pred.sum()) / len(pred)
-                    # pred += redistribute_amnt
-                    ### METHOD 2: keep ratios between preds ie [50% (blank), 10%, 40%] ->  [20%, 80%] (still x4)
-                    pred = pred / pred.sum()
+        result = ModelUtils.remove_class_batch(np.array(pred)[np.newaxis], classes, remove=remove,
+                                               redist_conf=redist_conf, **kwargs)
+        return {'pred': result.pop('preds')[0], **result}
+
+
+    @staticmethod
+    def remove_class_batch(preds, classes, remove=['blank', 'marker'], redist_conf=True, **kwargs):
+        '''
+        Same as `remove_class` except for a whole (N, C) matrix of preds at once. The classes to remove are only
+        matched against the class names once for each (classes, remove) combination
+
+        :param preds: (N, C) preds
+        :param classes:
+        :param remove:
+        :param redist_conf:
+        :return: dict with the (N, C - removed) 'preds', the remaining 'classes' and any kwargs with the removed
+        classes' values removed
+        '''
+
+        preds, classes = np.asarray(preds), list(classes)
+        keep = _get_kept_class_indices(tuple(classes), tuple(remove))
+
+        if len(keep) == len(classes):
+            # nothing removed
+            result = {'preds': np.array(preds), 'classes': classes}
+            result.update(kwargs)
+            return result
+
+        keep = list(keep)
+        preds = preds[:, keep]
+        if redist_conf:
+            # keep ratios between preds ie [50% (blank), 10%, 40%] -> [20%, 80%] (still x4)
+            preds = preds / preds.sum(axis=1, keepdims=True)
 
         result = {
-            'pred': pred,
-            'classes': classes
+            'preds': preds,
+            'classes': [classes[i] for i in keep]
         }
-        result.update(kwargs)
+        # remove elements at the removed indices in all kwargs values. on a copy
+        result.update({k: [v[i] for i in keep] for k, v in kwargs.items()})
         return result
 
 
     @staticmethod
-    def get_layer_datas(model, imgs, layers):
+    def get_layer_function(model, layers):
         '''
-        Returns image data after the specified layer
+        Returns a function that maps prepared images to the outputs of the specified layers. Functions are compiled
+        once per model and list of layers and the least recently used ones are dropped once there are more than
+        `LAYER_FUNCTION_CACHE_SIZE`
 
         :param model: keras model
-        :param imgs: list of images
         :param layers: list of string layer names or keras layers within the model
-        :return: list of numpy arrays; each element corresponds to each layer output
+        :return: function
         '''
 
         if len(layers) == 0:
             raise Exception('No layers specified')
 
-        imgs = ModelUtils.prepare_images(imgs)
+        # layer names are unique within a model. the weakref makes sure a new model that got the id of a deleted
+        # model does not get its functions
+        key = (id(model), tuple(l if type(l) == str else l.name for l in layers))
+        if key in _layer_functions:
+            model_ref, get_output = _layer_functions[key]
+            if model_ref() is model:
+                _layer_functions.move_to_end(key)
+                return get_output
+
+        # tensorflow is an optional dependency. only needed once we actually have a keras model
+        import tensorflow.keras.backend as K
 
         layer_outputs = [model.get_layer(l).output if type(l) == str else l.output for l in layers]
         get_output = K.function(model.layers[0].input, layer_outputs)
 
-        return get_output(imgs)
+        _layer_functions[key] = (weakref.ref(model), get_output)
+        while len(_layer_functions) > ModelUtils.LAYER_FUNCTION_CACHE_SIZE:
+            _layer_functions.popitem(last=False)
+
+        return get_output
 
 
     @staticmethod
-    def prepare_images(imgs):
+    def get_layer_datas(model, imgs, layers, dtype=np.float32):
+        '''
+        Returns image data after the specified layer
+
+        :param model: keras model
+        :param imgs: list of images
+        :param layers: list of string layer names or keras layers within the model
+        :param dtype: float dtype the images are prepared in
+        :return: list of numpy arrays; each element corresponds to each layer output
+        '''
+
+        get_output = ModelUtils.get_layer_function(model, layers)
+        return get_output(ModelUtils.prepare_images(imgs, dtype=dtype))
+
+
+    @staticmethod
+    def get_layer_datas_batched(model, batches, layers, dtype=np.float32):
+        '''
+        Same as `get_layer_datas` except images are given batch by batch (ie straight from
+        `TileExtractor.iterate_tiles`) so that all the images never need to be in memory at once
+
+        :param model: keras model
+        :param batches: iterable of image arrays or of dicts with the images under 'tiles'
+        :param layers: list of string layer names or keras layers within the model
+        :param dtype: float dtype the images are prepared in
+        :return: list of numpy arrays; each element corresponds to each layer output
+        '''
+
+        get_output = ModelUtils.get_layer_function(model, layers)
+
+        outputs = [[] for _ in layers]
+        buf = None
+        for batch in batches:
+            imgs = np.asarray(batch['tiles'] if isinstance(batch, dict) else batch)
+
+            # reuse the same prepared image buffer for every batch
+            if buf is None or buf.shape[1:] != imgs.shape[1:] or len(buf) < len(imgs):
+                buf = np.empty(imgs.shape, dtype=dtype)
+
+            for i, out in enumerate(get_output(ModelUtils.prepare_images(imgs, out=buf[:len(imgs)]))):
+                outputs[i].append(np.array(out))
+
+        if len(outputs[0]) == 0:
+            raise Exception('No images given')
+
+        return [np.concatenate(out) for out in outputs]
+
+
+    @staticmethod
+    def prepare_images(imgs, dtype=np.float32, out=None):
         '''
         Returns an array of prepared images for model use
 
+        Images are scaled straight into the float dtype rather than going through float64. To avoid allocating a new
+        array for every batch, pass a preallocated `out` array to be written into (a float batch can also be passed
+        as its own `out` to be prepared in place)
+
         :param img: array of images
+        :param dtype: float32 or float16. ignored if `out` is given
+        :param out: optional float array of the same shape as imgs to write the prepared images into
         :return: array of images
         '''
 
-        return np.divide(imgs, 255)
+        imgs = np.asarray(imgs)
+
+        if out is None:
+            out = np.empty(imgs.shape, dtype=dtype)
+        elif out.shape != imgs.shape:
+            raise Exception('Output shape {} does not match images shape {}'.format(out.shape, imgs.shape))
+
+        return np.divide(imgs, 255, out=out, dtype=out.dtype)
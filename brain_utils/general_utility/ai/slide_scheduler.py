@@ -0,0 +1,584 @@
+import os
+import json
+import time
+import queue
+import pickle
+import ctypes
+import hashlib
+import logging
+import traceback
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from ..slide import Slide
+from ..heatmap import HeatmapGrid
+from .tileextractor import TileExtractor
+from .top_tiles import TopTilesPerClass
+
+# longest error message sent back by a worker. messages are kept small so that they are written to the queue's pipe
+# in one go and a worker dying can never leave half of one behind
+MAX_ERROR_LENGTH = 2000
+
+# set in each worker process. see `_init_worker`
+_worker = {}
+
+
+def _slot_views(tiles_data, coordinates_data, batch_size, tile_size):
+    '''
+    Returns (tiles, coordinates) arrays of every batch slot of the shared buffers
+    '''
+
+    tiles = np.frombuffer(tiles_data, dtype=np.uint8).reshape(-1, batch_size, tile_size, tile_size, 3)
+    coordinates = np.frombuffer(coordinates_data, dtype=np.int64).reshape(-1, batch_size, 4)
+    return list(zip(tiles, coordinates))
+
+
+def _init_worker(messages, free_slots, stop, states, tiles_data, coordinates_data, batch_size, tile_size):
+    '''
+    Keeps what the worker shares with the scheduler: the queue messages are sent on, the queue of free batch slots, the
+    event telling workers to give up, the state of every slide and the shared batch slots
+    '''
+
+    _worker.update(messages=messages, free_slots=free_slots, stop=stop, states=states,
+                   slots=_slot_views(tiles_data, coordinates_data, batch_size, tile_size))
+
+    # anything still unsent when the worker exits is only there because the scheduler stopped listening
+    messages.cancel_join_thread()
+
+
+def _send(message):
+    '''
+    Sends a message to the scheduler
+
+    :return: False if the scheduler has asked the workers to stop
+    '''
+
+    if _worker['stop'].is_set():
+        return False
+    _worker['messages'].put(message)
+    return True
+
+
+def _get_free_slot():
+    '''
+    Waits for a batch slot the scheduler is done with
+
+    :return: slot index, None if the scheduler has asked the workers to stop
+    '''
+
+    while not _worker['stop'].is_set():
+        try:
+            return _worker['free_slots'].get(timeout=0.1)
+        except queue.Empty:
+            pass
+    return None
+
+
+def _send_in_slot(kind, index, obj):
+    '''
+    Sends an object that may be too large for a message through a batch slot
+
+    :return: see `_send`
+    '''
+
+    data = np.frombuffer(pickle.dumps(obj), dtype=np.uint8)
+    slot = _get_free_slot()
+    if slot is None:
+        return False
+
+    buf = _worker['slots'][slot][0].reshape(-1)
+    if len(data) > len(buf):
+        _worker['free_slots'].put(slot)
+        raise Exception('{} bytes is too large to send in a batch slot'.format(len(data)))
+
+    buf[:len(data)] = data
+    return _send((kind, index, slot, len(data)))
+
+
+def _extract_slide(index, path, tile_size, mpp, batch_size, min_non_blank_amt, extractor_kwargs, tile_kwargs):
+    '''
+    Extracts the tiles of a slide in a worker process and hands them to the scheduler batch by batch through the shared
+    batch slots, followed by how long it took. Errors are sent as the slide's result rather than raised so the worker
+    carries on with the next slide
+    '''
+
+    if _worker['stop'].is_set():
+        return
+
+    # set straight in shared memory, unlike messages which could be lost with the worker, so the scheduler knows which
+    # slides a crashed worker was on
+    _worker['states'][index] = SlideScheduler.STATE_BEGUN
+
+    try:
+        start = time.perf_counter()
+        with Slide(path) as slide:
+            tile_extractor = TileExtractor(slide, tile_size=tile_size, desired_tile_mpp=mpp, **extractor_kwargs)
+
+            r = tile_size / tile_extractor.modified_tile_size
+            grid_positions = ([int(x * r) for x in tile_extractor.grid_xs], [int(y * r) for y in tile_extractor.grid_ys])
+            if not _send_in_slot('start', index, grid_positions):
+                return
+
+            # each batch is copied into a slot straight away so it doesn't need to be copied out of the extractor first
+            for res in tile_extractor.iterate_tiles(min_non_blank_amt=min_non_blank_amt, batch_size=batch_size,
+                                                    print_time=False, ring_size=1, **tile_kwargs):
+                slot = _get_free_slot()
+                if slot is None:
+                    return
+
+                n = len(res['tiles'])
+                tiles, coordinates = _worker['slots'][slot]
+                tiles[:n], coordinates[:n] = res['tiles'], res['coordinates']
+                if not _send(('batch', index, slot, n)):
+                    return
+
+        _send(('done', index, {
+            'extraction_seconds': time.perf_counter() - start,
+            'stages': {stage: s['seconds'] for stage, s in tile_extractor.stats.summary().items() if s['count']},
+        }))
+    except Exception:
+        _send(('failed', index, traceback.format_exc()[-MAX_ERROR_LENGTH:]))
+    finally:
+        _worker['states'][index] = SlideScheduler.STATE_FINISHED
+
+
+class SlideScheduler:
+    '''
+    Runs a queue of slides through a model. Tiles of several slides are extracted at once by a pool of worker
+    processes while this process scores the batches as they arrive, so the model is kept busy and every core is used
+
+    Each slide gets a heatmap grid of its tiles' lesion confidences (or per-class preds), its most confident tiles per
+    class and how long it took. Results are saved to the output directory as each slide finishes, along with a
+    manifest of every slide's status so that an interrupted run picks up where it left off. A slide that fails is
+    recorded as failed without affecting the others. If a worker crashes outright, the slides the workers were on are
+    tried again one at a time to find the one that caused it
+
+    Batches are handed over through a fixed number of batch slots in shared memory rather than pickled, so memory stays
+    bounded: workers wait for a free slot once `max_queued_batches` batches are waiting to be scored, and only the
+    heatmaps and top tiles of the slides in progress are kept in memory
+    '''
+
+    MANIFEST_NAME = 'manifest.json'
+    # seconds to wait for a batch before checking that the workers are still alive
+    POLL_SECONDS = 1.0
+    # number of times the worker pool is restarted after crashing before the remaining slides are given up on
+    MAX_POOL_RESTARTS = 10
+
+    # where a worker is with a slide
+    STATE_WAITING, STATE_BEGUN, STATE_FINISHED = 0, 1, 2
+
+
+    def __init__(self, slide_paths, config, model, output_dir, num_workers=None, batch_size=8, min_non_blank_amt=0.0,
+                 top_k=1, per_class_heatmap=False, max_queued_batches=None, dtype=np.float32,
+                 mp_context='spawn', extractor_kwargs=None, tile_kwargs=None):
+        '''
+        Creates a scheduler for the slides. Nothing is processed until `run`
+
+        :param slide_paths: list of slide paths
+        :param config: config of the model (ie `Config_9_Class`). gives the tile size, mpp, classes and non-lesion
+        indices
+        :param model: model with `predict_on_batch`. only used in this process
+        :param output_dir: directory the results and manifest are saved in
+        :param num_workers: number of extraction processes. defaults to one less than the number of cores
+        :param batch_size: get x tiles at once
+        :param min_non_blank_amt: see `TileExtractor.iterate_tiles`
+        :param top_k: number of most confident tiles kept per class
+        :param per_class_heatmap: store every class' preds in the heatmap rather than the lesion confidence. always
+        the case for configs without non-lesion indices
+        :param max_queued_batches: number of shared batch slots, ie the maximum number of extracted batches waiting to
+        be scored. defaults to twice the number of workers
+        :param dtype: float dtype the tiles are prepared in for the model
+        :param mp_context: multiprocessing start method of the workers. 'spawn' avoids forking a process that has a
+        model loaded but needs the calling script to have an `if __name__ == '__main__'` guard
+        :param extractor_kwargs: additional `TileExtractor` options (ie stride, use_pyramid). a tile cache can't be
+        shared between processes
+        :param tile_kwargs: additional `TileExtractor.iterate_tiles` options (ie use_tissue_mask, read_mode)
+        '''
+
+        self.extractor_kwargs = dict(extractor_kwargs or {})
+        self.tile_kwargs = dict(tile_kwargs or {})
+
+        if num_workers is None:
+            num_workers = max(1, (os.cpu_count() or 2) - 1)
+        if num_workers < 1:
+            raise Exception('Need at least 1 worker')
+
+        if max_queued_batches is None:
+            max_queued_batches = 2 * num_workers
+        if max_queued_batches < 1:
+            raise Exception('Must be able to queue at least 1 batch')
+
+        if 'tile_cache' in self.extractor_kwargs:
+            raise Exception('A tile cache cannot be shared between worker processes')
+
+        if 'ring_size' in self.tile_kwargs:
+            raise Exception('Batches are copied into shared batch slots so a ring size cannot be given')
+
+        # the options are sent to the workers. if they can't be, every slide's task fails before it begins
+        try:
+            pickle.dumps((self.extractor_kwargs, self.tile_kwargs))
+        except Exception as e:
+            raise Exception('Extractor and tile options must be picklable to send to the workers: {}'.format(e))
+
+        self.slide_paths = [os.path.abspath(path) for path in slide_paths]
+        if len(set(self.slide_paths)) != len(self.slide_paths):
+            raise Exception('Slide paths must be unique')
+
+        self.config = config
+        self.model = model
+        self.output_dir = output_dir
+        self.num_workers = num_workers
+        self.batch_size = batch_size
+        self.min_non_blank_amt = min_non_blank_amt
+        self.top_k = top_k
+        self.max_queued_batches = max_queued_batches
+        self.dtype = dtype
+        self.mp_context = mp_context
+
+        self.num_classes = len(config.classes)
+        self.non_lesion_indices = getattr(config, 'non_lesion_indices', None)
+        self.per_class_heatmap = per_class_heatmap or self.non_lesion_indices is None
+
+        os.makedirs(output_dir, exist_ok=True)
+        self.manifest_path = os.path.join(output_dir, SlideScheduler.MANIFEST_NAME)
+        self.manifest = self._load_manifest()
+
+        # float buffer tiles are prepared in for the model
+        self._prepared = None
+
+
+    def _load_manifest(self):
+        '''
+        Reads the manifest left by an earlier run, or starts a new one. Every slide has an entry of its name, status
+        ('pending', 'done' or 'failed') and once finished, its result file and timing or error
+        '''
+
+        manifest = {'config': self.config.identity, 'slides': {}}
+        if os.path.exists(self.manifest_path):
+            with open(self.manifest_path) as f:
+                manifest = json.load(f)
+            if manifest['config'] != self.config.identity:
+                raise Exception('{} was made for {}, not {}'.format(
+                    self.manifest_path, manifest['config'], self.config.identity))
+
+        for path in self.slide_paths:
+            manifest['slides'].setdefault(path, {
+                'name': os.path.splitext(os.path.basename(path))[0],
+                'status': 'pending',
+            })
+
+        return manifest
+
+
+    def _save_manifest(self):
+        # written to a temporary file first so a crash never leaves a partial manifest
+        tmp_path = self.manifest_path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(self.manifest, f, indent=2)
+        os.replace(tmp_path, self.manifest_path)
+
+
+    def get_entry(self, path):
+        '''
+        Returns the manifest entry of a slide
+
+        :param path: slide path
+        :return: dict of name, status and once finished, result file and timing or error
+        '''
+
+        return self.manifest['slides'][os.path.abspath(path)]
+
+
+    def get_names(self, status):
+        '''
+        Returns the names of the slides with the given status ('pending', 'done' or 'failed'). Names of failed slides
+        can be passed on to `send_email`
+
+        :param status:
+        :return: list of names
+        '''
+
+        return [self.manifest['slides'][path]['name'] for path in self.slide_paths
+                if self.manifest['slides'][path]['status'] == status]
+
+
+    def run(self, on_result=None, retry_failed=False):
+        '''
+        Processes every slide that isn't done yet
+
+        :param on_result: optional function called with (slide path, result) in this process as each slide finishes.
+        result is a dict of 'name', 'heatmap' (`HeatmapGrid`), 'top_tiles' (`TopTilesPerClass`) and 'timing'. the
+        slide is recorded as failed if it raises
+        :param retry_failed: also process slides that failed in an earlier run
+        :return: dict of the names of the 'done' and 'failed' slides
+        '''
+
+        statuses = ('pending', 'failed') if retry_failed else ('pending',)
+        todo = [i for i, path in enumerate(self.slide_paths) if self.manifest['slides'][path]['status'] in statuses]
+
+        for i in todo:
+            entry = self.manifest['slides'][self.slide_paths[i]]
+            entry['status'] = 'pending'
+            entry.pop('error', None)
+        self._save_manifest()
+
+        logging.info('Processing {}/{} slides with {} workers'.format(len(todo), len(self.slide_paths),
+                                                                      self.num_workers))
+
+        suspects = []
+        restarts = 0
+        while todo or suspects:
+            if suspects:
+                # a worker crashed on one of these. with a single worker, only the slide that crashes it is to blame
+                logging.warning('A worker crashed. Trying {} slides one at a time'.format(len(suspects)))
+                crashed, retry, error = self._run_pool(suspects, on_result, 1)
+                for index in crashed:
+                    self._fail(index, 'Worker crashed while processing the slide')
+                suspects, todo = [], retry + todo
+            else:
+                crashed, todo, error = self._run_pool(todo, on_result, self.num_workers)
+                suspects = crashed
+
+            if error is None:
+                continue
+
+            # the pool broke without any slide to blame (ie a worker couldn't start), so it would again
+            if not crashed:
+                logging.error('Worker pool failed: {}'.format(error))
+                self._fail_all(suspects + todo, 'Worker pool failed: {}'.format(error))
+                break
+
+            restarts += 1
+            if restarts > SlideScheduler.MAX_POOL_RESTARTS:
+                logging.error('Worker pool crashed {} times. Giving up'.format(restarts))
+                self._fail_all(suspects + todo, 'Worker pool crashed too many times: {}'.format(error))
+                break
+
+        return {'done': self.get_names('done'), 'failed': self.get_names('failed')}
+
+
+    def _run_pool(self, indices, on_result, num_workers):
+        '''
+        Processes the slides with a new pool of workers until they are all finished or a worker crashes
+
+        :return: (indices of the slides the workers were on when one crashed, indices of the slides to try again, the
+        pool's error if it crashed else None)
+        '''
+
+        ctx = multiprocessing.get_context(self.mp_context)
+        messages = ctx.Queue()
+        free_slots = ctx.Queue()
+        stop = ctx.Event()
+        states = ctx.Array('b', len(self.slide_paths), lock=False)
+
+        # shared batch slots. made for every pool since a crashed worker may have been holding some
+        tile_size = self.config.tile_size
+        tiles_data = ctx.RawArray(ctypes.c_uint8, self.max_queued_batches * self.batch_size * tile_size * tile_size * 3)
+        coordinates_data = ctx.RawArray(ctypes.c_int64, self.max_queued_batches * self.batch_size * 4)
+        slots = _slot_views(tiles_data, coordinates_data, self.batch_size, tile_size)
+        for slot in range(len(slots)):
+            free_slots.put(slot)
+
+        # index -> heatmap, top tiles and timing of each slide whose tiles are arriving
+        in_progress = {}
+        unfinished = set(indices)
+        error = None
+
+        executor = ProcessPoolExecutor(
+            max_workers=min(num_workers, len(indices)), mp_context=ctx, initializer=_init_worker,
+            initargs=(messages, free_slots, stop, states, tiles_data, coordinates_data, self.batch_size, tile_size))
+        try:
+            worker_args = (tile_size, self.config.mpp, self.batch_size, self.min_non_blank_amt, self.extractor_kwargs,
+                           self.tile_kwargs)
+            futures = [executor.submit(_extract_slide, i, self.slide_paths[i], *worker_args) for i in indices]
+
+            while unfinished:
+                try:
+                    message = messages.get(timeout=SlideScheduler.POLL_SECONDS)
+                except queue.Empty:
+                    # workers catch their own errors so a failed future means the pool broke
+                    failed = [future for future in futures if future.done() and future.exception() is not None]
+                    if failed:
+                        exc = failed[0].exception()
+                        error = '{}: {}'.format(type(exc).__name__, exc)
+                        break
+                    continue
+
+                kind, index = message[:2]
+                try:
+                    # batches of a slide that already failed here are dropped
+                    if index in unfinished:
+                        if kind in ('start', 'batch'):
+                            slot, n = message[2:]
+                            self._handle(kind, index, slots[slot], n, in_progress, unfinished, on_result)
+                        else:
+                            self._handle(kind, index, message[2], None, in_progress, unfinished, on_result)
+
+                        if index not in unfinished:
+                            in_progress.pop(index, None)
+                finally:
+                    if kind in ('start', 'batch'):
+                        free_slots.put(message[2])
+        finally:
+            stop.set()
+            executor.shutdown(wait=True)
+
+        if error is None:
+            return [], [], None
+
+        # slides the workers were still on may have caused the crash. the others either never started or finished
+        # with their results lost along with the worker
+        suspects = [i for i in indices if i in unfinished and states[i] == SlideScheduler.STATE_BEGUN]
+        return suspects, [i for i in indices if i in unfinished and i not in suspects], error
+
+
+    def _handle(self, kind, index, payload, n, in_progress, unfinished, on_result):
+        '''
+        Acts on a message from a worker about a slide
+
+        :param payload: the message's payload, or the (tiles, coordinates) of the batch slot it came in
+        :param n: number of tiles (or bytes) in the batch slot
+        '''
+
+        from .model_utils import ModelUtils
+
+        path = self.slide_paths[index]
+
+        if kind == 'start':
+            xs, ys = pickle.loads(payload[0].reshape(-1)[:n].tobytes())
+            in_progress[index] = {
+                'start': time.perf_counter(),
+                'heatmap': HeatmapGrid.from_grid_positions(
+                    xs, ys, self.config.tile_size, num_classes=self.num_classes if self.per_class_heatmap else None),
+                'top_tiles': TopTilesPerClass(self.num_classes, k=self.top_k),
+                'tiles': 0,
+                'inference_seconds': 0.0,
+            }
+
+        elif kind == 'batch':
+            progress = in_progress[index]
+            tiles, coordinates = payload[0][:n], payload[1][:n]
+
+            try:
+                start = time.perf_counter()
+                buf = self._prepared
+                if buf is None or buf.shape[1:] != tiles.shape[1:] or len(buf) < len(tiles):
+                    buf = self._prepared = np.empty(tiles.shape, dtype=self.dtype)
+                prepared = ModelUtils.prepare_images(tiles, out=buf[:len(tiles)])
+                preds, lesion_confs = TileExtractor._predict(self.model, prepared, self.non_lesion_indices)
+                progress['inference_seconds'] += time.perf_counter() - start
+
+                progress['heatmap'].add(coordinates, preds if self.per_class_heatmap else lesion_confs)
+                progress['top_tiles'].add(tiles, coordinates, preds)
+                progress['tiles'] += len(tiles)
+            except Exception:
+                self._fail(index, traceback.format_exc())
+                unfinished.discard(index)
+
+        elif kind == 'done':
+            progress = in_progress.pop(index)
+            timing = dict(payload, seconds=time.perf_counter() - progress['start'], tiles=progress['tiles'],
+                          inference_seconds=progress['inference_seconds'])
+
+            try:
+                result_file = self._save_result(path, progress)
+                if on_result is not None:
+                    on_result(path, {
+                        'name': self.manifest['slides'][path]['name'],
+                        'heatmap': progress['heatmap'],
+                        'top_tiles': progress['top_tiles'],
+                        'timing': timing,
+                    })
+            except Exception:
+                self._fail(index, traceback.format_exc())
+                unfinished.discard(index)
+                return
+
+            self.manifest['slides'][path].update(status='done', result=result_file, timing=timing)
+            self._save_manifest()
+            unfinished.discard(index)
+
+            logging.info('Finished {} ({} tiles) in {:0.1f}s. {} slides left'.format(
+                self.manifest['slides'][path]['name'], progress['tiles'], timing['seconds'], len(unfinished)))
+
+        elif kind == 'failed':
+            self._fail(index, payload)
+            unfinished.discard(index)
+
+
+    def _fail(self, index, error):
+        path = self.slide_paths[index]
+        logging.error('Failed to process {}: {}'.format(path, error))
+
+        self.manifest['slides'][path].update(status='failed', error=error)
+        self._save_manifest()
+
+
+    def _fail_all(self, indices, error):
+        for index in indices:
+            path = self.slide_paths[index]
+            self.manifest['slides'][path].update(status='failed', error=error)
+        self._save_manifest()
+
+
+    def _save_result(self, path, progress):
+        '''
+        Saves a slide's heatmap and top tiles to the output directory
+
+        :return: name of the result file
+        '''
+
+        heatmap, top_tiles = progress['heatmap'], progress['top_tiles']
+
+        arrays = {'grid': heatmap.grid, 'filled': heatmap.filled, 'tile_size': heatmap.tile_size, 'top_k': self.top_k}
+        if heatmap.xs is not None:
+            arrays.update(xs=heatmap.xs, ys=heatmap.ys)
+        if len(top_tiles):
+            arrays['top_tiles'], arrays['top_coordinates'], arrays['top_confs'] = top_tiles.get_tiles()
+
+        # named by the slide's full path as well since slides in different folders can share a name
+        result_file = '{}_{}.npz'.format(self.manifest['slides'][path]['name'],
+                                         hashlib.sha1(path.encode()).hexdigest()[:8])
+        result_path = os.path.join(self.output_dir, result_file)
+
+        tmp_path = result_path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            np.savez(f, **arrays)
+        os.replace(tmp_path, result_path)
+
+        return result_file
+
+
+    def load_result(self, path):
+        '''
+        Loads the saved results of a finished slide
+
+        :param path: slide path
+        :return: dict of 'name', 'heatmap' (`HeatmapGrid`), 'top_tiles' (`TopTilesPerClass`, None if no tiles were
+        kept) and 'timing'
+        '''
+
+        entry = self.get_entry(path)
+        if entry['status'] != 'done':
+            raise Exception('{} has not been processed'.format(path))
+
+        with np.load(os.path.join(self.output_dir, entry['result'])) as data:
+            grid = data['grid']
+            tile_size = int(data['tile_size'])
+            rows, cols = grid.shape[:2]
+
+            heatmap = HeatmapGrid(rows * tile_size, cols * tile_size, tile_size,
+                                  num_classes=grid.shape[2] if grid.ndim == 3 else None, dtype=grid.dtype.type)
+            heatmap.grid, heatmap.filled = grid, data['filled']
+            if 'xs' in data:
+                heatmap.xs, heatmap.ys = data['xs'], data['ys']
+
+            top_tiles = None
+            if 'top_tiles' in data:
+                # re-adding the kept tiles keeps the same ones since they include every class' best
+                top_tiles = TopTilesPerClass(data['top_confs'].shape[1], k=int(data['top_k']))
+                top_tiles.add(data['top_tiles'], data['top_coordinates'], data['top_confs'])
+
+        return {'name': entry['name'], 'heatmap': heatmap, 'top_tiles': top_tiles, 'timing': entry['timing']}
@@ -0,0 +1,204 @@
+import os
+import hashlib
+import collections
+import numpy as np
+
+
+class TileCache:
+    '''
+    On-disk cache of extracted tiles so that running several models over the same slides only decodes and resizes
+    each tile once
+
+    Tiles are stored as raw uint8 blocks in fixed size slots of a memory mapped file. An index keeps, for every tile
+    seen, its slot and how blank it is. Blank tiles only need their blank amount so they don't take up a slot. Least
+    recently used tiles are evicted once the cache is full
+
+    A cache directory should only be used by one process at a time
+    '''
+
+    DEFAULT_MAX_BYTES = 10 * 1024 ** 3
+    # tiles without a slot (blank ones) that can be indexed per slot
+    ENTRIES_PER_SLOT = 4
+
+    INDEX_DTYPE = np.dtype([('key', 'S40'), ('slot', '<i8'), ('blank', '<f8')])
+
+
+    def __init__(self, directory, tile_size, max_bytes=DEFAULT_MAX_BYTES):
+        '''
+        Opens (or creates) the cache for tiles of the given size in the directory
+
+        :param directory:
+        :param tile_size: size of the cached tiles, ie the tile size tiles are extracted at
+        :param max_bytes: maximum size of the cached tile data on disk
+        '''
+
+        self.directory = directory
+        self.tile_size = tile_size
+
+        slot_bytes = tile_size * tile_size * 3
+        self.capacity = max(1, int(max_bytes // slot_bytes))
+
+        os.makedirs(directory, exist_ok=True)
+        tiles_path = os.path.join(directory, 'tiles_{}.npy'.format(tile_size))
+        slot_keys_path = os.path.join(directory, 'slot_keys_{}.npy'.format(tile_size))
+        self.index_path = os.path.join(directory, 'index_{}.npy'.format(tile_size))
+
+        tiles_shape = (self.capacity, tile_size, tile_size, 3)
+
+        # key -> [slot, blank amount] in least to most recently used order. slot is -1 if the pixels aren't stored
+        self._index = collections.OrderedDict()
+
+        try:
+            self._tiles = np.lib.format.open_memmap(tiles_path, mode='r+')
+            self._slot_keys = np.lib.format.open_memmap(slot_keys_path, mode='r+')
+            if self._tiles.shape != tiles_shape or self._slot_keys.shape != (self.capacity,):
+                raise Exception('Cache size changed')
+
+            for key, slot, blank in np.load(self.index_path):
+                self._index[bytes(key)] = [int(slot), float(blank)]
+        except Exception:
+            # missing, resized or corrupt. start over. the tile file is sparse so only filled slots use disk space
+            self._tiles = np.lib.format.open_memmap(tiles_path, mode='w+', dtype=np.uint8, shape=tiles_shape)
+            self._slot_keys = np.lib.format.open_memmap(slot_keys_path, mode='w+', dtype='S40',
+                                                        shape=(self.capacity,))
+            self._index.clear()
+
+        used = {slot for slot, _ in self._index.values() if slot >= 0}
+        self._free_slots = [slot for slot in range(self.capacity - 1, -1, -1) if slot not in used]
+
+
+    @staticmethod
+    def slide_key(slide):
+        '''
+        Identifies the slide's file by its path, modification time and size so that a changed file is never served
+        from the cache
+
+        :param slide: slide object
+        :return: string
+        '''
+
+        stat = os.stat(slide.path)
+        return '{}|{}|{}'.format(os.path.abspath(slide.path), stat.st_mtime_ns, stat.st_size)
+
+
+    @staticmethod
+    def make_key(slide_key, x, y, tile_size, out_tile_size, mpp, level=0, read_mode='tile', edge_mode='drop'):
+        '''
+        Content address of a tile
+
+        :param slide_key: see `slide_key`
+        :param x: top left of the tile in the slide
+        :param y:
+        :param tile_size: size of the region of the slide the tile covers
+        :param out_tile_size: size the tile is resized to
+        :param mpp: target mpp of the tile
+        :param level: pyramid level the tile is read from
+        :param read_mode: how the tile was read, see `TileExtractor.iterate_tiles`. strips are resized a row at a time
+        so their tiles can differ slightly from tiles resized on their own
+        :param edge_mode: how the tile extractor handles the edges of the slide
+        :return: 40 byte key
+        '''
+
+        key = '|'.join(str(v) for v in (slide_key, x, y, tile_size, out_tile_size, mpp, level, read_mode, edge_mode))
+        return hashlib.sha1(key.encode()).hexdigest().encode()
+
+
+    def get(self, key, max_blank_amt):
+        '''
+        Looks up a tile
+
+        :param key: see `make_key`
+        :param max_blank_amt: tiles with more than this percentage of blank pixels are too blank to be returned
+        :return: None if the tile has to be extracted, otherwise (tile or None if it is too blank, blank amount)
+        '''
+
+        entry = self._index.get(key)
+        if entry is None:
+            return None
+
+        slot, blank = entry
+        if blank > max_blank_amt:
+            self._index.move_to_end(key)
+            return None, blank
+
+        # pixels weren't kept when the tile was too blank for the run that cached it. the slot key guards against a
+        # slot reused after the index was last saved
+        if slot < 0 or self._slot_keys[slot] != key:
+            return None
+
+        self._index.move_to_end(key)
+        return np.array(self._tiles[slot]), blank
+
+
+    def put(self, key, tile, blank):
+        '''
+        Stores a tile
+
+        :param key: see `make_key`
+        :param tile: BGR uint8 tile, or None to only store the blank amount
+        :param blank: percentage of blank pixels in the tile
+        :return:
+        '''
+
+        entry = self._index.pop(key, None)
+        slot = -1 if entry is None else entry[0]
+
+        if tile is not None and (slot < 0 or self._slot_keys[slot] != key):
+            if tile.shape != self._tiles.shape[1:]:
+                raise Exception('Tile cache only holds {0}x{0} tiles'.format(self.tile_size))
+
+            while not self._free_slots:
+                self._evict()
+            slot = self._free_slots.pop()
+
+            self._tiles[slot] = tile
+            self._slot_keys[slot] = key
+
+        self._index[key] = [slot, blank]
+
+        while len(self._index) > self.capacity * TileCache.ENTRIES_PER_SLOT:
+            self._evict()
+
+
+    def _evict(self):
+        # least recently used
+        _, (slot, _) = self._index.popitem(last=False)
+        if slot >= 0:
+            self._slot_keys[slot] = b''
+            self._free_slots.append(slot)
+
+
+    def __len__(self):
+        return len(self._index)
+
+
+    def flush(self):
+        '''
+        Saves the index and tile data so the next run can use them
+        '''
+
+        self._tiles.flush()
+        self._slot_keys.flush()
+
+        index = np.empty(len(self._index), dtype=TileCache.INDEX_DTYPE)
+        for i, (key, (slot, blank)) in enumerate(self._index.items()):
+            index[i] = (key, slot, blank)
+
+        # written to a temporary file first so a crash never leaves a partial index
+        tmp_path = self.index_path + '.tmp.npy'
+        np.save(tmp_path, index)
+        os.replace(tmp_path, self.index_path)
+
+
+    def close(self):
+        self.flush()
+        self._tiles = None
+        self._slot_keys = None
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
@@ -2,12 +2,290 @@ import numpy as np
 import cv2
 import time
 import logging
+import threading
+import collections
+import itertools
+import queue
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, Future
 
-class TileExtractor:
-    DEFAULT_MIN_NON_BLANK_AMT = 0.1
+from PIL import Image
+
+# each worker thread (or process) keeps its own slide readers. a reader cannot be shared between workers
+_worker_local = threading.local()
+
+
+def _get_worker_reader(reader_cls, path):
+    '''
+    Returns the calling worker's own reader for the slide at path, opening it on first use
+
+    :param reader_cls: SlideReader subclass
+    :param path: slide path
+    :return: slide reader
+    '''
+
+    readers = getattr(_worker_local, 'readers', None)
+    if readers is None:
+        readers = _worker_local.readers = {}
+
+    if (reader_cls, path) not in readers:
+        readers[(reader_cls, path)] = reader_cls(path)
+
+    return readers[(reader_cls, path)]
+
+
+def _extract_tile(reader, x, y, tile_size, out_tile_size, max_blank_amt, level=0, downsample=1, out=None):
+    '''
+    Reads the tile with top left (x, y) from the slide, converts it to BGR and resizes it to the output tile size
+
+    :param reader: slide reader
+    :param x:
+    :param y:
+    :param tile_size: size of the full resolution region the tile covers
+    :param out_tile_size: size of the returned tile
+    :param max_blank_amt: tiles with more than this percentage of blank pixels are discarded
+    :param level: pyramid level to read the region from
+    :param downsample: downsample of the pyramid level
+    :param out: optional (out_tile_size, out_tile_size, 3) array to write the tile into
+    :return: (tile, coordinate, blank amount, (read, resize, blank check) seconds). tile is None if it is too blank
+    '''
+
+    start = time.perf_counter()
+    region = _read_region(reader, _level_box(x, y, tile_size, level, downsample), level)
+    return _finish_tile(region, x, y, tile_size, out_tile_size, max_blank_amt, time.perf_counter() - start, out)
+
+
+def _level_box(x, y, tile_size, level, downsample):
+    '''
+    Returns the box in the pyramid level's coordinates of the tile with top left (x, y)
+    '''
+
+    box = (x, y, x + tile_size, y + tile_size)
+    if level:
+        box = tuple(int(round(c / downsample)) for c in box)
+    return box
+
+
+def _read_region(reader, box, level):
+    '''
+    Reads a region of the slide. Areas past the edges of the slide are white, like the slide's background
+    '''
+
+    region = reader.read_region(box, level=level)
+
+    w, h = reader.level_dimensions[level]
+    x1, y1, x2, y2 = box
+    if x1 < 0 or y1 < 0 or x2 > w or y2 > h:
+        region[:max(0, -y1)] = 255
+        region[max(0, h - y1):] = 255
+        region[:, :max(0, -x1)] = 255
+        region[:, max(0, w - x1):] = 255
+
+    return region
+
+
+def _finish_tile(region, x, y, tile_size, out_tile_size, max_blank_amt, read_seconds, out=None):
+    '''
+    Converts the RGB region read for the tile with top left (x, y) to a BGR tile of the output tile size and checks
+    how blank it is. See `_extract_tile`
+    '''
+
+    t1 = time.perf_counter()
+    resize = region.shape[0] != out_tile_size or region.shape[1] != out_tile_size
+
+    if out is not None:
+        # straight into the given array without any intermediate tile
+        if resize:
+            tile = cv2.cvtColor(cv2.resize(region, (out_tile_size, out_tile_size), dst=out), cv2.COLOR_RGB2BGR, dst=out)
+        else:
+            tile = cv2.cvtColor(region, cv2.COLOR_RGB2BGR, dst=out)
+    else:
+        tile = region[:, :, ::-1]
+
+        # only what is left of the downsampling after reading from the level
+        if resize:
+            tile = cv2.resize(tile, (out_tile_size, out_tile_size))
+
+    return _check_tile(tile, x, y, tile_size, out_tile_size, max_blank_amt, read_seconds, time.perf_counter() - t1)
+
+
+def _check_tile(tile, x, y, tile_size, out_tile_size, max_blank_amt, read_seconds, resize_seconds):
+    '''
+    Checks how blank the finished BGR tile with top left (x, y) is. See `_extract_tile`
+    '''
+
+    start = time.perf_counter()
+    blank = TileExtractor.amount_blank_fast(tile)
+
+    return ((tile if blank <= max_blank_amt else None), _tile_coordinate(x, y, tile_size, out_tile_size), blank,
+            (read_seconds, resize_seconds, time.perf_counter() - start))
+
+
+def _tile_coordinate(x, y, tile_size, out_tile_size):
+    '''
+    Returns the coordinate of the tile with top left (x, y) once tiles are resized to the output tile size
+    '''
+
+    r = out_tile_size / tile_size
+    return int(x * r), int(y * r), int((x + tile_size) * r), int((y + tile_size) * r)
+
+
+def _extract_tile_worker(reader_cls, path, *args):
+    return _extract_tile(_get_worker_reader(reader_cls, path), *args)
+
+
+# marks the end of a generator run in the background
+_END = object()
+
+
+def _iterate_in_background(gen, queue_depth):
+    '''
+    Runs a generator on a background thread which keeps up to `queue_depth` items ready ahead of the consumer.
+    Items come out in the same order and anything raised by the generator is raised again in the consumer
+
+    :param gen: generator
+    :param queue_depth: maximum number of items waiting to be consumed
+    :return: generator
+    '''
+
+    # (item, exception) pairs. the end of the generator is marked with _END
+    q = queue.Queue(maxsize=queue_depth)
+    stop = threading.Event()
+
+    def put(item):
+        # give up if the consumer has gone away rather than blocking on a full queue forever
+        while not stop.is_set():
+            try:
+                q.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def produce():
+        try:
+            for item in gen:
+                if not put((item, None)):
+                    return
+            put((_END, None))
+        except BaseException as e:
+            put((_END, e))
+        finally:
+            gen.close()
+
+    thread = threading.Thread(target=produce, daemon=True)
+    thread.start()
+
+    try:
+        while True:
+            item, e = q.get()
+            if item is _END:
+                if e is not None:
+                    raise e
+                return
+            yield item
+    finally:
+        stop.set()
+        thread.join()
+
+
+class TileExtractorStats:
+    '''
+    Running count and total time of each stage of tile extraction and scoring:
+
+    'read' (crop/decode), 'resize', 'blank' (blank check), 'cache' (tiles read from the tile cache), 'batch' (batch
+    assembly), 'prepare' (preprocessing for the model) and 'inference'
+
+    Stages can be recorded from any thread. Times of tiles extracted by workers (threads or processes) are measured in
+    the worker and recorded once the tile is handed back
+    '''
+
+    STAGES = ('read', 'resize', 'blank', 'cache', 'batch', 'prepare', 'inference')
+
+
+    def __init__(self, callback=None):
+        '''
+        :param callback: optional function called with (stage, seconds, count) every time a stage is recorded. called
+        from whichever thread records the stage
+        '''
 
+        self.callback = callback
+        self._lock = threading.Lock()
+        self.reset()
 
-    def __init__(self, slide, tile_size=1024, desired_tile_mpp=0.5040):
+
+    def reset(self):
+        with self._lock:
+            self.counts = dict.fromkeys(TileExtractorStats.STAGES, 0)
+            self.seconds = dict.fromkeys(TileExtractorStats.STAGES, 0.0)
+
+
+    def add(self, stage, seconds, count=1):
+        '''
+        Records `count` items going through a stage in `seconds`
+        '''
+
+        with self._lock:
+            self.counts[stage] += count
+            self.seconds[stage] += seconds
+
+        if self.callback is not None:
+            self.callback(stage, seconds, count)
+
+
+    def timer(self, stage, count=1):
+        '''
+        Context manager that records the time spent within it for a stage
+        '''
+
+        return _StageTimer(self, stage, count)
+
+
+    def summary(self):
+        '''
+        :return: dict of stage -> {'count', 'seconds', 'ms_per_item'}
+        '''
+
+        with self._lock:
+            return {stage: {
+                'count': self.counts[stage],
+                'seconds': self.seconds[stage],
+                'ms_per_item': self.seconds[stage] / self.counts[stage] * 1000 if self.counts[stage] else None,
+            } for stage in TileExtractorStats.STAGES}
+
+
+    def __str__(self):
+        return ', '.join('{} {} in {:0.3f}s'.format(stage, s['count'], s['seconds'])
+                         for stage, s in self.summary().items() if s['count'])
+
+
+class _StageTimer:
+
+    def __init__(self, stats, stage, count):
+        self.stats, self.stage, self.count = stats, stage, count
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.stats.add(self.stage, time.perf_counter() - self.start, self.count)
+
+
+class TileExtractor:
+    DEFAULT_MIN_NON_BLANK_AMT = 0.1
+    WORKER_TYPES = ('thread', 'process')
+    # pixels per tile side in the downsampled tissue mask
+    DEFAULT_TISSUE_MASK_CELL_SIZE = 8
+    # slack given to the tissue mask's non-blank estimate before skipping a tile without cropping it
+    DEFAULT_TISSUE_MASK_MARGIN = 0.1
+    # what to do with the right and bottom remainder of the slide that doesn't fit a whole tile
+    EDGE_MODES = ('drop', 'pad', 'shift')
+    # read each tile on its own, or each row of tiles as one strip
+    READ_MODES = ('tile', 'strip')
+
+
+    def __init__(self, slide, tile_size=1024, desired_tile_mpp=0.5040, use_pyramid=True, tile_cache=None,
+                 stats_callback=None, stride=None, edge_mode='drop'):
         '''
         Creates a tile extractor object for the given slide
 
@@ -19,12 +297,33 @@ class TileExtractor:
             if slide MPP is smaller (larger magnification), takes a larger tile size and resizes the tile down
             if slide MPP is larger (smaller magnification), takes a smaller tile size and resizes the tile up
 
+        When resizing down, tiles are read from the smallest pyramid level (or reduced resolution decode) of the slide
+        that is still at least as detailed as the desired MPP, so that only the rest of the downsampling is left to do
+
         :param slide: slide object
         :param tile_size:
         :param desired_tile_mpp: the mpp of tiles that the tile extractor returns
+        :param use_pyramid: read tiles from the pyramid level best suited for the desired MPP
+        :param tile_cache: optional `TileCache` that extracted tiles are kept in and read back from on later runs
+        :param stats_callback: optional function called with (stage, seconds, count) as tiles go through each stage.
+        see `TileExtractorStats`
+        :param stride: distance between neighbouring tiles, in pixels of the returned tiles. smaller than the tile size
+        for overlapping tiles. defaults to the tile size
+        :param edge_mode: what to do with the right and bottom remainder of the slide that doesn't fit a whole tile.
+        'drop' it, 'pad' tiles past the edge of the slide with white or 'shift' the last tile back to fit the slide
         '''
 
+        if edge_mode not in TileExtractor.EDGE_MODES:
+            raise Exception('Edge mode must be one of {}'.format(TileExtractor.EDGE_MODES))
+
+        if stride is not None and stride < 1:
+            raise Exception('Stride must be at least 1')
+
+        if tile_cache is not None and tile_cache.tile_size != tile_size:
+            raise Exception('Tile cache holds {} sized tiles, not {}'.format(tile_cache.tile_size, tile_size))
+
         self.slide = slide
+        self.tile_cache = tile_cache
         self.original_tile_size = tile_size
         self.desired_tile_mpp = desired_tile_mpp
 
@@ -34,11 +333,33 @@ class TileExtractor:
         self.tile_size_resize_factor = factor
         self.modified_tile_size = modified_tile_size
 
+        # pyramid level tiles are read from
+        self.level, self.level_downsample = 0, 1
+        if use_pyramid and factor > 1:
+            self.level = slide.reader.get_best_level_for_downsample(factor)
+            self.level_downsample = slide.reader.level_downsamples[self.level]
+        logging.info('Reading tiles from level {} (downsample {:0.3f}) of {}'.format(
+            self.level, self.level_downsample, slide.name))
+
         # 'Crop' leftover from right and bottom
         self.trimmed_width = slide.width - (slide.width % modified_tile_size)
         self.trimmed_height = slide.height - (slide.height % modified_tile_size)
         self.chn = 3
 
+        # tile grid. stride is in returned tile pixels, modified stride in slide pixels
+        self.stride = tile_size if stride is None else stride
+        self.modified_stride = modified_tile_size if self.stride == tile_size else max(1, int(self.stride * factor))
+        self.edge_mode = edge_mode
+        # top left x/y of every column/row of tiles in the slide
+        self.grid_xs = TileExtractor._grid_positions(slide.width, modified_tile_size, self.modified_stride, edge_mode)
+        self.grid_ys = TileExtractor._grid_positions(slide.height, modified_tile_size, self.modified_stride, edge_mode)
+
+        # (cell size, mask) of the last computed tissue mask
+        self._tissue_mask = None
+
+        # time spent in each stage, over every iteration of this tile extractor
+        self.stats = TileExtractorStats(callback=stats_callback)
+
 
     @staticmethod
     def amount_blank(tile):
@@ -54,14 +375,363 @@ class TileExtractor:
         return np.sum(np.std(tile, axis=2) < 4) / (tile.shape[0] * tile.shape[1])
 
 
-    def iterate_tiles(self, min_non_blank_amt=0.0, batch_size=4, print_time=True):
+    @staticmethod
+    def amount_blank_fast(tiles, stride=1):
+        '''
+        Same as `amount_blank` but computed with small integers and reusable buffers instead of float64 temporaries.
+        Works on a single tile or a whole batch of tiles
+
+        A pixel's std dev across its 3 channels is below 4 exactly when (b-g)^2 + (g-r)^2 + (b-r)^2 < 144, since that
+        sum is 9 times the variance. Any channel difference of 12+ already makes the pixel non-blank, so differences
+        are clipped to 12 which keeps the sum within int16
+
+        :param tiles: BGR numpy array of shape (H, W, 3) or batch of shape (N, H, W, 3)
+        :param stride: only look at every `stride`th pixel in each direction. >1 gives an approximate result
+        :return: percentage for a single tile, array of percentages for a batch
+        '''
+
+        if stride < 1:
+            raise Exception('Stride must be at least 1')
+
+        single = tiles.ndim == 3
+        if single:
+            tiles = tiles[np.newaxis]
+
+        tiles = tiles[:, ::stride, ::stride, :]
+        n, h, w = tiles.shape[:3]
+
+        # scratch buffers reused for every tile
+        acc = np.empty((h, w), dtype=np.int16)
+        diff = np.empty((h, w), dtype=np.int16)
+        blank = np.empty((h, w), dtype=bool)
+
+        res = np.empty(n)
+        for i in range(n):
+            tile = tiles[i]
+            acc.fill(0)
+            for c1, c2 in ((0, 1), (1, 2), (0, 2)):
+                np.subtract(tile[:, :, c1], tile[:, :, c2], out=diff, dtype=np.int16)
+                np.abs(diff, out=diff)
+                np.minimum(diff, 12, out=diff)
+                np.multiply(diff, diff, out=diff)
+                acc += diff
+            np.less(acc, 144, out=blank)
+            res[i] = np.count_nonzero(blank) / (h * w)
+
+        return res[0] if single else res
+
+
+    def get_tissue_mask(self, cell_size=DEFAULT_TISSUE_MASK_CELL_SIZE):
+        '''
+        Returns an estimate of how much of each tile in the grid is non-blank, using the same std dev criteria as
+        `amount_blank` on a downsampled copy of the slide. The mask is only computed once per cell size
+
+        :param cell_size: each tile is represented by cell_size x cell_size pixels of the downsampled slide
+        :return: (rows, cols) array of non-blank percentages
+        '''
+
+        if self._tissue_mask is not None and self._tissue_mask[0] == cell_size:
+            return self._tissue_mask[1]
+
+        if cell_size < 1:
+            raise Exception('Tissue mask cell size must be at least 1')
+
+        cols = self.trimmed_width // self.modified_tile_size
+        rows = self.trimmed_height // self.modified_tile_size
+
+        if rows == 0 or cols == 0:
+            mask = np.zeros((rows, cols))
+        else:
+            # sample pixels rather than averaging them so the blank percentage of the samples estimates the tile's
+            thumb = self.slide.reader.get_thumbnail((cols * cell_size, rows * cell_size), resample=Image.NEAREST,
+                                                    box=(0, 0, self.trimmed_width, self.trimmed_height))
+            cells = thumb.reshape(rows, cell_size, cols, cell_size, 3).swapaxes(1, 2).reshape(-1, cell_size, cell_size, 3)
+            mask = 1 - TileExtractor.amount_blank_fast(cells).reshape(rows, cols)
+
+        self._tissue_mask = (cell_size, mask)
+        return mask
+
+
+    @staticmethod
+    def _grid_positions(length, tile_size, stride, edge_mode):
+        '''
+        Returns where tiles start along one side of the slide
+
+        :param length: length of the side
+        :param tile_size:
+        :param stride:
+        :param edge_mode: see __init__
+        :return: list of positions
+        '''
+
+        positions = list(range(0, length - tile_size + 1, stride))
+
+        if edge_mode == 'pad':
+            # keep going until the last tile reaches the end
+            while (positions[-1] + tile_size if positions else 0) < length:
+                positions.append(positions[-1] + stride if positions else 0)
+        elif edge_mode == 'shift' and positions and positions[-1] + tile_size < length:
+            positions.append(length - tile_size)
+
+        return positions
+
+
+    def _iterate_positions(self, min_non_blank_amt=0.0, use_tissue_mask=False,
+                           tissue_mask_cell_size=DEFAULT_TISSUE_MASK_CELL_SIZE,
+                           tissue_mask_margin=DEFAULT_TISSUE_MASK_MARGIN):
+        '''
+        Iterates over the top left coordinates of every tile within the slide, row by row.
+        If using the tissue mask, tiles whose estimated non-blank amount is clearly too low are skipped
+        '''
+
+        tile_size = self.modified_tile_size
+
+        candidates = None
+        if use_tissue_mask:
+            mask = self.get_tissue_mask(tissue_mask_cell_size)
+            if mask.size:
+                # a tile that isn't on the non-overlapping grid the mask is made for takes the best of the (at most
+                # two each way) cells it touches
+                rows, cols = mask.shape
+                ys = np.array(self.grid_ys, dtype=np.int64)
+                xs = np.array(self.grid_xs, dtype=np.int64)
+                r1, r2 = np.minimum(ys // tile_size, rows - 1), np.minimum((ys + tile_size - 1) // tile_size, rows - 1)
+                c1, c2 = np.minimum(xs // tile_size, cols - 1), np.minimum((xs + tile_size - 1) // tile_size, cols - 1)
+                estimates = np.maximum.reduce([mask[np.ix_(r, c)] for r in (r1, r2) for c in (c1, c2)])
+
+                # the mask doesn't cover the remainder past the trimmed area so tiles reaching into it are always kept
+                estimates[ys + tile_size > rows * tile_size] = 1
+                estimates[:, xs + tile_size > cols * tile_size] = 1
+                candidates = estimates >= (min_non_blank_amt - tissue_mask_margin)
+                logging.debug('Tissue mask kept {}/{} tiles'.format(np.sum(candidates), candidates.size))
+
+        for i, y in enumerate(self.grid_ys):
+            for j, x in enumerate(self.grid_xs):
+                if candidates is None or candidates[i, j]:
+                    yield x, y
+
+
+    def _iterate_extracted(self, positions, max_blank_amt, num_workers, worker_type, prefetch, read_mode='tile',
+                           next_slot=None):
+        '''
+        Extracts every tile at the given positions in order, either in this thread or spread over a pool of workers
+
+        Tiles in the tile cache are read from it rather than extracted, and extracted tiles are added to it
+
+        :param next_slot: optional function returning the array the next tile is wanted in. tiles read one at a time in
+        this thread are written straight into it
+
+        :return: generator of (y, result) where result is what `_extract_tile` returns for the tile
+        '''
+
+        args = (self.modified_tile_size, self.original_tile_size, max_blank_amt, self.level, self.level_downsample)
+
+        cache = self.tile_cache
+        if cache is not None:
+            slide_key = cache.slide_key(self.slide)
+
+        def get_cached(x, y):
+            # (key, result). result is None if the tile has to be extracted
+            if cache is None:
+                return None, None
+            start = time.perf_counter()
+            key = cache.make_key(slide_key, x, y, self.modified_tile_size, self.original_tile_size,
+                                 self.desired_tile_mpp, self.level, read_mode, self.edge_mode)
+            hit = cache.get(key, max_blank_amt)
+            if hit is None:
+                return key, None
+            tile, blank = hit
+            self.stats.add('cache', time.perf_counter() - start)
+            return key, (tile, _tile_coordinate(x, y, self.modified_tile_size, self.original_tile_size), blank, None)
+
+        def store(key, res):
+            # extracted tile. record where its time went and cache it. tiles from the cache (handed back by the worker
+            # path as they are) have no timings and were already recorded by get_cached
+            if res[3] is None:
+                return res
+            for stage, seconds in zip(('read', 'resize', 'blank'), res[3]):
+                self.stats.add(stage, seconds)
+            if key is not None:
+                cache.put(key, res[0], res[2])
+            return res
+
+        try:
+            yield from self._extract_in_order(positions, args, get_cached, store, num_workers, worker_type, prefetch,
+                                              read_mode, next_slot)
+        finally:
+            if cache is not None:
+                cache.flush()
+
+
+    def _extract_by_band(self, positions, args, get_cached, store, strip=False):
+        '''
+        Extracts the tiles a row at a time by reading the band of the slide the row covers and slicing the tiles out of
+        it, so that overlapping tiles don't read the same pixels over and over. The band is read into one buffer that
+        is reused for every row, and rows of it that the next row of tiles overlaps are kept rather than read again
+
+        As a strip, the row's part of the band is converted to BGR and resized to the output tile size all at once
+        into a reused buffer and the tiles are views of it. Since the row is resized as a whole, pixels near the edges
+        of tiles can differ slightly from resizing each tile on its own
+
+        :param strip: convert and resize the whole row at once
+        :return: see `_iterate_extracted`. tiles of a strip are only valid until the next row
+        '''
+
+        tile_size, out_tile_size, max_blank_amt, level, downsample = args
+        reader = self.slide.reader
+
+        # columns of the level covered by the grid
+        bx1 = _level_box(self.grid_xs[0], 0, tile_size, level, downsample)[0] if self.grid_xs else 0
+        bx2 = _level_box(self.grid_xs[-1], 0, tile_size, level, downsample)[2] if self.grid_xs else 0
+
+        # rows band_y1 to band_y1 + band_h of the level, columns bx1 to bx2. allocated once and reused for every row.
+        # rounding to the level can make a tile's box a row taller than the tile size says
+        band_buffer, band_y1, band_h = None, 0, 0
+        max_band_h = tile_size if not level else int(np.ceil(tile_size / downsample)) + 1
+
+        # row of tiles converted and resized to the output tile size, reused for every row
+        scale = out_tile_size * downsample / tile_size
+        strip_width = max(out_tile_size, int(round((bx2 - bx1) * scale)))
+        strip_buffer = None
+
+        for y, row in itertools.groupby(positions, key=lambda p: p[1]):
+            row = [(x,) + get_cached(x, y) for x, _ in row]
+            misses = sum(res is None for _, _, res in row)
+
+            if misses:
+                start = time.perf_counter()
+
+                _, by1, _, by2 = _level_box(0, y, tile_size, level, downsample)
+                if band_buffer is None:
+                    band_buffer = np.empty((max_band_h, bx2 - bx1, 3), dtype=np.uint8)
+
+                # rows of the last band that this row overlaps move to the top and only the rest are read
+                kept = min(band_y1 + band_h - by1, by2 - by1) if band_y1 <= by1 < band_y1 + band_h else 0
+                if kept:
+                    band_buffer[:kept] = band_buffer[by1 - band_y1:by1 - band_y1 + kept]
+                band_y1, band_h = by1, by2 - by1
+                if kept < band_h:
+                    band_buffer[kept:band_h] = _read_region(reader, (bx1, by1 + kept, bx2, by2), level)
+                band = band_buffer[:band_h]
+
+                # spread the read over the tiles it was for
+                read_seconds = (time.perf_counter() - start) / misses
+
+                if strip:
+                    start = time.perf_counter()
+                    if strip_buffer is None:
+                        strip_buffer = np.empty((out_tile_size, strip_width, 3), dtype=np.uint8)
+
+                    rows = band[by1 - band_y1:by2 - band_y1]
+                    if rows.shape[:2] == strip_buffer.shape[:2]:
+                        cv2.cvtColor(rows, cv2.COLOR_RGB2BGR, dst=strip_buffer)
+                    else:
+                        cv2.resize(rows, (strip_width, out_tile_size), dst=strip_buffer)
+                        cv2.cvtColor(strip_buffer, cv2.COLOR_RGB2BGR, dst=strip_buffer)
+                    resize_seconds = (time.perf_counter() - start) / misses
+
+            for x, key, res in row:
+                if res is None:
+                    tx1, ty1, tx2, ty2 = _level_box(x, y, tile_size, level, downsample)
+                    if strip:
+                        sx = min(int(round((tx1 - bx1) * scale)), strip_width - out_tile_size)
+                        res = store(key, _check_tile(strip_buffer[:, sx:sx + out_tile_size], x, y, tile_size,
+                                                     out_tile_size, max_blank_amt, read_seconds, resize_seconds))
+                    else:
+                        # the band is overwritten by the next row so the tile can't be a view of it
+                        region = band[ty1 - band_y1:ty2 - band_y1, tx1 - bx1:tx2 - bx1]
+                        out = np.empty((out_tile_size, out_tile_size, 3), dtype=np.uint8)
+                        res = store(key, _finish_tile(region, x, y, tile_size, out_tile_size, max_blank_amt,
+                                                      read_seconds, out=out))
+                yield y, res
+
+
+    def _extract_in_order(self, positions, args, get_cached, store, num_workers, worker_type, prefetch,
+                          read_mode='tile', next_slot=None):
+        '''
+        Does the work of `_iterate_extracted`. Only tiles that `get_cached` can't return are extracted, and every
+        extracted tile is passed through `store`
+        '''
+
+        if num_workers == 0:
+            if read_mode == 'strip' or self.modified_stride < self.modified_tile_size:
+                yield from self._extract_by_band(positions, args, get_cached, store, strip=read_mode == 'strip')
+                return
+
+            for x, y in positions:
+                key, res = get_cached(x, y)
+                if res is None:
+                    out = next_slot() if next_slot is not None else None
+                    res = store(key, _extract_tile(self.slide.reader, x, y, *args, out=out))
+                yield y, res
+            return
+
+        executor_cls = ThreadPoolExecutor if worker_type == 'thread' else ProcessPoolExecutor
+
+        with executor_cls(max_workers=num_workers) as executor:
+            # futures in submission order. we never have more than `prefetch` tiles in flight so memory stays capped
+            # cached tiles wait in line as already finished futures so everything still comes out in order
+            pending = collections.deque()
+            try:
+                for x, y in positions:
+                    key, res = get_cached(x, y)
+                    if res is None:
+                        future = executor.submit(
+                            _extract_tile_worker, type(self.slide.reader), self.slide.path, x, y, *args)
+                    else:
+                        key, future = None, Future()
+                        future.set_result(res)
+                    pending.append((y, key, future))
+
+                    if len(pending) >= prefetch:
+                        y_done, key, future = pending.popleft()
+                        yield y_done, store(key, future.result())
+
+                while pending:
+                    y_done, key, future = pending.popleft()
+                    yield y_done, store(key, future.result())
+            finally:
+                # generator may be closed early. don't bother finishing tiles nobody will ask for
+                for _, _, future in pending:
+                    future.cancel()
+
+
+    def iterate_tiles(self, min_non_blank_amt=0.0, batch_size=4, print_time=True, num_workers=0, worker_type='thread',
+                      prefetch=None, use_tissue_mask=False, tissue_mask_cell_size=DEFAULT_TISSUE_MASK_CELL_SIZE,
+                      tissue_mask_margin=DEFAULT_TISSUE_MASK_MARGIN, read_mode='tile', ring_size=None):
         '''
         A generator that iterates over all the tiles within the supplied slide
 
+        Tiles can be extracted in parallel by a pool of workers, each with its own reader on the slide. Batches are
+        yielded in the same order regardless of the number of workers
+
+        With the tissue mask, tiles that look blank on a downsampled copy of the slide are skipped without ever being
+        cropped. The remaining tiles still go through the usual full resolution blank check
+
+        In 'strip' read mode each row of tiles is read from the slide once as a band the height of a tile, converted to
+        BGR and resized as a whole, and cut into tiles. This saves decoding the same rows for every tile of a row (ie
+        for strip organized tiffs and jpegs) at the cost of pixels near tile edges differing slightly from 'tile' mode
+        when tiles are resized. Tiles and coordinates are yielded in the same order as 'tile' mode
+
+        Every batch is a copy unless a ring size is given, in which case batches are assembled in a ring of that many
+        reused buffers and yielded as is. A batch then stays valid until `ring_size` more batches have been asked for,
+        ie up to `ring_size` batches can be held at once and asking for another overwrites the oldest. Copy anything
+        that has to outlive that
+
         :param min_non_blank_amt: tile must have at least this percentage of its pixels "non-blank" ie if the value
         is 0.6, means the tile must have 60%+ of its pixels non-blank
         :param batch_size: get x tiles at once
         :param print_time: for printing out how many tiles/how many to go
+        :param num_workers: number of extraction workers. 0 extracts the tiles in the calling thread
+        :param worker_type: 'thread' or 'process' workers
+        :param prefetch: maximum number of tiles being extracted ahead of the consumer. defaults to twice the larger
+        of the batch size and number of workers
+        :param use_tissue_mask: only crop tiles that the tissue mask estimates to satisfy `min_non_blank_amt`
+        :param tissue_mask_cell_size: see `get_tissue_mask`
+        :param tissue_mask_margin: a tile is only skipped if its estimated non-blank amount is below
+        `min_non_blank_amt` by more than this margin
+        :param read_mode: 'tile' or 'strip'. strip reading is done in the calling thread so can't be used with workers
+        :param ring_size: number of reused batch buffers to yield views of rather than copying each batch
         :return: dict containing array of tiles and coordinates
         '''
 
@@ -71,89 +741,234 @@ class TileExtractor:
         if batch_size < 1:
             raise Exception('Batch size must be at least 1')
 
+        if num_workers < 0:
+            raise Exception('Number of workers cannot be negative')
+
+        if worker_type not in TileExtractor.WORKER_TYPES:
+            raise Exception('Worker type must be one of {}'.format(TileExtractor.WORKER_TYPES))
+
+        if read_mode not in TileExtractor.READ_MODES:
+            raise Exception('Read mode must be one of {}'.format(TileExtractor.READ_MODES))
+
+        if read_mode == 'strip' and num_workers:
+            raise Exception('Strip read mode cannot be used with workers')
+
+        if ring_size is not None and ring_size < 1:
+            raise Exception('Ring size must be at least 1')
+
+        if prefetch is None:
+            prefetch = 2 * max(batch_size, num_workers)
+        elif prefetch < 1:
+            raise Exception('Prefetch must be at least 1')
+
         # initialization
-        x = y = 0
         tile_size = self.modified_tile_size
+        out_tile_size = self.original_tile_size
 
         # For timing and count tiles
-        cols = self.trimmed_width / tile_size
-        rows = self.trimmed_height / tile_size
+        cols = len(self.grid_xs)
+        rows = len(self.grid_ys)
         tot_tiles = cols * rows
-        start_time = time.clock()
-
-        # buffer for our batches. will keep updating this each yield
-        tiles_buffer = np.zeros((batch_size, tile_size, tile_size, self.chn), dtype=np.uint8)
-        coordinates_buffer = np.zeros((batch_size, 4), dtype=int)
+        start_time = time.perf_counter()
+        rows_done = 0
+
+        def log_progress():
+            logging.info("{:0.2f}% ({}/{} tiles) in {:0.2f}s".format(
+                rows_done / rows * 100,  # percent of rows complete
+                rows_done * cols,  # number of rows complete * tiles per row
+                tot_tiles,
+                time.perf_counter() - start_time))
+
+        # buffers for our batches. will keep updating these each yield. without a ring, the one buffer is copied out
+        num_buffers = 1 if ring_size is None else ring_size
+        tiles_buffers = np.zeros((num_buffers, batch_size, out_tile_size, out_tile_size, self.chn), dtype=np.uint8)
+        coordinates_buffers = np.zeros((num_buffers, batch_size, 4), dtype=int)
+        ring_i = 0
+        tiles_buffer, coordinates_buffer = tiles_buffers[0], coordinates_buffers[0]
         buffer_i = 0
 
-        # break out when top left coordinate of next tile is the bottom of image
-        while y != self.trimmed_height:
+        # where the tile being extracted goes in the batch, if it was extracted straight into it
+        slot = None
+
+        def next_slot():
+            nonlocal slot
+            slot = tiles_buffer[buffer_i]
+            return slot
 
-            # Get current sub-image
-            tile = np.array(self.slide.image.crop((x, y, x + tile_size, y + tile_size)))[:, :, 2::-1]
+        positions = self._iterate_positions(min_non_blank_amt, use_tissue_mask, tissue_mask_cell_size,
+                                            tissue_mask_margin)
 
-            r = 1 / self.tile_size_resize_factor
-            if r != 1:
-                tile = cv2.resize(tile, (0, 0), fx=r, fy=r)
+        for y, res in self._iterate_extracted(positions, 1 - min_non_blank_amt, num_workers, worker_type, prefetch,
+                                              read_mode, next_slot):
+
+            # log each row once we have moved past it
+            while print_time and rows_done + 1 < rows and y >= self.grid_ys[rows_done + 1]:
+                rows_done += 1
+                log_progress()
 
             # only yield if under maximum blank allowance
-            if TileExtractor.amount_blank(tile) <= (1 - min_non_blank_amt):
-                top_left_x, top_left_y = int(x * r), int(y * r)
-                bot_right_x, bot_right_y = int((x + tile_size) * r), int((y + tile_size) * r)
-                coordinate = (top_left_x, top_left_y, bot_right_x, bot_right_y)
-
-                tiles_buffer[buffer_i] = tile
-                coordinates_buffer[buffer_i] = coordinate
-                buffer_i += 1
-
-                if buffer_i == batch_size:
-                    buffer_i = 0
-                    yield {'tiles': tiles_buffer.copy(), 'coordinates': coordinates_buffer.copy()}
-
-            # move onto next spot
-            x += tile_size
-            if x == self.trimmed_width:
-                x = 0
-                y += tile_size
-
-                if print_time:
-                    logging.info("{:0.2f}% ({}/{} tiles) in {:0.2f}s".format(
-                        (y / tile_size) / rows * 100,  # percent of rows complete
-                        (y / tile_size) * cols,  # number of rows complete * tiles per row
-                        tot_tiles,
-                        time.clock() - start_time))
+            tile, coordinate = res[:2]
+            if tile is not None:
+                with self.stats.timer('batch'):
+                    if tile is not slot:
+                        tiles_buffer[buffer_i] = tile
+                    coordinates_buffer[buffer_i] = coordinate
+                    buffer_i += 1
+
+                    if buffer_i == batch_size:
+                        buffer_i = 0
+                        if ring_size is None:
+                            batch = {'tiles': tiles_buffer.copy(), 'coordinates': coordinates_buffer.copy()}
+                        else:
+                            batch = {'tiles': tiles_buffer, 'coordinates': coordinates_buffer}
+                            ring_i = (ring_i + 1) % ring_size
+                            tiles_buffer, coordinates_buffer = tiles_buffers[ring_i], coordinates_buffers[ring_i]
+
+                if buffer_i == 0:
+                    yield batch
+
+        if print_time and rows_done < rows:
+            rows_done = rows
+            log_progress()
+
+        if print_time:
+            logging.info('Time per stage: {}'.format(self.stats))
 
         # may have leftover tiles
         if buffer_i > 0:
             yield {'tiles': tiles_buffer[:buffer_i, :, :, :], 'coordinates': coordinates_buffer[:buffer_i, :]}
 
 
-    def iterate_tiles_with_lesion_conf(self, model, non_lesion_indices, min_non_blank_amt=0.0, batch_size=4,
-                                       print_time=True):
+    def _iterate_prepared(self, min_non_blank_amt, batch_size, print_time, queue_depth, dtype, **kwargs):
         '''
-        A generator that iterates over all the tiles within the supplied slide along with the lesional score
+        Iterates over the batches of `iterate_tiles` along with their tiles prepared for a model. Upcoming batches are
+        extracted and prepared on a background thread while the current one is being scored
+
+        :return: generator of (batch, prepared tiles)
         '''
 
         from .model_utils import ModelUtils
 
+        if queue_depth < 0:
+            raise Exception('Queue depth cannot be negative')
+
+        # the background thread works up to queue_depth + 1 batches ahead of the one being scored
+        ring_size = kwargs.get('ring_size')
+        if queue_depth > 0 and ring_size is not None and ring_size < queue_depth + 2:
+            raise Exception('Ring size must be at least the queue depth + 2')
+
         # generator for extracting tiles
         extractor_gen = self.iterate_tiles(
-            min_non_blank_amt=min_non_blank_amt, batch_size=batch_size, print_time=print_time)
+            min_non_blank_amt=min_non_blank_amt, batch_size=batch_size, print_time=print_time, **kwargs)
 
-        for res in extractor_gen:
-            tile_batch, coordinate_batch = res['tiles'], res['coordinates']
+        # tiles are prepared into a ring of reusable buffers. a buffer can be in use by the model, waiting in the queue
+        # or being filled by the producer at any one time, hence queue_depth + 2 of them
+        buffers = [None] * (queue_depth + 2)
 
-            # get predictions for each tile
-            # preds = ModelUtils.get_conf_scoreJAJA(model, tile_batch)
-            preds = model.predict_on_batch(ModelUtils.prepare_images(tile_batch))
-            # depends on tensorflow
-            try:
-                lesion_confs = (1 - np.sum(preds.numpy()[:, non_lesion_indices], axis=1))
-            except:
-                lesion_confs = (1 - np.sum(preds[:, non_lesion_indices], axis=1))
+        def prepare(i, tiles):
+            buf = buffers[i % len(buffers)]
+            if buf is None or buf.shape[1:] != tiles.shape[1:] or len(buf) < len(tiles):
+                buf = buffers[i % len(buffers)] = np.empty(tiles.shape, dtype=dtype)
+            with self.stats.timer('prepare', len(tiles)):
+                return ModelUtils.prepare_images(tiles, out=buf[:len(tiles)])
+
+        # batches along with their images prepared for the model
+        prepared_gen = ((res, prepare(i, res['tiles'])) for i, res in enumerate(extractor_gen))
+        if queue_depth > 0:
+            prepared_gen = _iterate_in_background(prepared_gen, queue_depth)
+
+        return prepared_gen
+
+
+    @staticmethod
+    def _predict(model, prepared, non_lesion_indices=None):
+        '''
+        Scores a batch of prepared tiles
+
+        :return: (preds, lesion confidences or None if no non-lesion indices given)
+        '''
+
+        # get predictions for each tile
+        # preds = ModelUtils.get_conf_scoreJAJA(model, tile_batch)
+        preds = model.predict_on_batch(prepared)
+        # depends on tensorflow
+        try:
+            preds = preds.numpy()
+        except:
+            pass
+
+        if non_lesion_indices is None:
+            return preds, None
+        return preds, (1 - np.sum(preds[:, non_lesion_indices], axis=1))
+
+
+    def iterate_tiles_with_lesion_conf(self, model, non_lesion_indices, min_non_blank_amt=0.0, batch_size=4,
+                                       print_time=True, queue_depth=1, dtype=np.float32, **kwargs):
+        '''
+        A generator that iterates over all the tiles within the supplied slide along with the lesional score
+
+        Upcoming batches are extracted and prepared on a background thread while the model scores the current one
+
+        :param queue_depth: number of prepared batches that can wait for the model. 0 extracts and scores in turn on
+        the calling thread
+        :param dtype: float dtype the tiles are prepared in for the model
+        :param kwargs: additional tile extraction options passed on to `iterate_tiles`. with a `ring_size`, the
+        background thread holds up to queue_depth + 1 batches of the ring so it must be at least queue_depth + 2, and
+        up to ring_size - queue_depth - 1 of the yielded batches' tiles can be held at once
+        :return: dict containing array of tiles, coordinates, lesion confidences and the model's preds
+        '''
+
+        for res, prepared in self._iterate_prepared(min_non_blank_amt, batch_size, print_time, queue_depth, dtype,
+                                                    **kwargs):
+            with self.stats.timer('inference', len(prepared)):
+                preds, lesion_confs = TileExtractor._predict(model, prepared, non_lesion_indices)
+
+            yield {
+                'tiles': res['tiles'],
+                'coordinates': res['coordinates'],
+                'lesion_confs': lesion_confs,
+                'preds': preds,
+            }
+
+
+    def iterate_tiles_with_multi_model_conf(self, models_and_configs, min_non_blank_amt=0.0, batch_size=4,
+                                            print_time=True, queue_depth=1, dtype=np.float32, **kwargs):
+        '''
+        A generator that iterates over all the tiles within the supplied slide along with the scores of several models.
+        Each batch is extracted and prepared once and then fed to every model
+
+        Every config must have been made for the tile size and mpp of this tile extractor
+
+        :param models_and_configs: list of (model, config) pairs. configs without `non_lesion_indices` only get preds
+        :param queue_depth: see `iterate_tiles_with_lesion_conf`
+        :param dtype: see `iterate_tiles_with_lesion_conf`
+        :param kwargs: additional tile extraction options passed on to `iterate_tiles`
+        :return: dict containing array of tiles, coordinates, and dicts of each model's lesion confidences (None if
+        the config has no non-lesion indices) and preds keyed by config identity
+        '''
+
+        for _, config in models_and_configs:
+            tile_size, mpp = getattr(config, 'tile_size', None), getattr(config, 'mpp', None)
+            if (tile_size is not None and tile_size != self.original_tile_size) or \
+                    (mpp is not None and mpp != self.desired_tile_mpp):
+                raise Exception('{} needs {} sized tiles at {} mpp, not {} sized tiles at {} mpp'.format(
+                    config.identity, tile_size, mpp, self.original_tile_size, self.desired_tile_mpp))
+
+        identities = [config.identity for _, config in models_and_configs]
+        if len(set(identities)) != len(identities):
+            raise Exception('Configs must have different identities')
+
+        for res, prepared in self._iterate_prepared(min_non_blank_amt, batch_size, print_time, queue_depth, dtype,
+                                                    **kwargs):
+            lesion_confs, preds = {}, {}
+            for model, config in models_and_configs:
+                with self.stats.timer('inference', len(prepared)):
+                    preds[config.identity], lesion_confs[config.identity] = TileExtractor._predict(
+                        model, prepared, getattr(config, 'non_lesion_indices', None))
 
             yield {
-                'tiles': tile_batch,
-                'coordinates': coordinate_batch,
+                'tiles': res['tiles'],
+                'coordinates': res['coordinates'],
                 'lesion_confs': lesion_confs,
+                'preds': preds,
             }
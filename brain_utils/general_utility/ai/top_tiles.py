@@ -0,0 +1,134 @@
+import heapq
+import numpy as np
+
+
+class TopTilesPerClass:
+    '''
+    Keeps the k most confident tiles of every class while batches of scored tiles stream past, so that a slide's
+    report tiles can be picked without holding every tile of the slide in memory
+
+    A tile that is in the top k of several classes is only stored once. The kept tiles with their full conf rows give
+    the same per-class (and overall) argmax as the full slide would, so they can be passed straight to
+    `TileUtils.create_image_vector_for_each_classes`
+    '''
+
+
+    def __init__(self, num_classes, k=1):
+        '''
+        Creates an empty store
+
+        :param num_classes: number of classes in the confs
+        :param k: number of tiles kept per class
+        '''
+
+        if k < 1:
+            raise Exception('Must keep at least 1 tile per class')
+
+        self.num_classes = num_classes
+        self.k = k
+
+        # min heap per class of (conf, -sequence number). on equal confs the earlier tile wins, like np.argmax
+        self._heaps = [[] for _ in range(num_classes)]
+        # sequence number -> [tile, coordinate, confs, number of heaps the tile is in]
+        self._tiles = {}
+        self._count = 0
+
+
+    def add(self, tiles, coordinates, confs):
+        '''
+        Considers a batch of tiles
+
+        :param tiles: (N, H, W, C) tiles
+        :param coordinates: (N, 4) tile coordinates
+        :param confs: (N, num_classes) confs (preds) of each tile
+        :return:
+        '''
+
+        confs = np.asarray(confs)
+        if confs.ndim != 2 or confs.shape[1] != self.num_classes:
+            raise Exception('Confs must be of shape (N, {})'.format(self.num_classes))
+
+        first = self._count
+        self._count += len(confs)
+
+        for c, heap in enumerate(self._heaps):
+            col = confs[:, c]
+
+            # only tiles that can make it into the heap need to be looked at
+            if len(heap) == self.k:
+                candidates = np.flatnonzero(col > heap[0][0])
+            else:
+                candidates = np.arange(len(col))
+
+            for i in candidates:
+                item = (col[i], -(first + i))
+                if len(heap) < self.k:
+                    heapq.heappush(heap, item)
+                elif item > heap[0]:
+                    self._release(-heapq.heapreplace(heap, item)[1])
+                else:
+                    continue
+
+                seq = first + i
+                if seq not in self._tiles:
+                    # copy so that we don't keep the whole batch (or a reused buffer) alive
+                    self._tiles[seq] = [np.array(tiles[i]), np.array(coordinates[i]), np.array(confs[i]), 0]
+                self._tiles[seq][3] += 1
+
+
+    def add_result(self, res, identity=None):
+        '''
+        Considers a batch yielded by `TileExtractor.iterate_tiles_with_lesion_conf` (or
+        `iterate_tiles_with_multi_model_conf`, in which case the config identity of the model's preds to use is given)
+
+        :param res: dict with 'tiles', 'coordinates' and 'preds'
+        :param identity: config identity for multi model batches
+        :return:
+        '''
+
+        preds = res['preds'] if identity is None else res['preds'][identity]
+        self.add(res['tiles'], res['coordinates'], preds)
+
+
+    def _release(self, seq):
+        # a tile was pushed out of a class' heap. forget it once no class keeps it
+        entry = self._tiles[seq]
+        entry[3] -= 1
+        if entry[3] == 0:
+            del self._tiles[seq]
+
+
+    def __len__(self):
+        return len(self._tiles)
+
+
+    def get_tiles(self):
+        '''
+        Returns the kept tiles in the order they were added
+
+        :return: (tiles, coordinates, confs) arrays
+        '''
+
+        if not self._tiles:
+            raise Exception('No tiles added')
+
+        entries = [self._tiles[seq] for seq in sorted(self._tiles)]
+        return (np.stack([e[0] for e in entries]), np.stack([e[1] for e in entries]),
+                np.stack([e[2] for e in entries]))
+
+
+    def get_class_tiles(self, class_idx):
+        '''
+        Returns the kept tiles of a class, most confident first
+
+        :param class_idx:
+        :return: (tiles, coordinates, confs) arrays where confs are the class' confs
+        '''
+
+        seqs = [-s for _, s in sorted(self._heaps[class_idx], reverse=True)]
+        if not seqs:
+            raise Exception('No tiles added')
+
+        entries = [self._tiles[seq] for seq in seqs]
+        return (np.stack([e[0] for e in entries]), np.stack([e[1] for e in entries]),
+                np.array([e[2][class_idx] for e in entries]))
@@ -0,0 +1,186 @@
+import numpy as np
+import cv2
+import matplotlib.pyplot as plt
+
+from . import unique_colors
+
+
+class HeatmapGrid:
+    '''
+    Whole slide heatmap with one cell per tile, built up batch by batch from tile coordinates and their lesion
+    confidences (or per-class preds). Memory only depends on the number of tiles, not on the slide's size
+    '''
+
+
+    def __init__(self, height, width, tile_size, num_classes=None, dtype=np.float32):
+        '''
+        Creates an empty heatmap grid
+
+        :param height: height of the area the tiles cover (in tile coordinates)
+        :param width: width of the area the tiles cover (in tile coordinates)
+        :param tile_size: size of a tile (in tile coordinates)
+        :param num_classes: stores a pred per class for every tile if given, otherwise a single lesion confidence
+        :param dtype: float32, or uint8 to store values quantized to 0-255
+        '''
+
+        if dtype not in (np.float32, np.uint8):
+            raise Exception('Heatmap grid dtype must be float32 or uint8')
+
+        self.tile_size = tile_size
+        self.rows = int(height // tile_size)
+        self.cols = int(width // tile_size)
+        self.num_classes = num_classes
+
+        shape = (self.rows, self.cols) if num_classes is None else (self.rows, self.cols, num_classes)
+        self.grid = np.zeros(shape, dtype=dtype)
+        # which cells have had a tile added
+        self.filled = np.zeros((self.rows, self.cols), dtype=bool)
+
+        # top left x/y (in tile coordinates) of the tiles in each column/row. if not set, tiles are assumed to be on a
+        # non-overlapping grid of tile_size
+        self.xs = None
+        self.ys = None
+
+
+    @staticmethod
+    def from_tile_extractor(tile_extractor, num_classes=None, dtype=np.float32):
+        '''
+        Creates a heatmap grid matching the tiles yielded by the tile extractor, with a cell for each position of its
+        (possibly overlapping) tile grid
+
+        :param tile_extractor:
+        :param num_classes: see __init__
+        :param dtype: see __init__
+        :return: heatmap grid
+        '''
+
+        tile_size = tile_extractor.original_tile_size
+        r = tile_size / tile_extractor.modified_tile_size
+
+        # same truncation as the tile coordinates
+        xs = [int(x * r) for x in tile_extractor.grid_xs]
+        ys = [int(y * r) for y in tile_extractor.grid_ys]
+        return HeatmapGrid.from_grid_positions(xs, ys, tile_size, num_classes=num_classes, dtype=dtype)
+
+
+    @staticmethod
+    def from_grid_positions(xs, ys, tile_size, num_classes=None, dtype=np.float32):
+        '''
+        Creates a heatmap grid with a cell for each tile of a grid
+
+        :param xs: top left x (in tile coordinates) of the tiles in each column
+        :param ys: top left y (in tile coordinates) of the tiles in each row
+        :param tile_size: see __init__
+        :param num_classes: see __init__
+        :param dtype: see __init__
+        :return: heatmap grid
+        '''
+
+        grid = HeatmapGrid(len(ys) * tile_size, len(xs) * tile_size, tile_size, num_classes=num_classes, dtype=dtype)
+        grid.xs = np.array(xs, dtype=int)
+        grid.ys = np.array(ys, dtype=int)
+        return grid
+
+
+    def add(self, coordinates, values):
+        '''
+        Stores the values of a batch of tiles in their cells
+
+        :param coordinates: (N, 4) array of tile coordinates (top_left_x, top_left_y, bot_right_x, bot_right_y)
+        :param values: (N,) lesion confidences or (N, num_classes) preds
+        :return:
+        '''
+
+        coordinates = np.asarray(coordinates)
+        values = np.asarray(values)
+        if len(coordinates) == 0:
+            return
+
+        if self.xs is not None:
+            rows = np.searchsorted(self.ys, coordinates[:, 1])
+            cols = np.searchsorted(self.xs, coordinates[:, 0])
+        else:
+            # coordinates of resized tiles are truncated so round to the nearest cell
+            rows = np.rint(coordinates[:, 1] / self.tile_size).astype(int)
+            cols = np.rint(coordinates[:, 0] / self.tile_size).astype(int)
+
+        if self.grid.dtype == np.uint8:
+            values = np.rint(np.clip(values, 0, 1) * 255)
+
+        self.grid[rows, cols] = values
+        self.filled[rows, cols] = True
+
+
+    def add_result(self, res):
+        '''
+        Stores a batch yielded by `TileExtractor.iterate_tiles_with_lesion_conf`
+
+        :param res: dict with 'coordinates' and 'lesion_confs' (and 'preds' if storing per-class preds)
+        :return:
+        '''
+
+        self.add(res['coordinates'], res['lesion_confs'] if self.num_classes is None else res['preds'])
+
+
+    @property
+    def values(self):
+        '''
+        Stored values as floats between 0 and 1. Cells without a tile are 0
+        '''
+
+        if self.grid.dtype == np.uint8:
+            return self.grid / np.float32(255)
+        return self.grid
+
+
+    def colorize(self, colormaps=None, cmap='jet', cell_size=1, empty_color=(255, 255, 255)):
+        '''
+        Colors every cell with a single lookup. Per-class grids color each cell by the class with the highest pred
+        using the config's colormaps. Lesion confidence grids go through a matplotlib colormap
+
+        :param colormaps: config colormaps (color names or BGR 0-1 tuples), one per class. needed for per-class grids
+        :param cmap: matplotlib colormap name for lesion confidence grids
+        :param cell_size: size in pixels of each cell in the returned image
+        :param empty_color: BGR color of cells without a tile
+        :return: BGR image
+        '''
+
+        if self.num_classes is None:
+            # 256 level lookup table
+            lut = plt.get_cmap(cmap)(np.linspace(0, 1, 256))[:, 2::-1]
+            palette = np.round(lut * 255).astype(np.uint8)
+            if self.grid.dtype == np.uint8:
+                idx = self.grid
+            else:
+                idx = np.rint(np.clip(self.grid, 0, 1) * 255).astype(np.uint8)
+        else:
+            if colormaps is None or len(colormaps) != self.num_classes:
+                raise Exception('Need a colormap for each of the {} classes'.format(self.num_classes))
+            palette = HeatmapGrid.colormaps_to_bgr(colormaps)
+            idx = np.argmax(self.grid, axis=2)
+
+        image = palette[idx]
+        image[~self.filled] = empty_color
+
+        if cell_size != 1:
+            image = cv2.resize(image, (self.cols * cell_size, self.rows * cell_size), interpolation=cv2.INTER_NEAREST)
+
+        return image
+
+
+    @staticmethod
+    def colormaps_to_bgr(colormaps):
+        '''
+        Converts config colormaps into a (num_classes, 3) BGR palette
+
+        :param colormaps: list of color names from `unique_colors` or BGR tuples with values between 0 and 1
+        :return: uint8 array
+        '''
+
+        palette = np.zeros((len(colormaps), 3), dtype=np.uint8)
+        for i, c in enumerate(colormaps):
+            if isinstance(c, str):
+                palette[i] = unique_colors.BGR_COLORS[c]
+            else:
+                palette[i] = np.round(np.array(c[:3]) * 255)
+        return palette
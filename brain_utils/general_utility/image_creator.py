@@ -1,24 +1,55 @@
+import os
+import shutil
+import tempfile
+import functools
+import collections
 import numpy as np
 import cv2
 
 from .tile_image_utils import TileUtils
+from .tiff_writer import write_tiled_tiff
 
 
 class ImageCreator:
+    # tile numbering style, tuned for a 1024x1024 tile at full resolution
+    LABEL_FONT = cv2.FONT_HERSHEY_DUPLEX
+    LABEL_FONT_SCALE = 20
+    LABEL_THICKNESS = 40
+    # offset of the text's bottom left corner from the bottom left corner of the tile
+    LABEL_OFFSET = (40, 150)
 
-    def __init__(self, height, width, scale_factor=1, channels=3):
+    # (text, scale factor) -> (alpha mask, offset of the mask's top left corner from the text's bottom left corner)
+    _label_sprites = {}
+
+    # canvas rows processed at a time when filling or downsampling a memory mapped canvas
+    CHUNK_ROWS = 1024
+
+    def __init__(self, height, width, scale_factor=1, channels=3, memmap_path=None):
         '''
 
         Creates an image of the specified size except scaled down by an optional factor amount
 
+        For images too large to fit in memory, the image can be backed by a memory mapped .npy file instead. Tiles and
+        borders are added the same way and the image can be saved as a tiled pyramidal tiff or previewed at a smaller
+        size without it ever being fully loaded
+
         :param height:
         :param width:
         :param scale_factor: scale the created image down by a factor of this amount
         :param channels:
+        :param memmap_path: path of the .npy file to keep the image in. image is kept in memory if not given
         '''
 
+        shape = (int(height / scale_factor), int(width / scale_factor), channels)
+
         # this matrix will always have the specified dtype
-        self.image = np.ones((int(height / scale_factor), int(width / scale_factor), channels), dtype=np.uint8) * 255
+        if memmap_path is None:
+            self.image = np.full(shape, 255, dtype=np.uint8)
+        else:
+            self.image = np.lib.format.open_memmap(memmap_path, mode='w+', dtype=np.uint8, shape=shape)
+            for y in range(0, shape[0], ImageCreator.CHUNK_ROWS):
+                self.image[y:y + ImageCreator.CHUNK_ROWS] = 255
+
         self.scale_factor = scale_factor
 
     def _get_scaled_coordinate(self, coordinate):
@@ -38,6 +69,145 @@ class ImageCreator:
         # Put sub-image into correct spot of matrix (recreating image) by resizing tile if needed to fit within the spot
         self.image[y1_adj:y2_adj, x1_adj:x2_adj, :] = cv2.resize(tile, (x2_adj - x1_adj, y2_adj - y1_adj))
 
+    def add_tiles(self, tiles, coordinates):
+        '''
+        Adds a batch of same sized tiles, ie as yielded by `TileExtractor.iterate_tiles`
+
+        Tiles whose spots are the same size are shrunk with a single resize of the tiles stacked on top of each other.
+        Since no row of a shrunk tile is interpolated from past the tile's own rows, this gives the same pixels as
+        `add_tile` when the scale factor divides the tile size. Otherwise a few pixels can be 1 off from `add_tile`
+        from rounding. Tiles that have to be enlarged are resized one at a time like `add_tile`
+
+        :param tiles: (N, H, W, C) array of 0-255 valued tiles
+        :param coordinates: (N, 4) array of top left and bottom right coordinates of each tile
+        :return:
+        '''
+
+        tiles = np.asarray(tiles)
+        if len(tiles) == 0:
+            return
+
+        # adjust coordinates depending on if we want to scale our image
+        scaled = [self._get_scaled_coordinate(coordinate) for coordinate in coordinates]
+
+        # spot size -> indices of the tiles going into spots of that size
+        groups = collections.defaultdict(list)
+        for i, (x1_adj, y1_adj, x2_adj, y2_adj) in enumerate(scaled):
+            groups[(x2_adj - x1_adj, y2_adj - y1_adj)].append(i)
+
+        h, w = tiles.shape[1:3]
+        for (spot_w, spot_h), indices in groups.items():
+            if len(indices) == 1 or spot_w > w or spot_h > h:
+                resized = [cv2.resize(tiles[i], (spot_w, spot_h)) for i in indices]
+            else:
+                group = np.ascontiguousarray(tiles if len(indices) == len(tiles) else tiles[indices])
+                stacked = cv2.resize(group.reshape((-1,) + group.shape[2:]), (spot_w, spot_h * len(indices)))
+                resized = stacked.reshape((len(indices), spot_h, spot_w) + group.shape[3:])
+
+            for i, tile in zip(indices, resized):
+                x1_adj, y1_adj, x2_adj, y2_adj = scaled[i]
+                self.image[y1_adj:y2_adj, x1_adj:x2_adj, :] = tile
+
+    def _read_downsampled_rows(self, downsample, y1, y2, width):
+        '''
+        Returns rows y1 to y2 of the image downsampled by the given factor, only reading the rows of the image needed
+
+        :param downsample:
+        :param y1: first row in downsampled coordinates
+        :param y2: last row (exclusive) in downsampled coordinates
+        :param width: width of the downsampled image
+        :return: array of rows
+        '''
+
+        h = self.image.shape[0]
+        src_y1 = min(int(round(y1 * downsample)), h - 1)
+        src_y2 = max(min(int(round(y2 * downsample)), h), src_y1 + 1)
+
+        rows = np.asarray(self.image[src_y1:src_y2])
+        if rows.shape[1] == width and rows.shape[0] == y2 - y1:
+            return rows
+        return cv2.resize(rows, (width, y2 - y1), interpolation=cv2.INTER_AREA)
+
+    def get_preview(self, wh_dims):
+        '''
+        Returns a downsampled copy of the image, built a chunk of rows at a time so the full image is never loaded
+
+        :param wh_dims: dimensions of the preview (width, height)
+        :return: image
+        '''
+
+        w, h = wh_dims
+        downsample = self.image.shape[0] / h
+        step = max(1, int(ImageCreator.CHUNK_ROWS / downsample))
+
+        preview = np.empty((h, w, self.image.shape[2]), dtype=np.uint8)
+        for y in range(0, h, step):
+            y2 = min(y + step, h)
+            preview[y:y2] = self._read_downsampled_rows(downsample, y, y2, w).reshape(y2 - y, w, -1)
+        return preview
+
+    def save_tiled_tiff(self, path, tile_size=256, compression='deflate', min_level_size=1024):
+        '''
+        Saves the image as a tiled pyramidal tiff, halving the size each level until it fits within
+        `min_level_size`. Works a band of tiles at a time so the full image is never loaded
+
+        Each level is downsampled from the one before it rather than from the full image, so every level is only read
+        once. Levels that the next level is made from are kept until the tiff is written, in temporary memory mapped
+        files next to the image's if the image is memory mapped
+
+        :param path:
+        :param tile_size: see `write_tiled_tiff`
+        :param compression: see `write_tiled_tiff`
+        :param min_level_size: smallest level's largest side is at most this size
+        :return:
+        '''
+
+        if self.image.shape[2] != 3:
+            raise Exception('Only RGB images supported')
+
+        h, w = self.image.shape[:2]
+        sizes = [(w, h)]
+        while max(sizes[-1]) > min_level_size:
+            sizes.append((-(-sizes[-1][0] // 2), -(-sizes[-1][1] // 2)))
+
+        memmapped = isinstance(self.image, np.memmap)
+        if memmapped:
+            self.image.flush()
+        tmp_dir = tempfile.mkdtemp(dir=os.path.dirname(os.path.abspath(self.image.filename))) if memmapped else None
+
+        # level -> image of the level, for the levels the next level is made from. write_tiled_tiff writes the levels
+        # in order so each one is complete before the next is read from it
+        level_images = [self.image]
+        for i, (level_w, level_h) in enumerate(sizes[1:-1], 1):
+            if memmapped:
+                level_images.append(np.lib.format.open_memmap(os.path.join(tmp_dir, 'level_{}.npy'.format(i)),
+                                                              mode='w+', dtype=np.uint8, shape=(level_h, level_w, 3)))
+            else:
+                level_images.append(np.empty((level_h, level_w, 3), dtype=np.uint8))
+
+        def read_rows(y1, y2, level, level_w):
+            if level == 0:
+                rows = np.asarray(self.image[y1:y2])
+            else:
+                prev = level_images[level - 1]
+                rows = cv2.resize(np.asarray(prev[2 * y1:min(2 * y2, prev.shape[0])]), (level_w, y2 - y1),
+                                  interpolation=cv2.INTER_AREA).reshape(y2 - y1, level_w, 3)
+                if level < len(level_images):
+                    level_images[level][y1:y2] = rows
+
+            # image is BGR, tiffs are RGB
+            return rows[:, :, ::-1]
+
+        levels = [(level_w, level_h, functools.partial(read_rows, level=i, level_w=level_w))
+                  for i, (level_w, level_h) in enumerate(sizes)]
+
+        try:
+            write_tiled_tiff(path, levels, tile_size=tile_size, compression=compression)
+        finally:
+            del level_images[:]
+            if tmp_dir is not None:
+                shutil.rmtree(tmp_dir, ignore_errors=True)
+
     def add_borders(self, coordinates, color=(0, 255, 0), add_big_text=True):
         '''
         Adds colored borders onto the image at the coordinates. Default is bright green
@@ -55,38 +225,82 @@ class ImageCreator:
             # here to have matching numbering.
             add_big_text = len(coordinates) < 15
 
-        for idx, coordinate in enumerate(coordinates):
+        # adjust coordinates depending on if we want to scale our image
+        scaled_coordinates = [self._get_scaled_coordinate(coordinate) for coordinate in coordinates]
+
+        TileUtils.add_borders(self.image, scaled_coordinates, thickness=0.1, color=color)
+        # curr_slice = cv2.copyMakeBorder(curr_slice, 10, 10, 10, 10, cv2.BORDER_CONSTANT, value=(0,1,0))
 
-            # adjust coordinates depending on if we want to scale our image
-            x1_adj, y1_adj, x2_adj, y2_adj = self._get_scaled_coordinate(coordinate)
+        if not add_big_text:
+            return
 
-            curr_slice = self.image[y1_adj:y2_adj, x1_adj:x2_adj, :]
+        for idx, coordinate in enumerate(scaled_coordinates):
+            self._add_label(str(idx + 1), coordinate)
+
+    @staticmethod
+    def _get_label_sprite(text, scale_factor):
+        '''
+        Returns the text rendered at full resolution and then downsampled by the scale factor, as an alpha mask. Sprites
+        are cached so each label only ever gets rendered once per scale factor
+
+        :param text:
+        :param scale_factor:
+        :return: (alpha mask, (x offset, y offset) of the mask's top left corner from the text's bottom left corner)
+        '''
+
+        key = (text, scale_factor)
+        if key not in ImageCreator._label_sprites:
+            font = ImageCreator.LABEL_FONT
+            font_scale, thickness = ImageCreator.LABEL_FONT_SCALE, ImageCreator.LABEL_THICKNESS
+            (text_width, text_height), baseline = cv2.getTextSize(text, font, font_scale, thickness)
+
+            # render just the text's bounding box at full resolution
+            pad = thickness
+            mask = np.zeros((text_height + baseline + 2 * pad, text_width + 2 * pad), dtype=np.uint8)
+            cv2.putText(mask, text, (pad, pad + text_height), font, font_scale, 255, thickness)
+
+            # downsample to the canvas' scale. area interpolation gives the anti-aliased edges the old up/down
+            # resizing of the whole tile did
+            size = (max(1, int(round(mask.shape[1] / scale_factor))), max(1, int(round(mask.shape[0] / scale_factor))))
+            alpha = cv2.resize(mask, size, interpolation=cv2.INTER_AREA).astype(np.float32) / 255
+
+            offset = (int(round(-pad / scale_factor)), int(round(-(pad + text_height) / scale_factor)))
+            ImageCreator._label_sprites[key] = (alpha, offset)
+
+        return ImageCreator._label_sprites[key]
+
+    def _add_label(self, text, scaled_coordinate, color=(0, 0, 0)):
+        '''
+        Numbers a tile by blending its label sprite straight onto the canvas
+
+        :param text:
+        :param scaled_coordinate: coordinate of the tile on the canvas
+        :param color: BGR text color
+        :return:
+        '''
 
-            TileUtils.add_border(curr_slice, thickness=0.1, color=color)
-            # curr_slice = cv2.copyMakeBorder(curr_slice, 10, 10, 10, 10, cv2.BORDER_CONSTANT, value=(0,1,0))
+        x1, y1, x2, y2 = scaled_coordinate
 
-            if add_big_text:
-                # big black text
-                font_scale = 20
-                text_color = (0, 0, 0)
-                thickness = 40
+        # text's bottom left corner on the canvas
+        text_x = x1 + int(round(ImageCreator.LABEL_OFFSET[0] / self.scale_factor))
+        text_y = y2 - int(round(ImageCreator.LABEL_OFFSET[1] / self.scale_factor))
 
-                # in order for the text to be accurate irrespective of scale factor, we scale to original tile size
-                # and put text there before resizing back to previous.
-                # TODO: TUNED FOR SIZE 1024x1024. very slight loss of quality but the pros outweight cons
-                curr_slice = cv2.resize(curr_slice,
-                                        (curr_slice.shape[0] * self.scale_factor,
-                                         curr_slice.shape[1] * self.scale_factor))
+        if self.scale_factor == 1:
+            # already at full resolution. draw straight onto the tile
+            cv2.putText(self.image[y1:y2, x1:x2], text, (text_x - x1, text_y - y1), ImageCreator.LABEL_FONT,
+                        ImageCreator.LABEL_FONT_SCALE, color, ImageCreator.LABEL_THICKNESS)
+            return
 
-                bottom_left_corner_of_text = (40, curr_slice.shape[0] - 150)
+        alpha, (off_x, off_y) = ImageCreator._get_label_sprite(text, self.scale_factor)
 
-                TileUtils.add_text(curr_slice, str(idx + 1), bottom_left_corner_of_text=bottom_left_corner_of_text,
-                                   font_scale=font_scale, thickness=thickness, color=text_color)
-                curr_slice = cv2.resize(curr_slice,
-                                        (curr_slice.shape[0] // self.scale_factor,
-                                         curr_slice.shape[1] // self.scale_factor))
-                # import matplotlib.pyplot as plt
-                # plt.imshow(curr_slice)
-                # plt.show()
+        # part of the sprite that lands within the tile
+        sx1, sy1 = text_x + off_x, text_y + off_y
+        cx1, cy1 = max(sx1, x1, 0), max(sy1, y1, 0)
+        cx2 = min(sx1 + alpha.shape[1], x2, self.image.shape[1])
+        cy2 = min(sy1 + alpha.shape[0], y2, self.image.shape[0])
+        if cx1 >= cx2 or cy1 >= cy2:
+            return
 
-                self.image[y1_adj:y2_adj, x1_adj:x2_adj, :] = curr_slice
+        a = alpha[cy1 - sy1:cy2 - sy1, cx1 - sx1:cx2 - sx1, np.newaxis]
+        region = self.image[cy1:cy2, cx1:cx2]
+        region[:] = np.rint(region * (1 - a) + np.array(color, dtype=np.float32) * a)
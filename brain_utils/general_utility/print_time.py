@@ -1,20 +1,92 @@
+import os
+import json
 import time
 import logging
+import threading
+import collections
 
 
 class print_time:
+    '''
+    Logs how long the code within it took. Can be nested, in which case messages are indented by how deep they are
+
+    Every timed span is also kept (the most recent MAX_SPANS of them) so that they can be saved with `save_trace` and
+    viewed in chrome://tracing or Perfetto
+    '''
+
+    MAX_SPANS = 100000
+
+    # finished spans: dicts of name, start and duration (seconds since the epoch), depth, thread id
+    spans = collections.deque(maxlen=MAX_SPANS)
+
+    # each thread's stack of open spans
+    _local = threading.local()
+
     def __init__(self, obj=None, enter_msg=None, exit_msg=None):
         self.enter_msg = enter_msg if obj is None else "Starting to {}".format(obj)
         self.exit_msg = exit_msg if obj is None else "Successfully {}!".format(obj)
+        self.name = obj if obj is not None else (enter_msg or exit_msg or 'span')
+
+    @staticmethod
+    def _stack():
+        if not hasattr(print_time._local, 'stack'):
+            print_time._local.stack = []
+        return print_time._local.stack
 
     def __enter__(self):
-        logging.info(self.enter_msg)
-        self.time = time.time()
+        stack = print_time._stack()
+        self.depth = len(stack)
+        stack.append(self)
+
+        logging.info('  ' * self.depth + str(self.enter_msg))
+        self.wall_time = time.time()
+        self.time = time.perf_counter()
+        return self
 
     def __exit__(self, exc_type, exc_val, exc_tb):
-        tot = time.time() - self.time
+        tot = time.perf_counter() - self.time
+
+        stack = print_time._stack()
+        if self in stack:
+            stack.remove(self)
+
+        print_time.spans.append({
+            'name': str(self.name),
+            'start': self.wall_time,
+            'duration': tot,
+            'depth': self.depth,
+            'thread': threading.get_ident(),
+            'error': None if exc_type is None else exc_type.__name__,
+        })
+
         if tot >= 60:
-            res = '{} minutes and {} seconds'.format(int(int(tot) / 60), int(tot) % 60)
+            res = '{} minutes and {:0.1f} seconds'.format(int(tot // 60), tot % 60)
         else:
-            res = '{} seconds'.format(int(tot))
-        logging.info(self.exit_msg + ': ' + res)
+            res = '{:0.3f} seconds'.format(tot)
+        logging.info('  ' * self.depth + str(self.exit_msg) + ': ' + res)
+
+    @staticmethod
+    def save_trace(path, clear=False):
+        '''
+        Saves the kept spans as a chrome trace event file (json)
+
+        :param path:
+        :param clear: forget the saved spans
+        :return:
+        '''
+
+        events = [{
+            'name': span['name'],
+            'ph': 'X',
+            'ts': span['start'] * 1e6,
+            'dur': span['duration'] * 1e6,
+            'pid': os.getpid(),
+            'tid': span['thread'],
+            'args': {'depth': span['depth'], 'error': span['error']},
+        } for span in print_time.spans]
+
+        with open(path, 'w') as f:
+            json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, f)
+
+        if clear:
+            print_time.spans.clear()
@@ -1,7 +1,13 @@
+import os
 import pathlib
+import hashlib
+import tempfile
 from collections import namedtuple
 from PIL import Image
-import warnings
+
+from .slide_reader import (
+    SlideReader, read_tiff_ifds, TAG_IMAGE_WIDTH, TAG_IMAGE_LENGTH, TAG_COMPRESSION, TAG_IMAGE_DESCRIPTION
+)
 
 Image.MAX_IMAGE_PIXELS = 100000000000
 
@@ -11,13 +17,30 @@ class Slide:
     A slide object
     '''
 
+    # generated thumbnails are kept here so each one only ever gets made once per slide file
+    THUMBNAIL_CACHE_DIR = os.path.join(tempfile.gettempdir(), 'brain_utils_thumbnails')
+
+    # tiff compression tag value -> name
+    TIFF_COMPRESSIONS = {
+        1: 'Uncompressed', 5: 'LZW', 6: 'JPEG', 7: 'JPEG', 8: 'Deflate', 32946: 'Deflate', 33003: 'JPEG2000',
+        33005: 'JPEG2000', 34712: 'JPEG2000'
+    }
+
+    # tiff tags of the first image that the metadata is read from
+    HEADER_TAGS = (TAG_IMAGE_WIDTH, TAG_IMAGE_LENGTH, TAG_COMPRESSION, TAG_IMAGE_DESCRIPTION)
 
-    def __init__(self, path, img_requirements=None, stain_type='Unknown'):
+
+    def __init__(self, path, img_requirements=None, stain_type='Unknown', reader_cls=None):
         '''
         Creates a slide object with all possible data of the slide extracted
 
+        Only the file's header is read here. The slide's pixels are opened on first access of `image`/`reader` and
+        released with `close` (or by using the slide as a context manager) so that slides can be listed and checked
+        without keeping every file open
+
         :param path:
         :param img_requirements: dictionary of required svs configurations
+        :param reader_cls: SlideReader subclass used to read pixels from the slide. picks the best one if not given
         '''
 
         self.path = path
@@ -25,15 +48,17 @@ class Slide:
         self.image_type = pathlib.Path(path).suffix
         self.stain_type = stain_type
 
-        i = Image.open(path)
-        self.width, self.height = i.width, i.height
-        self.image = i
+        # opened on first access
+        self.reader_cls = reader_cls
+        self._image = None
+        self._reader = None
 
         Coordinate = namedtuple('Coordinate', 'x y')
         self.start_coordinate = Coordinate(0, 0)
 
         # get svs data if its an svs path
         curr_slide_data = self._extract_data(path)
+        self.width, self.height = curr_slide_data['width'], curr_slide_data['height']
         self.date_scanned = curr_slide_data['date_scanned']
         self.time_scanned = curr_slide_data['time_scanned']
         self.compression = curr_slide_data['compression']
@@ -41,6 +66,49 @@ class Slide:
         self.apparent_magnification = curr_slide_data['apparent_magnification']  # only here while in process of removal
 
 
+    @property
+    def image(self):
+        '''
+        PIL image of the slide, opened on first access
+        '''
+
+        if self._image is None:
+            self._image = Image.open(self.path)
+        return self._image
+
+
+    @property
+    def reader(self):
+        '''
+        Slide reader used for pixel access so that only the requested regions get decoded. Opened on first access
+        '''
+
+        if self._reader is None:
+            self._reader = SlideReader.open(self.path) if self.reader_cls is None else self.reader_cls(self.path)
+        return self._reader
+
+
+    def close(self):
+        '''
+        Releases any open file handles. They are reopened if the slide's pixels are accessed again
+        '''
+
+        if self._image is not None:
+            self._image.close()
+            self._image = None
+        if self._reader is not None:
+            self._reader.close()
+            self._reader = None
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
     def crop(self, coordinates):
         '''
         Updates internal slide properties so that we will only use a section of the slide
@@ -54,15 +122,59 @@ class Slide:
         self.height = coordinates[3] - coordinates[1]
 
 
-    def get_thumbnail(self, wh_dims):
+    def get_thumbnail(self, wh_dims, use_cache=True):
         '''
+        Returns a thumbnail of the (cropped) slide. Only as much of the slide as the thumbnail needs gets decoded:
+        jpegs are decoded at a reduced scale and tiffs are read from their smallest big enough pyramid level
+
+        Thumbnails are cached on disk, keyed by the slide file's path, modification time and size
 
         :param dims: dimensions of returned thumbnail (width, height)
+        :param use_cache: read/write the thumbnail from/to the cache in THUMBNAIL_CACHE_DIR
         :return:
         '''
 
-        warnings.warn('Please use thumbnail generated from heatmap for faster results')
-        return Image.open(self.path).resize(wh_dims)
+        wh_dims = tuple(int(d) for d in wh_dims)
+        box = (self.start_coordinate.x, self.start_coordinate.y,
+               self.start_coordinate.x + self.width, self.start_coordinate.y + self.height)
+
+        if not use_cache:
+            return Image.fromarray(self.reader.get_thumbnail(wh_dims, box=box))
+
+        stat = os.stat(self.path)
+        key = '{}|{}|{}|{}|{}'.format(os.path.abspath(self.path), stat.st_mtime_ns, stat.st_size, box, wh_dims)
+        cache_path = os.path.join(Slide.THUMBNAIL_CACHE_DIR, hashlib.sha1(key.encode()).hexdigest() + '.png')
+
+        if os.path.exists(cache_path):
+            try:
+                with Image.open(cache_path) as cached:
+                    cached.load()
+                    return cached
+            except OSError:
+                # partially written or corrupt. regenerate it
+                pass
+
+        thumb = Image.fromarray(self.reader.get_thumbnail(wh_dims, box=box))
+
+        # write to a temporary file first so that other processes never see a partial thumbnail
+        os.makedirs(Slide.THUMBNAIL_CACHE_DIR, exist_ok=True)
+        tmp_path = '{}.{}.tmp'.format(cache_path, os.getpid())
+        thumb.save(tmp_path, format='PNG')
+        os.replace(tmp_path, cache_path)
+
+        return thumb
+
+
+    def read_region(self, box, level=0):
+        '''
+        Reads a region of the slide without decoding the rest of it
+
+        :param box: (top_left_x, top_left_y, bot_right_x, bot_right_y) in the coordinates of the pyramid level
+        :param level: pyramid level. 0 is full resolution
+        :return: RGB numpy array
+        '''
+
+        return self.reader.read_region(box, level=level)
 
 
     def is_valid_img_file(self, img_requirements):
@@ -81,16 +193,55 @@ class Slide:
 
     def _extract_data(self, slide_path):
         '''
-        Extracts useful metadata from the svs
+        Extracts useful metadata from the svs. Only the file's header (tiff tags and aperio's image description) is
+        read. Non-tiffs only get their dimensions and format
 
         :param slide_path:
         :return:
         '''
 
-        return {
+        data = {
+            'width': None,
+            'height': None,
             'date_scanned': None,
             'time_scanned': None,
             'compression': None,
             'mpp': None,
             'apparent_magnification': None
         }
+
+        try:
+            with open(slide_path, 'rb') as f:
+                ifds = read_tiff_ifds(f, max_ifds=1, only_tags=Slide.HEADER_TAGS)
+        except Exception:
+            ifds = []
+
+        if not ifds:
+            # PIL only reads the header when opening
+            with Image.open(slide_path) as i:
+                data['width'], data['height'] = i.width, i.height
+                data['compression'] = i.format
+            return data
+
+        ifd = ifds[0]
+        data['width'], data['height'] = ifd[TAG_IMAGE_WIDTH], ifd[TAG_IMAGE_LENGTH]
+        compression = ifd.get(TAG_COMPRESSION, 1)
+        data['compression'] = Slide.TIFF_COMPRESSIONS.get(compression, compression)
+
+        # aperio: 'Aperio Image Library v10.0.51\r\n46920x33014 [...] JPEG/RGB Q=30|AppMag = 20|...|MPP = 0.4990|...'
+        description = ifd.get(TAG_IMAGE_DESCRIPTION, b'').decode('latin-1').strip('\0')
+        fields = {}
+        for field in description.split('|')[1:]:
+            if ' = ' in field:
+                key, value = field.split(' = ', 1)
+                fields[key.strip()] = value.strip()
+
+        data['date_scanned'] = fields.get('Date')
+        data['time_scanned'] = fields.get('Time')
+        for key, name in (('MPP', 'mpp'), ('AppMag', 'apparent_magnification')):
+            try:
+                data[name] = float(fields[key])
+            except (KeyError, ValueError):
+                pass
+
+        return data
@@ -0,0 +1,582 @@
+import io
+import struct
+import zlib
+import collections
+import numpy as np
+from PIL import Image
+
+Image.MAX_IMAGE_PIXELS = 100000000000
+
+
+# tiff field type -> struct format of a single value
+TIFF_TYPES = {
+    1: 'B', 2: 's', 3: 'H', 4: 'I', 5: 'II', 6: 'b', 7: 's', 8: 'h', 9: 'i', 10: 'ii', 11: 'f', 12: 'd', 13: 'I',
+    16: 'Q', 17: 'q', 18: 'Q'
+}
+
+# tiff tags we care about
+TAG_NEW_SUBFILE_TYPE = 254
+TAG_IMAGE_WIDTH = 256
+TAG_IMAGE_LENGTH = 257
+TAG_BITS_PER_SAMPLE = 258
+TAG_COMPRESSION = 259
+TAG_PHOTOMETRIC = 262
+TAG_IMAGE_DESCRIPTION = 270
+TAG_STRIP_OFFSETS = 273
+TAG_SAMPLES_PER_PIXEL = 277
+TAG_ROWS_PER_STRIP = 278
+TAG_STRIP_BYTE_COUNTS = 279
+TAG_PLANAR_CONFIG = 284
+TAG_PREDICTOR = 317
+TAG_TILE_WIDTH = 322
+TAG_TILE_LENGTH = 323
+TAG_TILE_OFFSETS = 324
+TAG_TILE_BYTE_COUNTS = 325
+TAG_JPEG_TABLES = 347
+
+# new subfile type bit of transparency masks
+SUBFILE_MASK = 4
+
+COMPRESSION_NONE = 1
+COMPRESSION_JPEG = 7
+COMPRESSION_DEFLATE = (8, 32946)
+PHOTOMETRIC_RGB = 2
+
+
+def read_tiff_ifds(f, max_ifds=None, only_tags=None):
+    '''
+    Reads the tags of every image file directory (IFD) in a classic or big tiff without reading any pixel data
+
+    :param f: file opened in binary mode
+    :param max_ifds: stop after this many IFDs
+    :param only_tags: only read the values of these tags. the others (ie the tile offsets of large slides, which can
+    have 100k+ values) are skipped without being read
+    :return: list of dicts of tag -> value. values with a single element are unpacked, byte/ascii values are bytes
+    '''
+
+    f.seek(0)
+    header = f.read(16)
+    if header[:2] == b'II':
+        bo = '<'
+    elif header[:2] == b'MM':
+        bo = '>'
+    else:
+        raise Exception('Not a tiff file')
+
+    version = struct.unpack(bo + 'H', header[2:4])[0]
+    # formats of the number of entries in an ifd, offsets and value counts. big tiffs use 8 bytes for all of them
+    if version == 42:
+        n_fmt, offset_fmt, entry_size = 'H', 'I', 12
+        ifd_offset = struct.unpack(bo + 'I', header[4:8])[0]
+    elif version == 43:
+        n_fmt, offset_fmt, entry_size = 'Q', 'Q', 20
+        ifd_offset = struct.unpack(bo + 'Q', header[8:16])[0]
+    else:
+        raise Exception('Not a tiff file')
+
+    n_size = struct.calcsize(n_fmt)
+    # value counts are the same size as offsets, as are values small enough to be stored inline
+    offset_size = inline_size = count_size = struct.calcsize(offset_fmt)
+
+    ifds = []
+    seen = set()
+    while ifd_offset and ifd_offset not in seen and (max_ifds is None or len(ifds) < max_ifds):
+        seen.add(ifd_offset)
+
+        f.seek(ifd_offset)
+        n = struct.unpack(bo + n_fmt, f.read(n_size))[0]
+        entries = f.read(n * entry_size)
+        next_offset = struct.unpack(bo + offset_fmt, f.read(offset_size))[0]
+
+        tags = {}
+        for i in range(n):
+            entry = entries[i * entry_size:(i + 1) * entry_size]
+            tag, typ = struct.unpack(bo + 'HH', entry[:4])
+            count = struct.unpack(bo + offset_fmt, entry[4:4 + count_size])[0]
+
+            if typ not in TIFF_TYPES or (only_tags is not None and tag not in only_tags):
+                continue
+
+            fmt = TIFF_TYPES[typ]
+            size = struct.calcsize(fmt) * count
+            if size <= inline_size:
+                data = entry[4 + count_size:4 + count_size + size]
+            else:
+                value_offset = struct.unpack(bo + offset_fmt, entry[4 + count_size:])[0]
+                pos = f.tell()
+                f.seek(value_offset)
+                data = f.read(size)
+                f.seek(pos)
+
+            if fmt == 's':
+                tags[tag] = data
+            elif len(fmt) == 1:
+                # offsets/byte counts can have 100k+ values so let numpy do the unpacking
+                values = np.frombuffer(data, dtype=np.dtype(bo + fmt))
+                tags[tag] = values[0].item() if count == 1 else values
+            else:
+                # rationals
+                values = np.frombuffer(data, dtype=np.dtype(bo + fmt[0])).reshape(-1, 2)
+                values = values[:, 0] / np.maximum(values[:, 1], 1)
+                tags[tag] = values[0].item() if count == 1 else values
+
+        ifds.append(tags)
+        ifd_offset = next_offset
+
+    return ifds
+
+
+class SlideReader:
+    '''
+    Reads pixel regions out of a slide. Backends only need to decode the parts of the slide that overlap the region
+
+    Levels are successively downsampled versions of the slide (a pyramid), level 0 being the full resolution image
+    '''
+
+
+    def __init__(self, path):
+        self.path = path
+        # (width, height) of each level
+        self.level_dimensions = []
+
+
+    @staticmethod
+    def open(path):
+        '''
+        Opens the slide with the best backend available for it
+
+        :param path:
+        :return: slide reader
+        '''
+
+        if TiffSlideReader.is_supported(path):
+            return TiffSlideReader(path)
+        return PILSlideReader(path)
+
+
+    @property
+    def width(self):
+        return self.level_dimensions[0][0]
+
+
+    @property
+    def height(self):
+        return self.level_dimensions[0][1]
+
+
+    @property
+    def level_count(self):
+        return len(self.level_dimensions)
+
+
+    @property
+    def level_downsamples(self):
+        return [self.width / w for w, h in self.level_dimensions]
+
+
+    def get_best_level_for_downsample(self, downsample):
+        '''
+        Returns the smallest level that is still at least as detailed as the given downsample of the full resolution
+        image. Level dimensions are rounded so a small tolerance is given
+
+        :param downsample: desired downsample factor relative to level 0
+        :return: level
+        '''
+
+        level = 0
+        for i, d in enumerate(self.level_downsamples):
+            if d <= downsample * 1.01:
+                level = i
+        return level
+
+
+    def read_region(self, box, level=0):
+        '''
+        Reads a region of the slide. Areas of the region outside of the slide are black
+
+        :param box: (top_left_x, top_left_y, bot_right_x, bot_right_y) in the coordinates of the level
+        :param level:
+        :return: RGB numpy array
+        '''
+
+        raise NotImplementedError
+
+
+    def get_thumbnail(self, wh_dims, box=None, resample=Image.BILINEAR):
+        '''
+        Returns a downsampled version of (a region of) the slide, read from the smallest level that is still at least
+        as large as the requested dimensions
+
+        :param wh_dims: dimensions of returned thumbnail (width, height)
+        :param box: region of the level 0 slide to make the thumbnail of. defaults to the whole slide
+        :param resample: PIL resampling filter
+        :return: RGB numpy array
+        '''
+
+        if box is None:
+            box = (0, 0, self.width, self.height)
+
+        level = self._get_thumbnail_level(wh_dims, box)
+        d = self.level_downsamples[level]
+        region = self.read_region(tuple(int(round(c / d)) for c in box), level=level)
+        return np.array(Image.fromarray(region).resize(tuple(wh_dims), resample))
+
+
+    def _get_thumbnail_level(self, wh_dims, box):
+        '''
+        Returns the smallest level which doesn't need upsampling to make a thumbnail of the box
+        '''
+
+        level = 0
+        for i, d in enumerate(self.level_downsamples):
+            if (box[2] - box[0]) / d >= wh_dims[0] and (box[3] - box[1]) / d >= wh_dims[1]:
+                level = i
+        return level
+
+
+    def close(self):
+        pass
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+class PILSlideReader(SlideReader):
+    '''
+    Reads slides through PIL. Works for any format PIL can open but PIL decodes the whole image on first access
+
+    Jpegs can be decoded at 1/2, 1/4 and 1/8 scale which are exposed as levels
+    '''
+
+    JPEG_DRAFT_SCALES = (2, 4, 8)
+
+
+    def __init__(self, path):
+        super().__init__(path)
+        self.image = Image.open(path)
+        self.level_dimensions = [self.image.size]
+        # level -> size passed to `draft` to decode it
+        self._draft_sizes = {}
+
+        if self.image.format == 'JPEG':
+            w, h = self.image.size
+            for k in PILSlideReader.JPEG_DRAFT_SCALES:
+                if w // k < 1 or h // k < 1:
+                    break
+
+                # the decoder rounds odd sizes up, so the level is whatever size draft actually gives. draft only
+                # reads the header
+                with Image.open(path) as image:
+                    image.draft('RGB', (w // k, h // k))
+                    size = image.size
+
+                if size != self.level_dimensions[-1]:
+                    self._draft_sizes[len(self.level_dimensions)] = (w // k, h // k)
+                    self.level_dimensions.append(size)
+
+        # level -> reduced scale image handle
+        self._level_images = {0: self.image}
+
+
+    def _get_level_image(self, level):
+        if level not in self._level_images:
+            image = Image.open(self.path)
+            image.draft('RGB', self._draft_sizes[level])
+            self._level_images[level] = image
+        return self._level_images[level]
+
+
+    def read_region(self, box, level=0):
+        region = self._get_level_image(level).crop(box)
+        if region.mode not in ('RGB', 'RGBA'):
+            region = region.convert('RGB')
+        return np.array(region)[:, :, :3]
+
+
+    def get_thumbnail(self, wh_dims, box=None, resample=Image.BILINEAR):
+        if box is None:
+            box = (0, 0, self.width, self.height)
+
+        # separate handle so that our own image is left untouched. jpegs can then be decoded at a reduced scale
+        # rather than at full resolution, as long as the box still has at least the thumbnail's pixels
+        x1, y1, x2, y2 = box
+        image = Image.open(self.path)
+        image.draft('RGB', (-(-wh_dims[0] * self.width // (x2 - x1)), -(-wh_dims[1] * self.height // (y2 - y1))))
+        # each side is rounded on its own
+        sx, sy = image.width / self.width, image.height / self.height
+
+        thumb = image.resize(tuple(wh_dims), resample, box=(x1 * sx, y1 * sy, x2 * sx, y2 * sy))
+        if thumb.mode != 'RGB':
+            thumb = thumb.convert('RGB')
+        image.close()
+        return np.array(thumb)
+
+
+    def close(self):
+        for image in self._level_images.values():
+            image.close()
+        self._level_images = {}
+
+
+class TiffSlideReader(SlideReader):
+    '''
+    Pure python/numpy reader for tiled or stripped tiffs (including svs). Only the tiles/strips overlapping a region
+    are read and decoded, and recently decoded ones are kept in a small cache
+
+    Supports 8 bit RGB(A) images that are uncompressed, deflate or jpeg compressed. Any other smaller image in the tiff
+    with the same aspect ratio as the full resolution image (and tiled, if it is) is used as a pyramid level
+    '''
+
+    DEFAULT_CACHE_BYTES = 128 * 1024 * 1024
+
+
+    def __init__(self, path, cache_bytes=DEFAULT_CACHE_BYTES):
+        super().__init__(path)
+
+        self._file = open(path, 'rb')
+        ifds = read_tiff_ifds(self._file)
+
+        if not TiffSlideReader._is_supported_ifd(ifds[0]):
+            self._file.close()
+            raise Exception('Unsupported tiff layout for {}'.format(path))
+
+        self.ifds = ifds
+
+        # base image plus any smaller supported images with a matching aspect ratio, largest to smallest. they can be
+        # in any order in the file (svs: base, thumbnail, pyramid levels, label, macro). with a tiled base image,
+        # stripped images are thumbnails/labels/macros rather than pyramid levels. masks are never levels
+        base_w, base_h = ifds[0][TAG_IMAGE_WIDTH], ifds[0][TAG_IMAGE_LENGTH]
+        base_tiled = TAG_TILE_OFFSETS in ifds[0]
+        levels = {}
+        for ifd in ifds[1:]:
+            if not TiffSlideReader._is_supported_ifd(ifd) or ifd.get(TAG_NEW_SUBFILE_TYPE, 0) & SUBFILE_MASK:
+                continue
+            if base_tiled and TAG_TILE_OFFSETS not in ifd:
+                continue
+            w, h = ifd[TAG_IMAGE_WIDTH], ifd[TAG_IMAGE_LENGTH]
+            if w < base_w and abs((base_w / w) / (base_h / h) - 1) < 0.02:
+                # first image of each width
+                levels.setdefault(w, ifd)
+        self._level_ifds = [ifds[0]] + [levels[w] for w in sorted(levels, reverse=True)]
+
+        self.level_dimensions = [(ifd[TAG_IMAGE_WIDTH], ifd[TAG_IMAGE_LENGTH]) for ifd in self._level_ifds]
+
+        self._cache = collections.OrderedDict()
+        self._cache_bytes = 0
+        self.max_cache_bytes = cache_bytes
+
+
+    @staticmethod
+    def _is_supported_ifd(ifd):
+        bps = ifd.get(TAG_BITS_PER_SAMPLE, 1)
+        if np.ndim(bps) > 0:
+            if len(set(bps)) != 1:
+                return False
+            bps = bps[0]
+
+        compression = ifd.get(TAG_COMPRESSION, COMPRESSION_NONE)
+        photometric = ifd.get(TAG_PHOTOMETRIC)
+
+        return (TAG_IMAGE_WIDTH in ifd and TAG_IMAGE_LENGTH in ifd and bps == 8
+                and ifd.get(TAG_SAMPLES_PER_PIXEL, 1) in (3, 4) and ifd.get(TAG_PLANAR_CONFIG, 1) == 1
+                and ((TAG_TILE_OFFSETS in ifd and TAG_TILE_WIDTH in ifd) or TAG_STRIP_OFFSETS in ifd)
+                and (compression == COMPRESSION_JPEG
+                     or (compression in (COMPRESSION_NONE,) + COMPRESSION_DEFLATE and photometric == PHOTOMETRIC_RGB)))
+
+
+    @staticmethod
+    def is_supported(path):
+        '''
+        Returns true if the file is a tiff whose full resolution image this reader can decode
+        '''
+
+        try:
+            with open(path, 'rb') as f:
+                ifds = read_tiff_ifds(f, max_ifds=1)
+        except Exception:
+            return False
+        return len(ifds) > 0 and TiffSlideReader._is_supported_ifd(ifds[0])
+
+
+    @staticmethod
+    def _get_layout(ifd):
+        '''
+        Returns (block width, block height, offsets, byte counts). strips are treated as tiles spanning the full width
+        '''
+
+        if TAG_TILE_OFFSETS in ifd:
+            bw, bh = ifd[TAG_TILE_WIDTH], ifd[TAG_TILE_LENGTH]
+            offsets, counts = ifd[TAG_TILE_OFFSETS], ifd[TAG_TILE_BYTE_COUNTS]
+        else:
+            bw = ifd[TAG_IMAGE_WIDTH]
+            bh = min(ifd.get(TAG_ROWS_PER_STRIP, ifd[TAG_IMAGE_LENGTH]), ifd[TAG_IMAGE_LENGTH])
+            offsets, counts = ifd[TAG_STRIP_OFFSETS], ifd[TAG_STRIP_BYTE_COUNTS]
+
+        return bw, bh, np.atleast_1d(offsets), np.atleast_1d(counts)
+
+
+    def _decode_block(self, ifd, data, bw, bh, scale=1):
+        '''
+        Decodes the raw bytes of a tile/strip into an RGB numpy array. Jpeg blocks can be decoded at 1/2, 1/4 or 1/8
+        scale, which is a lot faster than decoding them at full size
+        '''
+
+        compression = ifd.get(TAG_COMPRESSION, COMPRESSION_NONE)
+        spp = ifd.get(TAG_SAMPLES_PER_PIXEL, 1)
+
+        if compression == COMPRESSION_JPEG:
+            tables = ifd.get(TAG_JPEG_TABLES)
+            if tables is not None and len(tables) > 4:
+                # abbreviated stream. tables without their end of image marker + data without its start of image marker
+                data = tables[:-2] + data[2:]
+
+            image = Image.open(io.BytesIO(data))
+            if scale > 1:
+                image.draft(image.mode, (bw // scale, bh // scale))
+            if ifd.get(TAG_PHOTOMETRIC) == PHOTOMETRIC_RGB:
+                # (aperio) data is stored as rgb rather than ycbcr. stop the decoder from doing a color conversion
+                decoder, extents, offset, args = image.tile[0][:4]
+                image.tile = [(decoder, extents, offset, (args[0], 'RGB'))]
+            block = np.array(image.convert('RGB') if image.mode != 'RGB' else image)
+
+        else:
+            if compression in COMPRESSION_DEFLATE:
+                data = zlib.decompress(data)
+
+            block = np.frombuffer(data, dtype=np.uint8)
+            rows = min(len(block) // (bw * spp), bh)
+            block = block[:rows * bw * spp].reshape(rows, bw, spp)
+
+            if ifd.get(TAG_PREDICTOR, 1) == 2:
+                # horizontal differencing. uint8 cumsum wraps around the same way the differences did
+                block = np.cumsum(block, axis=1, dtype=np.uint8)
+
+            block = block[:, :, :3]
+
+        return block
+
+
+    def _get_block(self, level, index, step=1):
+        '''
+        Returns a tile/strip of a level. With a step, only every step'th row and column of the level is kept (counting
+        from the level's top left corner, so steps line up across blocks). Jpeg blocks are decoded at a reduced scale
+        to get most of the way there
+
+        :param level:
+        :param index: index of the block in the level
+        :param step: reduction factor
+        :return: RGB numpy array
+        '''
+
+        key = (level, index, step)
+        if key in self._cache:
+            self._cache.move_to_end(key)
+            return self._cache[key]
+
+        ifd = self._level_ifds[level]
+        bw, bh, offsets, counts = self._get_layout(ifd)
+        blocks_across = -(-ifd[TAG_IMAGE_WIDTH] // bw)
+        ox, oy = (index % blocks_across) * bw, (index // blocks_across) * bh
+
+        # largest jpeg decoding scale that keeps the block aligned with the step
+        scale = 1
+        if ifd.get(TAG_COMPRESSION, COMPRESSION_NONE) == COMPRESSION_JPEG:
+            scale = max(s for s in (1, 2, 4, 8) if step % s == 0 and bw % s == 0 and bh % s == 0)
+
+        if counts[index] == 0:
+            # sparse file. missing blocks are empty
+            scale = 1
+            block = np.zeros((bh, bw, 3), dtype=np.uint8)
+        else:
+            self._file.seek(int(offsets[index]))
+            block = self._decode_block(ifd, self._file.read(int(counts[index])), bw, bh, scale=scale)
+            # the decoder may reduce by less than asked (ie a short last strip). blocks always span their full width
+            # (unlike their height) so the width gives the scale it used
+            scale = bw // block.shape[1]
+
+        # subsample whatever the decoder didn't reduce
+        r = step // scale
+        if r > 1:
+            # copy so that the cache doesn't hold on to the full block
+            block = np.ascontiguousarray(block[(-(oy // scale)) % r::r, (-(ox // scale)) % r::r])
+
+        self._cache[key] = block
+        self._cache_bytes += block.nbytes
+        while self._cache_bytes > self.max_cache_bytes and len(self._cache) > 1:
+            _, evicted = self._cache.popitem(last=False)
+            self._cache_bytes -= evicted.nbytes
+
+        return block
+
+
+    def read_region(self, box, level=0):
+        return self._read_region(box, level, 1)
+
+
+    def _read_region(self, box, level, step):
+        '''
+        Reads a region of a level reduced by a step (see `_get_block`)
+
+        :param box: region in the coordinates of the reduced level
+        :param level:
+        :param step:
+        :return: RGB numpy array
+        '''
+
+        x1, y1, x2, y2 = (int(c) for c in box)
+        out = np.zeros((y2 - y1, x2 - x1, 3), dtype=np.uint8)
+
+        w, h = self.level_dimensions[level]
+        bw, bh, _, _ = self._get_layout(self._level_ifds[level])
+        blocks_across = -(-w // bw)
+
+        # part of the region that is within the (reduced) image
+        cx1, cy1, cx2, cy2 = max(x1, 0), max(y1, 0), min(x2, -(-w // step)), min(y2, -(-h // step))
+        if cx1 >= cx2 or cy1 >= cy2:
+            return out
+
+        for by in range(cy1 * step // bh, (cy2 - 1) * step // bh + 1):
+            for bx in range(cx1 * step // bw, (cx2 - 1) * step // bw + 1):
+                block = self._get_block(level, by * blocks_across + bx, step)
+
+                # intersection of the block with the region, in reduced image coordinates
+                ox, oy = -(-bx * bw // step), -(-by * bh // step)
+                ix1, iy1 = max(cx1, ox), max(cy1, oy)
+                ix2, iy2 = min(cx2, ox + block.shape[1]), min(cy2, oy + block.shape[0])
+                if ix1 >= ix2 or iy1 >= iy2:
+                    continue
+
+                out[iy1 - y1:iy2 - y1, ix1 - x1:ix2 - x1] = block[iy1 - oy:iy2 - oy, ix1 - ox:ix2 - ox]
+
+        return out
+
+
+    def get_thumbnail(self, wh_dims, box=None, resample=Image.BILINEAR):
+        if box is None:
+            box = (0, 0, self.width, self.height)
+
+        level = self._get_thumbnail_level(wh_dims, box)
+        d = self.level_downsamples[level]
+        x1, y1, x2, y2 = (c / d for c in box)
+
+        # without a level close to the thumbnail's size, don't build the full level just to throw most of it away.
+        # keep every step'th pixel as blocks are decoded, while still having at least as many pixels as the thumbnail
+        ratio = min((x2 - x1) / wh_dims[0], (y2 - y1) / wh_dims[1])
+        step = 1
+        while step * 2 <= ratio:
+            step *= 2
+
+        region = self._read_region((int(round(x1 / step)), int(round(y1 / step)),
+                                    int(round(x2 / step)), int(round(y2 / step))), level, step)
+        return np.array(Image.fromarray(region).resize(tuple(wh_dims), resample))
+
+
+    def close(self):
+        self._file.close()
+        self._cache.clear()
+        self._cache_bytes = 0
@@ -0,0 +1,133 @@
+import io
+import struct
+import zlib
+import numpy as np
+from PIL import Image
+
+from .slide_reader import (
+    TAG_NEW_SUBFILE_TYPE, TAG_IMAGE_WIDTH, TAG_IMAGE_LENGTH, TAG_BITS_PER_SAMPLE, TAG_COMPRESSION, TAG_PHOTOMETRIC,
+    TAG_SAMPLES_PER_PIXEL, TAG_PLANAR_CONFIG, TAG_TILE_WIDTH, TAG_TILE_LENGTH, TAG_TILE_OFFSETS, TAG_TILE_BYTE_COUNTS,
+    COMPRESSION_NONE, COMPRESSION_JPEG, COMPRESSION_DEFLATE, PHOTOMETRIC_RGB
+)
+
+PHOTOMETRIC_YCBCR = 6
+
+COMPRESSIONS = {
+    None: COMPRESSION_NONE,
+    'deflate': COMPRESSION_DEFLATE[0],
+    'jpeg': COMPRESSION_JPEG,
+}
+
+# classic tiffs can't point past 4GB
+CLASSIC_TIFF_MAX_BYTES = 2 ** 32 - 1
+
+
+def _encode_tile(tile, compression, jpeg_quality):
+    if compression is None:
+        return tile.tobytes()
+    elif compression == 'deflate':
+        return zlib.compress(tile.tobytes(), 6)
+    else:
+        buf = io.BytesIO()
+        Image.fromarray(tile).save(buf, format='JPEG', quality=jpeg_quality)
+        return buf.getvalue()
+
+
+def write_tiled_tiff(path, levels, tile_size=256, compression='deflate', jpeg_quality=90):
+    '''
+    Writes a tiled, pyramidal RGB tiff one band of tiles at a time so that no level ever has to be fully in memory.
+    The result can be read back with `TiffSlideReader` (and most slide viewers)
+
+    :param path:
+    :param levels: list of (width, height, read_rows) for each level, largest first. read_rows(y1, y2) returns
+    rows y1 to y2 of the level as an RGB uint8 array
+    :param tile_size: must be a multiple of 16
+    :param compression: None, 'deflate' or 'jpeg'
+    :param jpeg_quality:
+    :return:
+    '''
+
+    if compression not in COMPRESSIONS:
+        raise Exception('Compression must be one of {}'.format(list(COMPRESSIONS)))
+
+    if tile_size % 16:
+        raise Exception('Tile size must be a multiple of 16')
+
+    # worst case size decides if we need a big tiff
+    raw_bytes = sum(w * h * 3 for w, h, _ in levels)
+    bigtiff = raw_bytes * 1.1 + 1024 * len(levels) > CLASSIC_TIFF_MAX_BYTES
+
+    bo = '<'
+    offset_fmt, n_fmt, entry_size = ('Q', 'Q', 20) if bigtiff else ('I', 'H', 12)
+    offset_size = struct.calcsize(offset_fmt)
+
+    with open(path, 'wb') as f:
+        if bigtiff:
+            f.write(b'II' + struct.pack(bo + 'HHHQ', 43, 8, 0, 0))
+        else:
+            f.write(b'II' + struct.pack(bo + 'HI', 42, 0))
+        # where the offset of the next ifd needs to be written
+        next_ifd_pointer = f.tell() - offset_size
+
+        for i, (w, h, read_rows) in enumerate(levels):
+
+            # tile data, band by band
+            offsets, counts = [], []
+            for y in range(0, h, tile_size):
+                rows = np.asarray(read_rows(y, min(y + tile_size, h)), dtype=np.uint8)
+                for x in range(0, w, tile_size):
+                    tile = np.zeros((tile_size, tile_size, 3), dtype=np.uint8)
+                    part = rows[:, x:x + tile_size, :3]
+                    tile[:part.shape[0], :part.shape[1]] = part
+
+                    data = _encode_tile(tile, compression, jpeg_quality)
+                    offsets.append(f.tell())
+                    counts.append(len(data))
+                    f.write(data)
+
+            if f.tell() % 2:
+                f.write(b'\0')
+
+            # (tag, type, values). types: 3 short, 4 long, 16 long8
+            long_type = 16 if bigtiff else 4
+            photometric = PHOTOMETRIC_YCBCR if compression == 'jpeg' else PHOTOMETRIC_RGB
+            entries = [
+                (TAG_NEW_SUBFILE_TYPE, 4, [0 if i == 0 else 1]),
+                (TAG_IMAGE_WIDTH, 4, [w]),
+                (TAG_IMAGE_LENGTH, 4, [h]),
+                (TAG_BITS_PER_SAMPLE, 3, [8, 8, 8]),
+                (TAG_COMPRESSION, 3, [COMPRESSIONS[compression]]),
+                (TAG_PHOTOMETRIC, 3, [photometric]),
+                (TAG_SAMPLES_PER_PIXEL, 3, [3]),
+                (TAG_PLANAR_CONFIG, 3, [1]),
+                (TAG_TILE_WIDTH, 3, [tile_size]),
+                (TAG_TILE_LENGTH, 3, [tile_size]),
+                (TAG_TILE_OFFSETS, long_type, offsets),
+                (TAG_TILE_BYTE_COUNTS, long_type, counts),
+            ]
+
+            # values too big to fit inside the ifd entry go before the ifd
+            value_offsets = {}
+            for tag, typ, values in entries:
+                data = np.array(values, dtype=bo + {3: 'u2', 4: 'u4', 16: 'u8'}[typ]).tobytes()
+                if len(data) > offset_size:
+                    value_offsets[tag] = f.tell()
+                    f.write(data)
+                    if f.tell() % 2:
+                        f.write(b'\0')
+
+            ifd_offset = f.tell()
+            f.write(struct.pack(bo + n_fmt, len(entries)))
+            for tag, typ, values in entries:
+                data = np.array(values, dtype=bo + {3: 'u2', 4: 'u4', 16: 'u8'}[typ]).tobytes()
+                if tag in value_offsets:
+                    data = struct.pack(bo + offset_fmt, value_offsets[tag])
+                f.write(struct.pack(bo + 'HH' + offset_fmt, tag, typ, len(values)) + data.ljust(offset_size, b'\0'))
+            f.write(struct.pack(bo + offset_fmt, 0))
+
+            # link the previous ifd (or the header) to this one
+            end = f.tell()
+            f.seek(next_ifd_pointer)
+            f.write(struct.pack(bo + offset_fmt, ifd_offset))
+            f.seek(end)
+            next_ifd_pointer = end - offset_size
@@ -141,6 +141,23 @@ class TileUtils:
 
         return new
 
+    @staticmethod
+    def _border_slices(h, w, thickness):
+        '''
+        Returns the slices of an h x w image that make up its border
+
+        :param h:
+        :param w:
+        :param thickness: border thickness
+        :return: list of slices
+        '''
+
+        pixel_len = min(int(w * thickness), int(h * thickness))
+
+        # first and last rows get colored entirely (note: bottom rows are measured off of the width), then the leftmost
+        # and rightmost columns of every row
+        return [np.s_[:pixel_len + 1], np.s_[max(w - pixel_len, 0):], np.s_[:, :pixel_len], np.s_[:, (w - pixel_len):]]
+
     @staticmethod
     def add_border(a, thickness=0.05, color=(0, 0, 0)):
         '''
@@ -159,21 +176,40 @@ class TileUtils:
         if c != 3:
             raise Exception('Only RGB images supported')
 
-        pixel_len = min(int(w * thickness), int(h * thickness))
+        for border_slice in TileUtils._border_slices(h, w, thickness):
+            a[border_slice] = color
+
+    @staticmethod
+    def add_borders(img, coordinates, thickness=0.05, color=(0, 0, 0)):
+        '''
+        Adds a border around each of the coordinates' regions within the image. Same as calling `add_border` on each
+        region, except border slices are only worked out once per region size
+
+        :param img: the matrix image
+        :param coordinates: list of (top_left_x, top_left_y, bot_right_x, bot_right_y)
+        :param thickness: border thickness
+        :return:
+        '''
+
+        if img.shape[2] != 3:
+            raise Exception('Only RGB images supported')
+
+        # (h, w) -> border slices
+        slices = {}
+
+        for x1, y1, x2, y2 in coordinates:
+            region = img[y1:y2, x1:x2]
+            h, w = region.shape[:2]
+
+            # see add_border
+            if h == 0:
+                continue
+
+            if (h, w) not in slices:
+                slices[(h, w)] = TileUtils._border_slices(h, w, thickness)
 
-        # for each row in the image
-        for j in range(h):
-            # if we are in first 5% or last% of rows, we color the whole row
-            if j <= pixel_len or j >= w - pixel_len:
-                # color entire row
-                for i in range(3):
-                    a[j, :, i] = color[i]
-            else:
-
-                # color the leftmost and rightmost 5% of the row
-                for i in range(3):
-                    a[j, :pixel_len, i] = color[i]
-                    a[j, (w - pixel_len):, i] = color[i]
+            for border_slice in slices[(h, w)]:
+                region[border_slice] = color
 
     @staticmethod
     def add_text(a, text, bottom_left_corner_of_text, color=(0, 0, 0), font_scale=1, thickness=2):
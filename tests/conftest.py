@@ -0,0 +1,107 @@
+import struct
+
+import numpy as np
+import cv2
+import pytest
+from PIL import Image
+
+
+def make_tissue(width, height, seed=0):
+    '''
+    Returns a synthetic RGB slide: pink/purple blobs of noisy tissue on a white background
+    '''
+
+    rng = np.random.RandomState(seed)
+    image = np.full((height, width, 3), 245, dtype=np.uint8)
+
+    for _ in range(max(4, width * height // 40000)):
+        x, y = rng.randint(0, width), rng.randint(0, height)
+        axes = (int(rng.randint(20, max(21, width // 4))), int(rng.randint(20, max(21, height // 4))))
+        color = tuple(int(c) for c in rng.randint(60, 220, 3))
+        cv2.ellipse(image, (x, y), axes, int(rng.randint(0, 180)), 0, 360, color, -1)
+
+    # the same on every channel so the background stays blank
+    noise = rng.randint(-20, 21, image.shape[:2] + (1,))
+    return np.clip(image.astype(np.int16) + noise, 0, 255).astype(np.uint8)
+
+
+@pytest.fixture
+def tissue():
+    return make_tissue
+
+
+@pytest.fixture
+def jpeg_path(tmp_path):
+    '''
+    Factory writing a synthetic jpeg slide of the given size
+    '''
+
+    def make(width, height, name='slide.jpg', seed=0):
+        path = str(tmp_path / name)
+        Image.fromarray(make_tissue(width, height, seed)).save(path, quality=95)
+        return path
+
+    return make
+
+
+@pytest.fixture
+def write_tiff():
+    return _write_tiff
+
+
+def _write_tiff(path, images, tile_size=64):
+    '''
+    Writes an uncompressed RGB tiff of the given images in order, ie to mimic the image order of scanner formats
+
+    :param images: list of (image, tiled, new subfile type). tiled images use tile_size tiles, others a single strip
+    '''
+
+    with open(path, 'wb') as f:
+        f.write(b'II' + struct.pack('<HI', 42, 0))
+        next_ifd_pointer = 4
+
+        for image, tiled, subfile_type in images:
+            h, w = image.shape[:2]
+            if tiled:
+                th, tw = -(-h // tile_size) * tile_size, -(-w // tile_size) * tile_size
+                padded = np.zeros((th, tw, 3), dtype=np.uint8)
+                padded[:h, :w] = image
+                blocks = [padded[y:y + tile_size, x:x + tile_size].tobytes()
+                          for y in range(0, th, tile_size) for x in range(0, tw, tile_size)]
+            else:
+                blocks = [np.ascontiguousarray(image).tobytes()]
+
+            offsets = []
+            for block in blocks:
+                offsets.append(f.tell())
+                f.write(block)
+            counts = [len(block) for block in blocks]
+
+            # (tag, type, values). types: 3 short, 4 long
+            entries = [(254, 4, [subfile_type]), (256, 4, [w]), (257, 4, [h]), (258, 3, [8, 8, 8]), (259, 3, [1]),
+                       (262, 3, [2]), (277, 3, [3]), (284, 3, [1])]
+            if tiled:
+                entries += [(322, 3, [tile_size]), (323, 3, [tile_size]), (324, 4, offsets), (325, 4, counts)]
+            else:
+                entries += [(273, 4, offsets), (278, 4, [h]), (279, 4, counts)]
+
+            values = {}
+            for tag, typ, vals in entries:
+                data = np.array(vals, dtype='<u2' if typ == 3 else '<u4').tobytes()
+                if len(data) > 4:
+                    values[tag] = struct.pack('<I', f.tell())
+                    f.write(data)
+                else:
+                    values[tag] = data.ljust(4, b'\0')
+
+            ifd_offset = f.tell()
+            f.write(struct.pack('<H', len(entries)))
+            for tag, typ, vals in sorted(entries):
+                f.write(struct.pack('<HHI', tag, typ, len(vals)) + values[tag])
+            f.write(struct.pack('<I', 0))
+
+            end = f.tell()
+            f.seek(next_ifd_pointer)
+            f.write(struct.pack('<I', ifd_offset))
+            f.seek(end)
+            next_ifd_pointer = end - 4
@@ -0,0 +1,118 @@
+import numpy as np
+import pytest
+import matplotlib.pyplot as plt
+
+from brain_utils.general_utility import unique_colors
+from brain_utils.general_utility.heatmap import HeatmapGrid
+from brain_utils.general_utility.slide import Slide
+from brain_utils.general_utility.tiff_writer import write_tiled_tiff
+from brain_utils.general_utility.ai.tileextractor import TileExtractor
+
+
+class Model:
+
+    def predict_on_batch(self, x):
+        means = x.mean(axis=(1, 2)) + 1e-3
+        return means / means.sum(axis=1, keepdims=True)
+
+
+@pytest.fixture
+def tiff_path(tmp_path, tissue):
+    path = str(tmp_path / 'slide.tif')
+    image = tissue(1000, 760)
+    write_tiled_tiff(path, [(1000, 760, lambda y1, y2: image[y1:y2])], tile_size=128)
+    return path
+
+
+def make_extractor(path, mpp=None, stride=None):
+    # with an mpp of 0.3, tiles are resized by a fraction and their coordinates are truncated
+    slide = Slide(path)
+    slide.mpp = mpp
+    return TileExtractor(slide, tile_size=64, desired_tile_mpp=0.504, use_pyramid=False, stride=stride)
+
+
+def grid_shape(rows, cols, num_classes):
+    return (rows, cols) if num_classes is None else (rows, cols, num_classes)
+
+
+def fill(grid, tile_extractor, min_non_blank_amt):
+    for res in tile_extractor.iterate_tiles_with_lesion_conf(Model(), [0, 1], min_non_blank_amt=min_non_blank_amt,
+                                                             batch_size=5, print_time=False):
+        grid.add_result(res)
+    return grid
+
+
+@pytest.mark.parametrize('mpp', [None, 0.3])
+@pytest.mark.parametrize('stride', [None, 24])
+@pytest.mark.parametrize('num_classes', [None, 3])
+def test_cells_hold_their_tiles_values(tiff_path, mpp, stride, num_classes):
+    # every tile is yielded in row order, so each one's values can be laid out over the grid directly
+    tile_extractor = make_extractor(tiff_path, mpp, stride)
+    rows, cols = len(tile_extractor.grid_ys), len(tile_extractor.grid_xs)
+    results = list(tile_extractor.iterate_tiles_with_lesion_conf(Model(), [0, 1], batch_size=5, print_time=False))
+    key = 'lesion_confs' if num_classes is None else 'preds'
+    expected = np.concatenate([res[key] for res in results]).reshape(grid_shape(rows, cols, num_classes))
+
+    grid = HeatmapGrid.from_tile_extractor(tile_extractor, num_classes=num_classes)
+    for res in results:
+        grid.add_result(res)
+    assert grid.filled.all()
+    assert np.array_equal(grid.values, expected.astype(np.float32))
+
+    # only tiles that are yielded fill cells
+    sparse = HeatmapGrid.from_tile_extractor(tile_extractor, num_classes=num_classes)
+    fill(sparse, make_extractor(tiff_path, mpp, stride), 0.3)
+    assert 0 < sparse.filled.sum() < rows * cols
+    assert np.array_equal(sparse.values[sparse.filled], grid.values[sparse.filled])
+    assert not sparse.values[~sparse.filled].any()
+
+
+@pytest.mark.parametrize('mpp', [None, 0.3])
+def test_grid_without_positions_rounds_to_the_nearest_cell(tiff_path, mpp):
+    tile_extractor = make_extractor(tiff_path, mpp)
+    expected = fill(HeatmapGrid.from_tile_extractor(tile_extractor), make_extractor(tiff_path, mpp), 0.3)
+
+    grid = HeatmapGrid(len(tile_extractor.grid_ys) * 64, len(tile_extractor.grid_xs) * 64, 64)
+    fill(grid, make_extractor(tiff_path, mpp), 0.3)
+    assert np.array_equal(grid.filled, expected.filled)
+    assert np.array_equal(grid.values, expected.values)
+
+
+def test_uint8_grid_quantizes_values():
+    values = np.array([0, 0.1, 0.5, 0.999, 1.2])
+    coordinates = [(x * 10, 0, x * 10 + 10, 10) for x in range(5)]
+
+    grid = HeatmapGrid(10, 60, 10, dtype=np.uint8)
+    grid.add(coordinates, values)
+    assert grid.grid.dtype == np.uint8
+    assert np.allclose(grid.values[0, :5], np.clip(values, 0, 1), atol=0.5 / 255)
+    assert not grid.filled[0, 5]
+
+
+def test_colorize_lesion_confs():
+    grid = HeatmapGrid(20, 30, 10)
+    values = [0, 0.5, 1, 0.25, 0.75]
+    grid.add([(x, y, x + 10, y + 10) for x, y in [(0, 0), (10, 0), (20, 0), (0, 10), (10, 10)]], values)
+
+    image = grid.colorize(cmap='viridis', empty_color=(1, 2, 3))
+    lut = np.round(plt.get_cmap('viridis')(np.linspace(0, 1, 256))[:, 2::-1] * 255).astype(np.uint8)
+    assert np.array_equal(image[[0, 0, 0, 1, 1], [0, 1, 2, 0, 1]], lut[np.rint(np.array(values) * 255).astype(int)])
+    assert tuple(image[1, 2]) == (1, 2, 3)
+
+    big = grid.colorize(cmap='viridis', cell_size=4)
+    assert big.shape == (8, 12, 3)
+    assert np.array_equal(big[::4, ::4], grid.colorize(cmap='viridis'))
+
+
+def test_colorize_per_class_preds():
+    grid = HeatmapGrid(10, 40, 10, num_classes=3)
+    grid.add([(0, 0, 10, 10), (10, 0, 20, 10), (20, 0, 30, 10)], [[0.1, 0.7, 0.2], [0.5, 0.2, 0.3], [0, 0.4, 0.6]])
+
+    image = grid.colorize(['red', 'green', (1, 0, 0)])
+    assert np.array_equal(image[0, 0], unique_colors.BGR_COLORS['green'])
+    assert np.array_equal(image[0, 1], unique_colors.BGR_COLORS['red'])
+    assert tuple(image[0, 2]) == (255, 0, 0)
+    assert tuple(image[0, 3]) == (255, 255, 255)
+
+    with pytest.raises(Exception, match='colormap'):
+        grid.colorize(['red', 'green'])
@@ -0,0 +1,44 @@
+import os
+
+import numpy as np
+import cv2
+import pytest
+
+from brain_utils.general_utility.image_creator import ImageCreator
+from brain_utils.general_utility.slide_reader import TiffSlideReader
+
+
+@pytest.mark.parametrize('memmap', [False, True])
+def test_save_tiled_tiff_levels(tmp_path, tissue, memmap):
+    image = tissue(2500, 1300)
+    image_creator = ImageCreator(1300, 2500, memmap_path=str(tmp_path / 'canvas.npy') if memmap else None)
+    image_creator.image[:] = image
+
+    path = str(tmp_path / 'out.tif')
+    image_creator.save_tiled_tiff(path, tile_size=256, min_level_size=400)
+
+    # no temporary levels left behind
+    assert sorted(os.listdir(str(tmp_path))) == (['canvas.npy', 'out.tif'] if memmap else ['out.tif'])
+
+    with TiffSlideReader(path) as reader:
+        assert reader.level_dimensions == [(2500, 1300), (1250, 650), (625, 325), (313, 163)]
+        assert np.array_equal(reader.read_region((0, 0, 2500, 1300)), image[:, :, ::-1])
+
+        for level, (w, h) in enumerate(reader.level_dimensions[1:], 1):
+            expected = cv2.resize(image, (w, h), interpolation=cv2.INTER_AREA)[:, :, ::-1]
+            assert np.abs(reader.read_region((0, 0, w, h), level=level).astype(int) - expected).mean() < 2
+
+
+@pytest.mark.parametrize('scale_factor, max_diff', [(1, 0), (2, 0), (4, 0), (8, 0), (0.5, 0), (3, 1), (2.5, 1)])
+def test_add_tiles_matches_add_tile(tissue, scale_factor, max_diff):
+    image = tissue(1024, 768)
+    tiles = np.stack([image[y:y + 128, x:x + 128] for y in range(0, 768, 128) for x in range(0, 1024, 128)])
+    coordinates = np.array([(x, y, x + 128, y + 128) for y in range(0, 768, 128) for x in range(0, 1024, 128)])
+
+    one_by_one, batched = ImageCreator(768, 1024, scale_factor), ImageCreator(768, 1024, scale_factor)
+    for tile, coordinate in zip(tiles, coordinates):
+        one_by_one.add_tile(tile, coordinate)
+    for i in range(0, len(tiles), 16):
+        batched.add_tiles(tiles[i:i + 16], coordinates[i:i + 16])
+
+    assert np.abs(batched.image.astype(int) - one_by_one.image).max() <= max_diff
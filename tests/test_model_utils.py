@@ -0,0 +1,57 @@
+import logging
+
+import numpy as np
+import pytest
+from fuzzywuzzy import process, fuzz
+
+from brain_utils.general_utility.ai.model_utils import ModelUtils
+
+CLASSES = ['Blank', 'Glioma', 'Marker Pen', 'Necrosis', 'Meningioma']
+
+
+def remove_class_one_by_one(pred, classes, remove, redist_conf=True, **kwargs):
+    # the original remove_class, removing each class from a single pred in turn
+    pred, classes = np.array(pred), list(classes)
+    for r in remove:
+        name, confidence = process.extractOne(r, classes, scorer=fuzz.partial_ratio)
+        if confidence >= 85:
+            idx = classes.index(name)
+            classes.pop(idx)
+            pred = np.delete(pred, idx)
+            for k, v in kwargs.items():
+                kwargs[k] = v[:idx] + v[idx + 1:]
+            if redist_conf:
+                pred = pred / pred.sum()
+    return dict(pred=pred, classes=classes, **kwargs)
+
+
+@pytest.mark.parametrize('remove', [['blank', 'marker'], ['marker'], ['necrosis', 'blank', 'glioma'], []])
+@pytest.mark.parametrize('redist_conf', [True, False])
+def test_remove_class_batch_matches_removing_one_by_one(remove, redist_conf):
+    preds = np.random.RandomState(0).dirichlet(np.ones(len(CLASSES)), 16)
+    colors = ['c{}'.format(i) for i in range(len(CLASSES))]
+
+    result = ModelUtils.remove_class_batch(preds, CLASSES, remove=remove, redist_conf=redist_conf, colors=colors)
+
+    for pred, row in zip(preds, result['preds']):
+        expected = remove_class_one_by_one(pred, CLASSES, remove, redist_conf=redist_conf, colors=colors)
+        assert np.allclose(row, expected['pred'])
+        assert result['classes'] == expected['classes']
+        assert result['colors'] == expected['colors']
+
+    single = ModelUtils.remove_class(preds[0], CLASSES, remove=remove, redist_conf=redist_conf, colors=colors)
+    assert np.allclose(single['pred'], result['preds'][0])
+    assert single['classes'] == result['classes'] and single['colors'] == result['colors']
+
+
+def test_remove_class_batch_ignores_missing_classes(caplog):
+    preds = np.random.RandomState(0).dirichlet(np.ones(len(CLASSES)), 4)
+
+    with caplog.at_level(logging.WARNING):
+        result = ModelUtils.remove_class_batch(preds, CLASSES, remove=['lymphoma', 'blank'])
+
+    assert 'Failed to remove lymphoma' in caplog.text
+    assert result['classes'] == CLASSES[1:]
+    assert np.allclose(result['preds'].sum(axis=1), 1)
+    # the input is left untouched
+    assert preds.shape == (4, len(CLASSES))
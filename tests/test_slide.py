@@ -0,0 +1,62 @@
+import builtins
+
+import numpy as np
+import cv2
+from PIL import Image
+
+from brain_utils.general_utility import slide as slide_module
+from brain_utils.general_utility.slide import Slide
+from brain_utils.general_utility.tiff_writer import write_tiled_tiff
+
+
+def test_metadata_only_reads_the_header(tmp_path, monkeypatch):
+    # 16px tiles give 65536 tile offsets and byte counts on the first level alone
+    path = str(tmp_path / 'slide.tif')
+    levels = [(size, size, lambda y1, y2, size=size: np.zeros((y2 - y1, size, 3), dtype=np.uint8))
+              for size in (4096, 2048, 1024)]
+    write_tiled_tiff(path, levels, tile_size=16, compression=None)
+
+    bytes_read = []
+
+    class CountingFile:
+
+        def __init__(self, f):
+            self.f = f
+
+        def read(self, *args):
+            data = self.f.read(*args)
+            bytes_read.append(len(data))
+            return data
+
+        def __getattr__(self, name):
+            return getattr(self.f, name)
+
+        def __enter__(self):
+            return self
+
+        def __exit__(self, *args):
+            self.f.close()
+
+    monkeypatch.setattr(slide_module, 'open', lambda *args: CountingFile(builtins.open(*args)), raising=False)
+
+    slide = Slide(path)
+    assert (slide.width, slide.height, slide.compression) == (4096, 4096, 'Uncompressed')
+    assert sum(bytes_read) < 4096
+
+
+def test_cropped_jpeg_thumbnail_matches_cropped_full_image(jpeg_path):
+    # the crop is a quarter of the slide's width, so decoding the whole jpeg at a thumbnail-sized scale would leave the
+    # crop with a quarter of the thumbnail's pixels
+    path = jpeg_path(4100, 3075)
+    box = (1000, 700, 2024, 1468)
+    slide = Slide(path)
+    slide.crop(box)
+
+    thumb = np.array(slide.get_thumbnail((256, 192), use_cache=False))
+    expected = np.array(Image.open(path).crop(box).resize((256, 192), Image.BILINEAR))
+
+    assert thumb.shape == expected.shape
+    assert np.abs(thumb.astype(int) - expected).mean() < 1
+    # blurry thumbnails lose most of the high frequencies
+    sharpness = cv2.Laplacian(thumb, cv2.CV_64F).var() / cv2.Laplacian(expected, cv2.CV_64F).var()
+    assert sharpness > 0.8
@@ -0,0 +1,40 @@
+import numpy as np
+import cv2
+import pytest
+from PIL import Image
+
+from brain_utils.general_utility.slide_reader import TiffSlideReader, TAG_ROWS_PER_STRIP
+
+
+@pytest.mark.parametrize('step', [2, 4, 8])
+def test_reduced_jpeg_strip_reads_match_full_reads(tmp_path, tissue, step):
+    # 64 row strips leave a 20 row last strip, which the decoder can only reduce by 2. blurred so that decoding at a
+    # reduced scale is close to keeping every step'th pixel
+    path = str(tmp_path / 'strips.tif')
+    Image.fromarray(cv2.GaussianBlur(tissue(1000, 660), (0, 0), 4)).save(path, compression='jpeg', tiffinfo={TAG_ROWS_PER_STRIP: 64})
+
+    with TiffSlideReader(path) as reader:
+        full = reader.read_region((0, 0, 1000, 660))[::step, ::step]
+        reduced = reader._read_region((0, 0, full.shape[1], full.shape[0]), 0, step)
+
+    diff = np.abs(reduced.astype(int) - full)
+    assert diff.mean() < 5
+    # the rows of the last strip
+    assert diff[-(-640 // step):].mean() < 5
+
+
+def test_svs_ordered_pyramid_levels(tmp_path, tissue, write_tiff):
+    image = tissue(1024, 768)
+
+    def level(d):
+        return cv2.resize(image, (1024 // d, 768 // d), interpolation=cv2.INTER_AREA)
+
+    # svs order: base, thumbnail, pyramid levels, label, macro. plus a mask of the base's aspect ratio
+    path = str(tmp_path / 'slide.svs')
+    write_tiff(path, [(image, True, 0), (level(8), False, 0), (level(2), True, 0), (level(4), True, 0),
+                      (tissue(100, 100), False, 1), (tissue(300, 100), False, 9), (level(16), True, 4)])
+
+    with TiffSlideReader(path) as reader:
+        assert reader.level_dimensions == [(1024, 768), (512, 384), (256, 192)]
+        assert reader.get_best_level_for_downsample(4) == 2
+        assert np.array_equal(reader.read_region((0, 0, 256, 192), level=2), level(4))
@@ -0,0 +1,124 @@
+import os
+
+import numpy as np
+import pytest
+
+from brain_utils.general_utility.ai import slide_scheduler
+from brain_utils.general_utility.ai.slide_scheduler import SlideScheduler
+
+# workers are forked so that the crashing slide patched in below reaches them
+pytestmark = pytest.mark.skipif(not hasattr(os, 'fork'), reason='needs fork')
+
+
+class Config:
+    identity = 'test_config'
+    classes = ['a', 'b', 'c']
+    tile_size = 64
+    mpp = 0.5040
+    non_lesion_indices = np.array([0, 1])
+
+
+class Model:
+
+    def predict_on_batch(self, x):
+        means = x.mean(axis=(1, 2)) + 1e-3
+        return means / means.sum(axis=1, keepdims=True)
+
+
+class FailsToUnpickle:
+    '''
+    Pickles fine here but raises when a worker unpickles its task, which breaks the pool before any slide begins
+    '''
+
+    def __reduce__(self):
+        return int, ('not a number',)
+
+
+@pytest.fixture
+def slide_paths(jpeg_path):
+    return [jpeg_path(256, 192, name='slide_{}.jpg'.format(i), seed=i) for i in range(4)]
+
+
+def make_scheduler(paths, output_dir, **kwargs):
+    kwargs.setdefault('num_workers', 2)
+    return SlideScheduler(paths, Config(), Model(), str(output_dir), batch_size=4, mp_context='fork', **kwargs)
+
+
+def test_run_and_resume(slide_paths, tmp_path):
+    scheduler = make_scheduler(slide_paths, tmp_path)
+    res = scheduler.run()
+
+    assert sorted(res['done']) == ['slide_{}'.format(i) for i in range(4)]
+    assert res['failed'] == []
+    for path in slide_paths:
+        result = scheduler.load_result(path)
+        assert result['heatmap'].filled.all()
+        assert result['timing']['tiles'] == 12
+
+    # nothing is left for a new run over the same output directory
+    calls = []
+    make_scheduler(slide_paths, tmp_path).run(on_result=lambda path, result: calls.append(path))
+    assert calls == []
+
+
+def test_failed_slide_is_retried(slide_paths, tmp_path, jpeg_path):
+    missing = str(tmp_path / 'missing.jpg')
+    scheduler = make_scheduler(slide_paths[:2] + [missing], tmp_path / 'out')
+
+    res = scheduler.run()
+    assert res['failed'] == ['missing']
+    assert 'FileNotFoundError' in scheduler.get_entry(missing)['error']
+
+    jpeg_path(256, 192, name='missing.jpg')
+    res = make_scheduler(slide_paths[:2] + [missing], tmp_path / 'out').run(retry_failed=True)
+    assert res == {'done': ['slide_0', 'slide_1', 'missing'], 'failed': []}
+
+
+def test_worker_crash_only_fails_the_crashing_slide(slide_paths, tmp_path, monkeypatch):
+    real_slide = slide_scheduler.Slide
+
+    def crashing_slide(path, *args, **kwargs):
+        if path == slide_paths[1]:
+            os._exit(1)
+        return real_slide(path, *args, **kwargs)
+
+    monkeypatch.setattr(slide_scheduler, 'Slide', crashing_slide)
+
+    scheduler = make_scheduler(slide_paths, tmp_path)
+    res = scheduler.run()
+
+    assert res['failed'] == ['slide_1']
+    assert sorted(res['done']) == ['slide_0', 'slide_2', 'slide_3']
+    assert 'crashed' in scheduler.get_entry(slide_paths[1])['error']
+
+
+def test_pool_failure_without_suspects_fails_remaining_slides(slide_paths, tmp_path):
+    scheduler = make_scheduler(slide_paths, tmp_path, tile_kwargs={'broken': FailsToUnpickle()})
+    res = scheduler.run()
+
+    assert res['done'] == []
+    assert sorted(res['failed']) == ['slide_{}'.format(i) for i in range(4)]
+    assert 'Worker pool failed' in scheduler.get_entry(slide_paths[0])['error']
+
+
+def test_too_many_pool_crashes_gives_up(slide_paths, tmp_path, monkeypatch):
+    real_slide = slide_scheduler.Slide
+
+    def crashing_slide(path, *args, **kwargs):
+        if path != slide_paths[-1]:
+            os._exit(1)
+        return real_slide(path, *args, **kwargs)
+
+    monkeypatch.setattr(slide_scheduler, 'Slide', crashing_slide)
+    monkeypatch.setattr(SlideScheduler, 'MAX_POOL_RESTARTS', 1)
+
+    scheduler = make_scheduler(slide_paths, tmp_path, num_workers=1)
+    res = scheduler.run()
+
+    assert res['done'] == []
+    assert 'too many times' in scheduler.get_entry(slide_paths[-1])['error']
+
+
+def test_unpicklable_options_are_rejected(slide_paths, tmp_path):
+    with pytest.raises(Exception, match='picklable'):
+        make_scheduler(slide_paths, tmp_path, extractor_kwargs={'stats_callback': lambda *args: None})
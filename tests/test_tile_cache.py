@@ -0,0 +1,83 @@
+import numpy as np
+
+from brain_utils.general_utility.ai.tile_cache import TileCache
+
+
+def make_tile(value, tile_size=8):
+    return np.full((tile_size, tile_size, 3), value, dtype=np.uint8)
+
+
+def key(x):
+    return TileCache.make_key('slide', x, 0, 16, 8, 0.504)
+
+
+def test_hit_and_miss(tmp_path):
+    with TileCache(str(tmp_path), 8) as cache:
+        assert cache.get(key(0), 0.5) is None
+
+        cache.put(key(0), make_tile(7), 0.25)
+        tile, blank = cache.get(key(0), 0.5)
+        assert np.array_equal(tile, make_tile(7))
+        assert blank == 0.25
+        assert cache.get(key(1), 0.5) is None
+
+
+def test_blank_amount_round_trip(tmp_path):
+    with TileCache(str(tmp_path), 8) as cache:
+        # too blank for the run that cached it so only the blank amount is kept
+        cache.put(key(0), None, 0.9)
+        assert cache.get(key(0), 0.5) == (None, 0.9)
+        # not too blank for this run, but there are no pixels to return
+        assert cache.get(key(0), 0.95) is None
+
+        cache.put(key(1), make_tile(3), 0.6)
+        assert cache.get(key(1), 0.5) == (None, 0.6)
+        assert cache.get(key(1), 0.7)[1] == 0.6
+
+
+def test_least_recently_used_tiles_are_evicted(tmp_path):
+    slot_bytes = 8 * 8 * 3
+    with TileCache(str(tmp_path), 8, max_bytes=2 * slot_bytes) as cache:
+        cache.put(key(0), make_tile(0), 0)
+        cache.put(key(1), make_tile(1), 0)
+        # key 0 is now the most recently used
+        assert cache.get(key(0), 0.5) is not None
+
+        cache.put(key(2), make_tile(2), 0)
+        assert cache.get(key(1), 0.5) is None
+        assert np.array_equal(cache.get(key(0), 0.5)[0], make_tile(0))
+        assert np.array_equal(cache.get(key(2), 0.5)[0], make_tile(2))
+
+
+def test_blank_entries_are_capped(tmp_path):
+    slot_bytes = 8 * 8 * 3
+    with TileCache(str(tmp_path), 8, max_bytes=2 * slot_bytes) as cache:
+        for x in range(3 * TileCache.ENTRIES_PER_SLOT):
+            cache.put(key(x), None, 1)
+        assert len(cache) == 2 * TileCache.ENTRIES_PER_SLOT
+        assert cache.get(key(0), 0.5) is None
+        assert cache.get(key(3 * TileCache.ENTRIES_PER_SLOT - 1), 0.5) == (None, 1)
+
+
+def test_tiles_persist_across_reopening(tmp_path):
+    with TileCache(str(tmp_path), 8) as cache:
+        cache.put(key(0), make_tile(5), 0.1)
+        cache.put(key(1), None, 0.8)
+
+    with TileCache(str(tmp_path), 8) as cache:
+        assert len(cache) == 2
+        tile, blank = cache.get(key(0), 0.5)
+        assert np.array_equal(tile, make_tile(5))
+        assert blank == 0.1
+        assert cache.get(key(1), 0.5) == (None, 0.8)
+
+
+def test_keys_depend_on_how_the_tile_was_read():
+    keys = {
+        TileCache.make_key('slide', 0, 0, 16, 8, 0.504),
+        TileCache.make_key('slide', 0, 0, 16, 8, 0.504, level=1),
+        TileCache.make_key('slide', 0, 0, 16, 8, 0.504, read_mode='strip'),
+        TileCache.make_key('slide', 0, 0, 16, 8, 0.504, edge_mode='pad'),
+    }
+    assert len(keys) == 4
+    assert all(len(k) == 40 for k in keys)
@@ -0,0 +1,46 @@
+import numpy as np
+import pytest
+
+from brain_utils.general_utility.tile_image_utils import TileUtils
+
+
+def add_border_by_row(a, thickness=0.05, color=(0, 0, 0)):
+    # the original row by row add_border
+    h, w, c = a.shape
+    if h == 0 or c == 0:
+        return
+
+    pixel_len = min(int(w * thickness), int(h * thickness))
+    for j in range(h):
+        if j <= pixel_len or j >= w - pixel_len:
+            for i in range(3):
+                a[j, :, i] = color[i]
+        else:
+            for i in range(3):
+                a[j, :pixel_len, i] = color[i]
+                a[j, (w - pixel_len):, i] = color[i]
+
+
+@pytest.mark.parametrize('h, w', [(100, 100), (64, 200), (200, 64), (5, 7), (1, 1), (0, 10)])
+@pytest.mark.parametrize('thickness', [0.05, 0.2, 0.5])
+def test_add_border_matches_row_by_row(h, w, thickness):
+    image = np.random.RandomState(0).randint(0, 256, (h, w, 3)).astype(np.uint8)
+    expected = image.copy()
+
+    TileUtils.add_border(image, thickness=thickness, color=(10, 20, 30))
+    add_border_by_row(expected, thickness=thickness, color=(10, 20, 30))
+    assert np.array_equal(image, expected)
+
+
+def test_add_borders_matches_add_border():
+    image = np.random.RandomState(0).randint(0, 256, (300, 400, 3)).astype(np.uint8)
+    expected = image.copy()
+
+    # overlapping, differently sized and partly (or fully) outside the image
+    coordinates = [(0, 0, 100, 100), (50, 50, 150, 200), (100, 0, 200, 100), (350, 250, 450, 350), (400, 300, 500, 400),
+                   (0, 200, 100, 300)]
+
+    TileUtils.add_borders(image, coordinates, color=(0, 255, 0))
+    for x1, y1, x2, y2 in coordinates:
+        TileUtils.add_border(expected[y1:y2, x1:x2], color=(0, 255, 0))
+    assert np.array_equal(image, expected)
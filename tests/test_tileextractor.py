@@ -0,0 +1,367 @@
+import collections
+import itertools
+import threading
+from types import SimpleNamespace
+
+import numpy as np
+import cv2
+import pytest
+
+from brain_utils.general_utility.slide import Slide
+from brain_utils.general_utility.tiff_writer import write_tiled_tiff
+from brain_utils.general_utility.ai.tileextractor import TileExtractor, _iterate_in_background
+from brain_utils.general_utility.ai.tile_cache import TileCache
+
+
+def collect(tile_extractor, **kwargs):
+    '''
+    Returns all the (tiles, coordinates) the extractor yields, copied out of any reused buffers
+    '''
+
+    batches = [(res['tiles'].copy(), res['coordinates'].copy())
+               for res in tile_extractor.iterate_tiles(print_time=False, **kwargs)]
+    return np.concatenate([b[0] for b in batches]), np.concatenate([b[1] for b in batches])
+
+
+@pytest.fixture
+def tiff_path(tmp_path, tissue):
+    path = str(tmp_path / 'slide.tif')
+    image = tissue(1000, 760)
+    write_tiled_tiff(path, [(1000, 760, lambda y1, y2: image[y1:y2])], tile_size=128)
+    return path
+
+
+def make_extractor(path, mpp=None, **kwargs):
+    '''
+    Tile extractor of 64px tiles. with an mpp, tiles are read at twice the size and resized
+    '''
+
+    slide = Slide(path)
+    slide.mpp = mpp
+    return TileExtractor(slide, tile_size=64, desired_tile_mpp=0.504, use_pyramid=False, **kwargs)
+
+
+@pytest.mark.parametrize('mpp', [None, 0.252])
+@pytest.mark.parametrize('num_workers, worker_type', [(1, 'thread'), (3, 'thread'), (2, 'process')])
+def test_workers_match_serial(tiff_path, mpp, num_workers, worker_type):
+    expected = collect(make_extractor(tiff_path, mpp), min_non_blank_amt=0.3, batch_size=5)
+
+    tiles, coordinates = collect(make_extractor(tiff_path, mpp), min_non_blank_amt=0.3, batch_size=5,
+                                 num_workers=num_workers, worker_type=worker_type, prefetch=4)
+    assert np.array_equal(coordinates, expected[1])
+    assert np.array_equal(tiles, expected[0])
+
+
+@pytest.mark.parametrize('mpp', [None, 0.252])
+@pytest.mark.parametrize('edge_mode', TileExtractor.EDGE_MODES)
+def test_overlapping_tiles_match_tile_by_tile(tiff_path, mpp, edge_mode):
+    tile_extractor = make_extractor(tiff_path, mpp, stride=24, edge_mode=edge_mode)
+    step = tile_extractor.modified_stride
+    assert np.all(np.diff(tile_extractor.grid_xs)[:-1] == step)
+
+    # serially, overlapping tiles are sliced out of bands. a worker reads each tile on its own
+    tiles, coordinates = collect(tile_extractor, min_non_blank_amt=0.3, batch_size=5)
+    expected = collect(make_extractor(tiff_path, mpp, stride=24, edge_mode=edge_mode), min_non_blank_amt=0.3,
+                       batch_size=5, num_workers=1)
+
+    assert np.array_equal(coordinates, expected[1])
+    assert np.array_equal(tiles, expected[0])
+
+
+def test_stride_of_tile_size_matches_default(tiff_path):
+    expected = collect(make_extractor(tiff_path))
+    tiles, coordinates = collect(make_extractor(tiff_path, stride=64))
+    assert np.array_equal(coordinates, expected[1])
+    assert np.array_equal(tiles, expected[0])
+
+
+@pytest.mark.parametrize('mpp', [None, 0.252, 0.3])
+@pytest.mark.parametrize('stride', [None, 24])
+@pytest.mark.parametrize('edge_mode', TileExtractor.EDGE_MODES)
+def test_strip_reads_match_tile_reads(tiff_path, mpp, stride, edge_mode):
+    expected = collect(make_extractor(tiff_path, mpp, stride=stride, edge_mode=edge_mode), batch_size=5)
+    tiles, coordinates = collect(make_extractor(tiff_path, mpp, stride=stride, edge_mode=edge_mode), batch_size=5,
+                                 read_mode='strip')
+
+    assert np.array_equal(coordinates, expected[1])
+    diff = np.abs(tiles.astype(int) - expected[0])
+    if mpp in (None, 0.252):
+        # no resizing, or resizing by a whole factor, which is the same for the whole strip as for each tile
+        assert diff.max() == 0
+    else:
+        assert diff.mean() < 6
+
+
+def test_strip_reads_cannot_use_workers(tiff_path):
+    with pytest.raises(Exception, match='workers'):
+        collect(make_extractor(tiff_path), read_mode='strip', num_workers=2)
+
+
+class Model:
+
+    def __init__(self, weights=(1, 1, 1)):
+        self.weights = np.array(weights)
+
+    def predict_on_batch(self, x):
+        means = x.mean(axis=(1, 2)) * self.weights + 1e-3
+        return means / means.sum(axis=1, keepdims=True)
+
+
+@pytest.mark.parametrize('ring_size', [1, 2, 3])
+@pytest.mark.parametrize('mpp, stride, read_mode, num_workers', [
+    (None, None, 'tile', 0), (0.252, None, 'tile', 0), (None, 24, 'tile', 0), (0.3, None, 'strip', 0),
+    (0.252, None, 'tile', 2),
+])
+def test_ring_batches_match_copied_batches(tiff_path, ring_size, mpp, stride, read_mode, num_workers):
+    kwargs = dict(min_non_blank_amt=0.3, batch_size=5, read_mode=read_mode, num_workers=num_workers)
+    expected = [(res['tiles'], res['coordinates'])
+                for res in make_extractor(tiff_path, mpp, stride=stride).iterate_tiles(print_time=False, **kwargs)]
+
+    # up to ring_size batches can be held at once and must all still be intact
+    held = collections.deque(maxlen=ring_size)
+    gen = make_extractor(tiff_path, mpp, stride=stride).iterate_tiles(print_time=False, ring_size=ring_size, **kwargs)
+    for i, res in enumerate(gen):
+        held.append((i, res))
+        for j, batch in held:
+            assert np.array_equal(batch['tiles'], expected[j][0])
+            assert np.array_equal(batch['coordinates'], expected[j][1])
+    assert i == len(expected) - 1
+
+
+@pytest.mark.parametrize('queue_depth', [0, 1, 2])
+def test_ring_batches_with_lesion_conf(tiff_path, queue_depth):
+    non_lesion_indices = [0, 1]
+    expected = list(make_extractor(tiff_path).iterate_tiles_with_lesion_conf(
+        Model(), non_lesion_indices, batch_size=5, print_time=False, queue_depth=queue_depth))
+
+    ring_size = queue_depth + 3
+    gen = make_extractor(tiff_path).iterate_tiles_with_lesion_conf(
+        Model(), non_lesion_indices, batch_size=5, print_time=False, queue_depth=queue_depth, ring_size=ring_size)
+
+    # the background thread holds up to queue_depth + 1 batches of the ring, leaving the rest for the caller
+    held = collections.deque(maxlen=ring_size - queue_depth - 1)
+    for i, res in enumerate(gen):
+        held.append((i, res))
+        for j, batch in held:
+            assert np.array_equal(batch['tiles'], expected[j]['tiles'])
+        assert np.array_equal(res['coordinates'], expected[i]['coordinates'])
+        assert np.allclose(res['lesion_confs'], expected[i]['lesion_confs'])
+    assert i == len(expected) - 1
+
+
+@pytest.mark.parametrize('queue_depth', [1, 2, 5])
+def test_background_items_come_out_in_order(queue_depth):
+    assert list(_iterate_in_background((i for i in range(20)), queue_depth)) == list(range(20))
+
+
+def test_background_exceptions_are_raised_in_the_consumer():
+    def gen():
+        yield from range(3)
+        raise ValueError('broken slide')
+
+    items = []
+    with pytest.raises(ValueError, match='broken slide'):
+        for item in _iterate_in_background(gen(), 2):
+            items.append(item)
+    assert items == [0, 1, 2]
+
+
+def test_background_generator_is_closed_when_the_consumer_stops():
+    closed = threading.Event()
+
+    def gen():
+        try:
+            yield from range(100)
+        finally:
+            closed.set()
+
+    consumer = _iterate_in_background(gen(), 2)
+    assert next(consumer) == 0
+    consumer.close()
+    assert closed.is_set()
+
+
+@pytest.mark.parametrize('queue_depth', [0, 1, 3])
+def test_pipelined_lesion_conf_matches_foreground(tiff_path, queue_depth, monkeypatch):
+    kwargs = dict(min_non_blank_amt=0.3, batch_size=5, print_time=False)
+    expected = list(make_extractor(tiff_path).iterate_tiles_with_lesion_conf(Model(), [0, 1], **kwargs))
+
+    results = list(make_extractor(tiff_path).iterate_tiles_with_lesion_conf(Model(), [0, 1], queue_depth=queue_depth,
+                                                                            **kwargs))
+    assert len(results) == len(expected)
+    for res, exp in zip(results, expected):
+        assert np.array_equal(res['tiles'], exp['tiles'])
+        assert np.array_equal(res['coordinates'], exp['coordinates'])
+        assert np.array_equal(res['lesion_confs'], exp['lesion_confs'])
+
+    # a read failing part way through reaches the caller after the batches before it
+    tile_extractor = make_extractor(tiff_path)
+    read_region = tile_extractor.slide.reader.read_region
+    reads = itertools.count()
+
+    def failing_read_region(*args, **kwargs):
+        if next(reads) == 30:
+            raise IOError('truncated slide')
+        return read_region(*args, **kwargs)
+
+    monkeypatch.setattr(tile_extractor.slide.reader, 'read_region', failing_read_region)
+    gen = tile_extractor.iterate_tiles_with_lesion_conf(Model(), [0, 1], queue_depth=queue_depth, **kwargs)
+    batches = 0
+    with pytest.raises(IOError, match='truncated slide'):
+        for res in gen:
+            assert np.array_equal(res['coordinates'], expected[batches]['coordinates'])
+            batches += 1
+    assert 0 < batches < len(expected)
+
+
+def test_multi_model_confs_match_single_model_runs(tiff_path):
+    models_and_configs = [
+        (Model(), SimpleNamespace(identity='a', tile_size=64, mpp=0.504, non_lesion_indices=[0, 1])),
+        (Model((3, 1, 2)), SimpleNamespace(identity='b', non_lesion_indices=[2])),
+        # preds only
+        (Model((1, 2, 1)), SimpleNamespace(identity='c')),
+    ]
+    kwargs = dict(min_non_blank_amt=0.3, batch_size=5, print_time=False, ring_size=4)
+    results = list(make_extractor(tiff_path).iterate_tiles_with_multi_model_conf(models_and_configs, **kwargs))
+
+    for model, config in models_and_configs:
+        expected = list(make_extractor(tiff_path).iterate_tiles_with_lesion_conf(
+            model, getattr(config, 'non_lesion_indices', None), **kwargs))
+        assert len(results) == len(expected)
+        for res, exp in zip(results, expected):
+            assert np.array_equal(res['coordinates'], exp['coordinates'])
+            assert np.array_equal(res['preds'][config.identity], exp['preds'])
+            if exp['lesion_confs'] is None:
+                assert res['lesion_confs'][config.identity] is None
+            else:
+                assert np.array_equal(res['lesion_confs'][config.identity], exp['lesion_confs'])
+
+
+@pytest.mark.parametrize('config, match', [
+    (SimpleNamespace(identity='b', tile_size=128), 'needs'),
+    (SimpleNamespace(identity='b', mpp=0.252), 'needs'),
+    (SimpleNamespace(identity='a'), 'identities'),
+])
+def test_multi_model_configs_must_fit(tiff_path, config, match):
+    models_and_configs = [(Model(), SimpleNamespace(identity='a')), (Model(), config)]
+    with pytest.raises(Exception, match=match):
+        next(make_extractor(tiff_path).iterate_tiles_with_multi_model_conf(models_and_configs, print_time=False))
+
+
+def test_ring_size_must_cover_queue_depth(tiff_path):
+    with pytest.raises(Exception, match='queue depth'):
+        next(make_extractor(tiff_path).iterate_tiles_with_lesion_conf(Model(), [0, 1], print_time=False,
+                                                                      queue_depth=2, ring_size=3))
+
+
+@pytest.mark.parametrize('num_workers', [0, 2])
+def test_cached_tiles_match_extracted_tiles(tiff_path, tmp_path, num_workers):
+    kwargs = dict(min_non_blank_amt=0.3, batch_size=5, num_workers=num_workers)
+    expected = collect(make_extractor(tiff_path), **kwargs)
+
+    runs = []
+    for _ in range(2):
+        with TileCache(str(tmp_path / 'cache'), 64) as cache:
+            tile_extractor = make_extractor(tiff_path, tile_cache=cache)
+            runs.append(collect(tile_extractor, **kwargs))
+            stats = tile_extractor.stats.summary()
+
+    # the second run reads every tile from the cache
+    assert stats['cache']['count'] == len(tile_extractor.grid_xs) * len(tile_extractor.grid_ys)
+    assert stats['read']['count'] == 0
+    for tiles, coordinates in runs:
+        assert np.array_equal(coordinates, expected[1])
+        assert np.array_equal(tiles, expected[0])
+
+
+@pytest.mark.parametrize('stride', [None, 24, 90])
+@pytest.mark.parametrize('edge_mode', TileExtractor.EDGE_MODES)
+def test_tissue_mask_keeps_every_non_blank_tile(tiff_path, stride, edge_mode):
+    kwargs = dict(min_non_blank_amt=0.3, batch_size=5)
+    expected = collect(make_extractor(tiff_path, stride=stride, edge_mode=edge_mode), **kwargs)
+
+    tile_extractor = make_extractor(tiff_path, stride=stride, edge_mode=edge_mode)
+    tiles, coordinates = collect(tile_extractor, use_tissue_mask=True, **kwargs)
+
+    # background tiles are skipped without being read
+    reads = tile_extractor.stats.summary()['read']['count']
+    assert len(expected[0]) <= reads < len(tile_extractor.grid_xs) * len(tile_extractor.grid_ys)
+    assert np.array_equal(coordinates, expected[1])
+    assert np.array_equal(tiles, expected[0])
+
+
+def test_amount_blank_fast_matches_amount_blank(tissue):
+    rng = np.random.RandomState(0)
+    # greys with small channel differences around the std dev threshold, plus real tissue
+    greys = np.clip(rng.randint(0, 256, (8, 64, 64, 1)) + rng.randint(-12, 13, (8, 64, 64, 3)), 0, 255)
+    tiles = np.concatenate([greys.astype(np.uint8), tissue(512, 128).reshape(2, 64, 8, 64, 3).swapaxes(1, 2).reshape(-1, 64, 64, 3)])
+
+    expected = np.array([TileExtractor.amount_blank(tile) for tile in tiles])
+    assert np.array_equal(TileExtractor.amount_blank_fast(tiles), expected)
+    assert TileExtractor.amount_blank_fast(tiles[3]) == expected[3]
+
+
+def assert_pyramid_matches_full_resolution(path):
+    tiles = {}
+    for use_pyramid in (True, False):
+        slide = Slide(path)
+        slide.mpp = 0.252
+        tile_extractor = TileExtractor(slide, tile_size=128, desired_tile_mpp=0.504, use_pyramid=use_pyramid)
+        assert tile_extractor.level == (1 if use_pyramid else 0)
+        tiles[use_pyramid] = collect(tile_extractor, batch_size=8)
+        slide.close()
+
+    assert np.array_equal(tiles[True][1], tiles[False][1])
+    assert np.abs(tiles[True][0].astype(int) - tiles[False][0]).mean() < 5
+
+
+@pytest.mark.parametrize('size', [(4096, 3072), (4100, 3075), (1001, 999)])
+def test_pyramid_matches_full_resolution_jpeg(jpeg_path, size):
+    assert_pyramid_matches_full_resolution(jpeg_path(*size))
+
+
+@pytest.mark.parametrize('size', [(2048, 1536), (2050, 1537), (1001, 999)])
+def test_pyramid_matches_full_resolution_tiff(tmp_path, tissue, size):
+    image = tissue(*size)
+    half = cv2.resize(image, (-(-size[0] // 2), -(-size[1] // 2)), interpolation=cv2.INTER_AREA)
+
+    path = str(tmp_path / 'slide.tif')
+    write_tiled_tiff(path, [(img.shape[1], img.shape[0], lambda y1, y2, img=img: img[y1:y2]) for img in (image, half)])
+    assert_pyramid_matches_full_resolution(path)
+
+
+@pytest.fixture
+def pyramid_path(tmp_path, tissue):
+    # a level a third the size, so tile boxes are rounded to the level and what is left of the downsampling is done
+    # by resizing
+    image = tissue(2000, 1520)
+    third = cv2.resize(image, (667, 507), interpolation=cv2.INTER_AREA)
+    path = str(tmp_path / 'pyramid.tif')
+    write_tiled_tiff(path, [(img.shape[1], img.shape[0], lambda y1, y2, img=img: img[y1:y2]) for img in (image, third)],
+                     tile_size=128)
+    return path
+
+
+def make_level_extractor(path, **kwargs):
+    slide = Slide(path)
+    slide.mpp = 0.1
+    tile_extractor = TileExtractor(slide, tile_size=64, desired_tile_mpp=0.35, use_pyramid=True, **kwargs)
+    assert tile_extractor.level == 1
+    return tile_extractor
+
+
+@pytest.mark.parametrize('stride, read_mode, num_workers', [
+    (None, 'tile', 0), (None, 'tile', 2), (24, 'tile', 0), (5, 'tile', 0), (None, 'strip', 0), (24, 'strip', 0),
+])
+def test_pyramid_level_reads_match_tile_by_tile(pyramid_path, stride, read_mode, num_workers):
+    # a worker reads each tile from the level on its own
+    expected = collect(make_level_extractor(pyramid_path, stride=stride), min_non_blank_amt=0.3, batch_size=50,
+                       num_workers=1)
+
+    tiles, coordinates = collect(make_level_extractor(pyramid_path, stride=stride), min_non_blank_amt=0.3,
+                                 batch_size=50, read_mode=read_mode, num_workers=num_workers, worker_type='process')
+    assert np.array_equal(coordinates, expected[1])
+    if read_mode == 'strip':
+        assert np.abs(tiles.astype(int) - expected[0]).mean() < 6
+    else:
+        assert np.array_equal(tiles, expected[0])
@@ -0,0 +1,95 @@
+import numpy as np
+import pytest
+
+from brain_utils.general_utility.ai.top_tiles import TopTilesPerClass
+
+
+def make_batches(n=200, num_classes=5, seed=0):
+    '''
+    Batches of random sizes of tiles marked with their index, and confs rounded so that many of them are equal
+    '''
+
+    rng = np.random.RandomState(seed)
+    tiles = np.arange(n, dtype=np.uint8).reshape(n, 1, 1, 1) * np.ones((1, 4, 4, 3), dtype=np.uint8)
+    coordinates = np.stack([np.arange(n), np.zeros(n, dtype=int), np.arange(n) + 4, np.full(n, 4)], axis=1)
+    confs = np.round(rng.dirichlet(np.ones(num_classes), n), 1)
+
+    bounds = [0] + sorted(rng.choice(np.arange(1, n), 15, replace=False)) + [n]
+    batches = [(tiles[s:e], coordinates[s:e], confs[s:e]) for s, e in zip(bounds[:-1], bounds[1:])]
+    return batches, (tiles, coordinates, confs)
+
+
+@pytest.mark.parametrize('k', [1, 3, 8])
+def test_class_tiles_match_sorting_the_whole_slide(k):
+    batches, (tiles, coordinates, confs) = make_batches()
+    store = TopTilesPerClass(confs.shape[1], k)
+    for batch in batches:
+        store.add(*batch)
+
+    for c in range(confs.shape[1]):
+        # most confident first, earlier tiles first on equal confs
+        expected = np.argsort(-confs[:, c], kind='stable')[:k]
+        class_tiles, class_coordinates, class_confs = store.get_class_tiles(c)
+        assert np.array_equal(class_tiles, tiles[expected])
+        assert np.array_equal(class_coordinates, coordinates[expected])
+        assert np.array_equal(class_confs, confs[expected, c])
+
+
+@pytest.mark.parametrize('k', [1, 3])
+def test_kept_tiles_give_the_slides_argmax(k):
+    batches, (tiles, coordinates, confs) = make_batches(seed=1)
+    store = TopTilesPerClass(confs.shape[1], k)
+    for batch in batches:
+        store.add(*batch)
+
+    kept_tiles, kept_coordinates, kept_confs = store.get_tiles()
+    # in the order they were added, and a tile in several classes' top k is only kept once
+    assert np.all(np.diff(kept_coordinates[:, 0]) > 0)
+    assert len(store) == len(kept_tiles) <= k * confs.shape[1]
+    assert np.array_equal(kept_confs, confs[kept_coordinates[:, 0]])
+
+    for c in range(confs.shape[1]):
+        assert np.array_equal(kept_tiles[np.argmax(kept_confs[:, c])], tiles[np.argmax(confs[:, c])])
+    assert np.array_equal(kept_coordinates[np.unravel_index(np.argmax(kept_confs), kept_confs.shape)[0]],
+                          coordinates[np.unravel_index(np.argmax(confs), confs.shape)[0]])
+
+
+def test_tiles_are_copied_out_of_the_batch():
+    tiles = np.full((2, 4, 4, 3), 7, dtype=np.uint8)
+    store = TopTilesPerClass(2)
+    store.add(tiles, np.zeros((2, 4)), [[0.9, 0.1], [0.2, 0.8]])
+
+    # a reused buffer being overwritten by the next batch
+    tiles[:] = 0
+    assert np.all(store.get_tiles()[0] == 7)
+
+
+def test_add_result_uses_the_identitys_preds():
+    tiles = np.arange(3, dtype=np.uint8).reshape(3, 1, 1, 1) * np.ones((1, 4, 4, 3), dtype=np.uint8)
+    res = {
+        'tiles': tiles,
+        'coordinates': np.zeros((3, 4)),
+        'preds': {'a': np.array([[0.9, 0.1], [0.5, 0.5], [0.1, 0.9]]),
+                  'b': np.array([[0.1, 0.9], [0.8, 0.2], [0.4, 0.6]])},
+    }
+
+    store = TopTilesPerClass(2)
+    store.add_result(res, 'b')
+    assert store.get_class_tiles(0)[0][0, 0, 0, 0] == 1
+    assert store.get_class_tiles(1)[0][0, 0, 0, 0] == 0
+
+    store = TopTilesPerClass(2)
+    store.add_result(dict(res, preds=res['preds']['a']))
+    assert store.get_class_tiles(0)[0][0, 0, 0, 0] == 0
+    assert store.get_class_tiles(1)[0][0, 0, 0, 0] == 2
+
+
+def test_invalid_use():
+    with pytest.raises(Exception, match='at least 1'):
+        TopTilesPerClass(3, k=0)
+
+    store = TopTilesPerClass(3)
+    with pytest.raises(Exception, match='No tiles'):
+        store.get_tiles()
+    with pytest.raises(Exception, match='shape'):
+        store.add(np.zeros((2, 4, 4, 3)), np.zeros((2, 4)), np.zeros((2, 2)))